@@ -0,0 +1,267 @@
+"""Storage backends for the archive of pull requests processed by the CI
+server. The archive behaves like a dictionary of lowered repo names whose
+values are dictionaries of pull request numbers (as strings) and their
+processing status, i.e. `archive[repokey][snumber]["completed"]`.
+
+The JSON backend re-writes a single file every time the archive is saved. The
+SQLite backend stores one row per (repo, pull request number, head SHA) and
+only writes the entries that changed, so saving costs the same no matter how
+much history the archive has.
+"""
+from collections import MutableMapping
+from threading import RLock
+from pyci.msg import vms
+
+sqlite_extensions = [".db", ".sqlite", ".sqlite3"]
+"""Archive file extensions that select the SQLite backend."""
+
+def get_store(filepath):
+    """Returns the archive store for the specified file path; the backend is
+    chosen by the file extension.
+    """
+    from os import path
+    if path.splitext(filepath)[1].lower() in sqlite_extensions:
+        return SqliteStore(filepath)
+    else:
+        return JsonStore(filepath)
+
+class JsonStore(object):
+    """Keeps the whole archive in a single JSON file."""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        """The full path to the JSON archive file."""
+
+    def load(self):
+        """Returns the archive dictionary deserialized from the JSON file."""
+        from utility import get_json
+        return get_json(self.filepath, {})
+
+    def save(self, archive):
+        """Serializes the entire archive to the JSON file."""
+        import json
+        from utility import json_serial
+        with open(self.filepath, 'w') as f:
+            json.dump(archive, f, default=json_serial)
+
+class SqliteStore(object):
+    """Keeps the archive in an SQLite database with one row per processed
+    pull request head. Entries are written transactionally when they change.
+    """
+    def __init__(self, filepath):
+        """
+        :arg filepath: the full path to the database file. If it doesn't exist
+          yet and a JSON archive with the same base name does, the JSON archive
+          is migrated into the new database.
+        """
+        import sqlite3
+        from os import path
+        self.filepath = filepath
+        """The full path to the SQLite database file."""
+        self.lock = RLock()
+        """Serializes access to the connection across threads."""
+        self.dirty = {}
+        """Dictionary of (repo, number) keys and the ArchiveEntry instances that
+        changed since the last save.
+        """
+
+        exists = path.isfile(filepath)
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        """The sqlite3.Connection to the database."""
+        self._create()
+
+        jsonpath = path.splitext(filepath)[0] + ".json"
+        if not exists and path.isfile(jsonpath):
+            self.migrate(jsonpath)
+
+    def _create(self):
+        """Creates the tables and indices if they don't exist yet."""
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS repos "
+                                    "(repo TEXT PRIMARY KEY)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pulls "
+                                    "(repo TEXT NOT NULL, number TEXT NOT NULL, "
+                                    "sha TEXT NOT NULL DEFAULT '', data TEXT NOT NULL, "
+                                    "updated REAL NOT NULL, "
+                                    "PRIMARY KEY (repo, number, sha))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS pulls_updated "
+                                    "ON pulls (repo, number, updated)")
+
+    def migrate(self, jsonpath):
+        """Imports all the entries from a JSON archive file in one transaction."""
+        from utility import get_json
+        vms("Migrating the JSON archive {} to {}.".format(jsonpath, self.filepath))
+        archive = get_json(jsonpath, {})
+        with self.lock, self.connection:
+            for repo, pulls in archive.items():
+                self.connection.execute("INSERT OR IGNORE INTO repos VALUES (?)", (repo,))
+                for snumber, entry in pulls.items():
+                    self._write(repo, snumber, entry)
+
+    def load(self):
+        """Returns a SqliteArchive mapping backed by this store. No entries are
+        read until they are accessed.
+        """
+        return SqliteArchive(self)
+
+    def save(self, archive=None):
+        """Writes all the changed entries to the database in one transaction."""
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+            with self.connection:
+                for (repo, snumber), entry in self.dirty.items():
+                    self._write(repo, snumber, entry)
+            self.dirty = {}
+
+    def _write(self, repo, snumber, entry):
+        """Inserts or replaces the row for the entry; must be called within a
+        transaction.
+        """
+        import json
+        from time import time
+        from utility import json_serial
+        sha = entry.get("sha") or ""
+        if entry.get("compact"):
+            #The compact summary replaces the entire history of the pull request.
+            self.connection.execute("DELETE FROM pulls WHERE repo=? AND number=?",
+                                    (repo, str(snumber)))
+        self.connection.execute("INSERT OR REPLACE INTO pulls VALUES (?, ?, ?, ?, ?)",
+                                (repo, str(snumber), sha, json.dumps(entry, default=json_serial),
+                                 time()))
+
+    def read(self, repo, snumber):
+        """Returns the decoded data of the most recent entry for the pull
+        request, or None if it hasn't been archived.
+        """
+        import json
+        from utility import load_with_datetime
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM pulls WHERE repo=? AND number=? "
+                                          "ORDER BY updated DESC LIMIT 1",
+                                          (repo, str(snumber))).fetchone()
+        if row is not None:
+            return json.loads(row[0], object_pairs_hook=load_with_datetime)
+
+    def query(self, sql, args=()):
+        """Returns all the rows for the SQL query."""
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def execute(self, sql, args=()):
+        """Executes the SQL statement in its own transaction."""
+        with self.lock, self.connection:
+            self.connection.execute(sql, args)
+
+class SqliteArchive(MutableMapping):
+    """Dictionary-like view of the repos in a SqliteStore."""
+    def __init__(self, store):
+        self.store = store
+        """The SqliteStore that holds the entries."""
+        self._repos = {}
+        """Dictionary of the RepoArchive instances handed out so far."""
+
+    def __getitem__(self, repo):
+        if repo not in self._repos:
+            if len(self.store.query("SELECT 1 FROM repos WHERE repo=?", (repo,))) == 0:
+                raise KeyError(repo)
+            self._repos[repo] = RepoArchive(self.store, repo)
+        return self._repos[repo]
+
+    def __setitem__(self, repo, pulls):
+        self.store.execute("INSERT OR IGNORE INTO repos VALUES (?)", (repo,))
+        self._repos[repo] = RepoArchive(self.store, repo)
+        for snumber, entry in pulls.items():
+            self._repos[repo][snumber] = entry
+
+    def __delitem__(self, repo):
+        with self.store.lock, self.store.connection:
+            self.store.connection.execute("DELETE FROM pulls WHERE repo=?", (repo,))
+            self.store.connection.execute("DELETE FROM repos WHERE repo=?", (repo,))
+        self.store.dirty = {k: v for k, v in self.store.dirty.items() if k[0] != repo}
+        if repo in self._repos:
+            del self._repos[repo]
+
+    def __contains__(self, repo):
+        return (repo in self._repos or
+                len(self.store.query("SELECT 1 FROM repos WHERE repo=?", (repo,))) > 0)
+
+    def __iter__(self):
+        return iter([r[0] for r in self.store.query("SELECT repo FROM repos")])
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM repos")[0][0]
+
+class RepoArchive(MutableMapping):
+    """Dictionary-like view of the pull requests archived for a single repo.
+    Only the most recent entry of each pull request is visible.
+    """
+    def __init__(self, store, repo):
+        self.store = store
+        """The SqliteStore that holds the entries."""
+        self.repo = repo
+        """The lowered name of the repository."""
+        self._entries = {}
+        """Dictionary of the ArchiveEntry instances read or written so far."""
+
+    def __getitem__(self, snumber):
+        snumber = str(snumber)
+        if snumber not in self._entries:
+            data = self.store.read(self.repo, snumber)
+            if data is None:
+                raise KeyError(snumber)
+            self._entries[snumber] = ArchiveEntry(self, snumber, data)
+        return self._entries[snumber]
+
+    def __setitem__(self, snumber, entry):
+        snumber = str(snumber)
+        self._entries[snumber] = ArchiveEntry(self, snumber, entry)
+        self._entries[snumber].changed()
+
+    def __delitem__(self, snumber):
+        snumber = str(snumber)
+        self.store.execute("DELETE FROM pulls WHERE repo=? AND number=?", (self.repo, snumber))
+        self.store.dirty.pop((self.repo, snumber), None)
+        self._entries.pop(snumber, None)
+
+    def __contains__(self, snumber):
+        snumber = str(snumber)
+        return (snumber in self._entries or
+                len(self.store.query("SELECT 1 FROM pulls WHERE repo=? AND number=?",
+                                     (self.repo, snumber))) > 0)
+
+    def __iter__(self):
+        numbers = set(r[0] for r in self.store.query("SELECT DISTINCT number FROM pulls "
+                                                     "WHERE repo=?", (self.repo,)))
+        return iter(numbers | set(self._entries))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+class ArchiveEntry(dict):
+    """Status dictionary of a single archived pull request that remembers when
+    it is modified so the store only writes the entries that changed.
+    """
+    def __init__(self, parent, snumber, data):
+        dict.__init__(self, data)
+        self.parent = parent
+        """The RepoArchive that this entry belongs to."""
+        self.snumber = snumber
+        """The pull request number as a string."""
+
+    def changed(self):
+        """Flags the entry to be written on the next save of the store."""
+        store = self.parent.store
+        with store.lock:
+            store.dirty[(self.parent.repo, self.snumber)] = self
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.changed()
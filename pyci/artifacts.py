@@ -0,0 +1,151 @@
+"""Cache of build products (the folders named in a repo's <cache> tag) keyed by
+the hashes of the files that determine them, such as a makefile or a
+requirements file. Matching entries are restored into the staging directory
+before the tests and new ones are saved after them; the least recently used
+entries are evicted when the cache grows beyond its disk budget.
+"""
+from threading import RLock
+from pyci.msg import vms, warn
+
+class ArtifactCache(object):
+    """A folder with one sub-folder per cached build product and an index with
+    the size and last use of each.
+    """
+    def __init__(self, folder, budget):
+        """
+        :arg folder: the full path to the cache's directory.
+        :arg budget: the maximum number of bytes that the cached entries may use.
+        """
+        from os import path, makedirs
+        self.folder = path.abspath(path.expanduser(folder))
+        """The full path to the cache's directory."""
+        self.budget = budget
+        """The maximum number of bytes that the cached entries may use."""
+        self.index = {}
+        """Dictionary of cache keys and their 'size' (in bytes), 'used' (epoch time
+        of the last save or restore) and the 'repo' and 'path' they came from.
+        """
+        self.lock = RLock()
+        """Serializes changes to the cache between the workers."""
+        if not path.isdir(self.folder):
+            makedirs(self.folder)
+        self._load()
+
+    @property
+    def indexpath(self):
+        """Returns the full path to the JSON index of the cache."""
+        from os import path
+        return path.join(self.folder, "index.json")
+
+    def _load(self):
+        """Loads the index, dropping entries whose folders are gone."""
+        import json
+        from os import path
+        if not path.isfile(self.indexpath):
+            return
+        try:
+            with open(self.indexpath) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            warn("Unable to read the artifact cache index at {}.".format(self.indexpath))
+            return
+        self.index = dict((k, v) for k, v in index.items() if path.isdir(self.entrypath(k)))
+
+    def _save(self):
+        """Saves the index to disk."""
+        import json
+        from os import rename
+        temp = self.indexpath + ".tmp"
+        with open(temp, 'w') as f:
+            json.dump(self.index, f)
+        rename(temp, self.indexpath)
+
+    def entrypath(self, key):
+        """Returns the full path to the folder of the cached entry."""
+        from os import path
+        return path.join(self.folder, key)
+
+    @property
+    def size(self):
+        """Returns the total number of bytes used by the cached entries."""
+        return sum(e["size"] for e in self.index.values())
+
+    def key(self, reponame, relpath, keyfiles, repodir):
+        """Returns the cache key for the folder of a repo; it changes whenever the
+        contents of one of the key files change.
+
+        :arg reponame: the full name of the repo.
+        :arg relpath: the path of the cached folder relative to the repo root.
+        :arg keyfiles: a list of paths (relative to the repo root) of the files
+          that determine the folder's contents.
+        :arg repodir: the full path to the staging directory.
+        """
+        from hashlib import sha1
+        from os import path
+        from assets import hash_file
+        from utility import get_repo_relpath
+        digest = sha1()
+        digest.update("{}\n{}\n".format(reponame, path.normpath(relpath)))
+        for keyfile in keyfiles:
+            filepath = get_repo_relpath(repodir, keyfile)
+            value = hash_file(filepath) if path.isfile(filepath) else "missing"
+            digest.update("{} {}\n".format(path.normpath(keyfile), value))
+        return digest.hexdigest()
+
+    def restore(self, key, target):
+        """Copies the cached entry to the target folder if there is one and the
+        target doesn't exist yet. Returns True if the entry was restored.
+        """
+        from os import path
+        from time import time
+        from assets import copy_tree
+        with self.lock:
+            #The lock also keeps the entry from being evicted while it is copied.
+            if key not in self.index or path.exists(target):
+                return False
+            vms("Restoring cached {} into {}.".format(key[0:7], target), 2)
+            copy_tree(self.entrypath(key), target)
+            self.index[key]["used"] = time()
+            self._save()
+            return True
+
+    def save(self, key, source, reponame=None, relpath=None):
+        """Adds the source folder to the cache under the key unless an entry for it
+        exists already, then evicts the least recently used entries until the cache
+        fits in its budget.
+        """
+        from os import path, rename
+        from shutil import rmtree
+        from time import time
+        from tempfile import mkdtemp
+        from assets import copy_tree
+        with self.lock:
+            if key in self.index or not path.isdir(source):
+                return
+        #The copy is made outside of the lock so that other workers can restore
+        #entries in the meantime.
+        vms("Caching {} as {}.".format(source, key[0:7]), 2)
+        temp = path.join(mkdtemp(dir=self.folder, suffix=".tmp"), "entry")
+        size = copy_tree(source, temp)
+        with self.lock:
+            if key in self.index:
+                #Another worker saved the same entry first.
+                rmtree(path.dirname(temp))
+                return
+            rename(temp, self.entrypath(key))
+            rmtree(path.dirname(temp))
+            self.index[key] = {"size": size, "used": time(), "repo": reponame, "path": relpath}
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache fits in its
+        budget.
+        """
+        from shutil import rmtree
+        for key in sorted(self.index, key=lambda k: self.index[k]["used"]):
+            if self.size <= self.budget:
+                break
+            vms("Evicting {} from the artifact cache.".format(key[0:7]), 2)
+            rmtree(self.entrypath(key))
+            del self.index[key]
@@ -0,0 +1,250 @@
+"""Content-addressed store for the static files and folders that are copied
+into the staging directories. Each source file is hashed once; the manifest
+remembers its modification time, size and hash so that unchanged files are
+never read again. By default each staging directory gets its own writable
+reflink or copy of the stored object, which is only replaced when a test
+changed it. Files that are marked for linking are staged as read-only hard
+links to the stored objects instead, so re-staging the same test data costs a
+stat() per file and no extra disk.
+"""
+from threading import RLock
+from pyci.msg import vms, warn
+
+FICLONE = 0x40049409
+"""The Linux ioctl request that makes a file share the extents of another one
+(a reflink) on copy-on-write file systems.
+"""
+
+class AssetStore(object):
+    """Stores the contents of static files by their SHA1 hash and materializes
+    them in the staging directories.
+    """
+    def __init__(self, folder):
+        """
+        :arg folder: the full path to the directory with the stored objects and
+          the manifest.
+        """
+        from os import path, makedirs
+        self.folder = path.abspath(path.expanduser(folder))
+        """The full path to the store's directory."""
+        self.manifest = {"files": {}, "objects": {}}
+        """Dictionary with the real paths to the source files and their 'mtime',
+        'size' and 'hash' when they were last fingerprinted ('files'), and the
+        modification times of the stored objects when they were written ('objects').
+        """
+        self.dirty = False
+        """True when the manifest changed since it was last saved to disk."""
+        self.lock = RLock()
+        """Serializes changes to the store between the workers that stage pull
+        requests at the same time.
+        """
+        if not path.isdir(path.join(self.folder, "objects")):
+            makedirs(path.join(self.folder, "objects"))
+        self._load()
+
+    @property
+    def manifestpath(self):
+        """Returns the full path to the JSON manifest file."""
+        from os import path
+        return path.join(self.folder, "manifest.json")
+
+    def _load(self):
+        """Loads the manifest from disk."""
+        import json
+        from os import path
+        if not path.isfile(self.manifestpath):
+            return
+        try:
+            with open(self.manifestpath) as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            warn("Unable to read the asset manifest at {}; rebuilding it.".format(self.manifestpath))
+            self.manifest = {"files": {}, "objects": {}}
+
+    def save(self):
+        """Saves the manifest to disk if anything changed."""
+        import json
+        from os import rename
+        with self.lock:
+            if not self.dirty:
+                return
+            temp = self.manifestpath + ".tmp"
+            with open(temp, 'w') as f:
+                json.dump(self.manifest, f)
+            rename(temp, self.manifestpath)
+            self.dirty = False
+
+    def objectpath(self, digest):
+        """Returns the full path to the stored object with the specified hash."""
+        from os import path
+        return path.join(self.folder, "objects", digest[0:2], digest[2:])
+
+    def add(self, source):
+        """Returns the hash of the source file, adding its contents to the store if
+        they aren't there yet. The file is only read if its size or modification
+        time changed since it was last added.
+        """
+        from os import path, stat
+        realpath = path.realpath(source)
+        info = stat(realpath)
+        with self.lock:
+            entry = self.manifest["files"].get(realpath)
+            if (entry is not None and entry["mtime"] == info.st_mtime and
+                entry["size"] == info.st_size and self._intact(entry["hash"], info.st_size)):
+                return entry["hash"]
+
+            vms("Fingerprinting static file {}.".format(realpath), 3)
+            digest = hash_file(realpath)
+            self.manifest["files"][realpath] = {"mtime": info.st_mtime, "size": info.st_size,
+                                                "hash": digest}
+            self.dirty = True
+            if not self._intact(digest, info.st_size):
+                self._ingest(realpath, digest, info)
+            return digest
+
+    def _intact(self, digest, size):
+        """Returns True if the object with the hash exists and wasn't modified
+        through one of its hard links since it was written.
+        """
+        from os import stat
+        try:
+            info = stat(self.objectpath(digest))
+        except OSError:
+            return False
+        return info.st_size == size and info.st_mtime == self.manifest["objects"].get(digest)
+
+    def _ingest(self, source, digest, info):
+        """Copies the source file into the store as the read-only object for the
+        hash. The object keeps the source's modification time, which is recorded
+        to detect later changes.
+        """
+        from os import path, makedirs, rename, chmod, utime, remove, stat
+        from shutil import copyfile
+        target = self.objectpath(digest)
+        if not path.isdir(path.dirname(target)):
+            makedirs(path.dirname(target))
+        if path.isfile(target):
+            remove(target)
+        temp = target + ".tmp"
+        copyfile(source, temp)
+        chmod(temp, info.st_mode & 0555)
+        utime(temp, (info.st_atime, info.st_mtime))
+        rename(temp, target)
+        self.manifest["objects"][digest] = stat(target).st_mtime
+
+    def materialize(self, source, target, link=False):
+        """Makes 'target' a copy of the source file with its own reflink or copy of
+        the stored object and the source's permissions, so that it can be written
+        to. It is only replaced if its size or modification time differ from the
+        object's.
+
+        :arg link: when true, the target is made a read-only hard link to the
+          stored object instead (a reflink or a plain copy when that isn't
+          possible). Nothing is done if the target is already linked to it.
+        """
+        from os import path, remove, makedirs, stat
+        digest = self.add(source)
+        objpath = self.objectpath(digest)
+        if path.isfile(target):
+            if path.samefile(objpath, target):
+                if link:
+                    return
+            elif not link:
+                info, objinfo = stat(target), stat(objpath)
+                if (info.st_size == objinfo.st_size and
+                    info.st_mtime == objinfo.st_mtime):
+                    return
+            remove(target)
+        elif not path.isdir(path.dirname(target)):
+            makedirs(path.dirname(target))
+
+        if not link:
+            from os import chmod
+            _clone(objpath, target)
+            chmod(target, stat(source).st_mode & 0777)
+            return
+        try:
+            from os import link as hardlink
+            hardlink(objpath, target)
+        except OSError:
+            #The staging directory is on a different file system.
+            _clone(objpath, target)
+
+    def copy(self, source, target, link=False):
+        """Materializes the source file or every file in the source folder at the
+        corresponding path under 'target'. Files in the target that aren't in the
+        source are left alone.
+
+        :arg link: when true, the files are staged as read-only hard links to the
+          stored objects; see materialize().
+        """
+        from os import path, walk
+        if path.isfile(source):
+            self.materialize(source, target, link)
+            return
+        for root, dirs, files in walk(source):
+            relpath = path.relpath(root, source)
+            for filename in files:
+                self.materialize(path.join(root, filename),
+                                 path.normpath(path.join(target, relpath, filename)),
+                                 link)
+
+def hash_file(filepath):
+    """Returns the hex SHA1 digest of the file's contents."""
+    from hashlib import sha1
+    digest = sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _reflink(source, target):
+    """Makes the target a copy-on-write clone of the source; returns False if the
+    file system doesn't support it.
+    """
+    from fcntl import ioctl
+    from os import remove
+    from shutil import copystat
+    with open(source, 'rb') as fsrc:
+        with open(target, 'wb') as fdst:
+            try:
+                ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                success = True
+            except IOError:
+                success = False
+    if success:
+        copystat(source, target)
+    else:
+        remove(target)
+    return success
+
+def _clone(source, target):
+    """Makes the target a reflink of the source where the file system supports
+    it and a plain copy otherwise; the modification time is preserved.
+    """
+    if not _reflink(source, target):
+        from shutil import copy2
+        copy2(source, target)
+
+def copy_tree(source, target):
+    """Copies the folder with reflinks where the file system supports them and
+    plain copies otherwise; symbolic links are re-created and the modification
+    times are preserved. Returns the total number of bytes in the files.
+    """
+    from os import path, walk, makedirs, readlink, symlink, lstat
+    from shutil import copy2, copystat
+    total = 0
+    for root, dirs, files in walk(source):
+        folder = path.normpath(path.join(target, path.relpath(root, source)))
+        if not path.isdir(folder):
+            makedirs(folder)
+        for name in dirs + files:
+            filepath = path.join(root, name)
+            if path.islink(filepath):
+                symlink(readlink(filepath), path.join(folder, name))
+            elif name in files:
+                if not _reflink(filepath, path.join(folder, name)):
+                    copy2(filepath, path.join(folder, name))
+                total += lstat(filepath).st_size
+        copystat(root, folder)
+    return total
@@ -0,0 +1,349 @@
+"""Thin client for the github REST API that sends conditional requests
+(If-None-Match/If-Modified-Since) and keeps the responses in a persistent
+on-disk cache. Unchanged resources come back as '304 Not Modified', which
+github does not count against the rate limit.
+"""
+from threading import Lock, RLock
+from pyci.msg import vms, err, warn
+
+_registry_lock = Lock()
+"""Guards the creation of clients in the registry."""
+clients = {}
+"""Process-wide registry of GithubClient instances keyed by the (username, apikey)
+credentials so that all repos sharing an account share one client.
+"""
+caches = {}
+"""Dictionary of cache file paths and the ResponseCache/RepoIndex instances
+loaded from them; shared by all the clients in the process. The clients keep
+their responses apart by prefixing the URLs with their user name.
+"""
+
+def get_client(username, apikey, settings):
+    """Returns the shared GithubClient for the credentials, creating it the
+    first time they are used.
+
+    :arg settings: the config.GlobalSettings with the cache file locations and
+      the metadata TTL.
+    """
+    key = (username, apikey)
+    with _registry_lock:
+        if key not in clients:
+            vms("Creating shared github client for '{}'.".format(username), 2)
+            cache = _get_cache(ResponseCache, settings.cachefile)
+            repos = _get_cache(RepoIndex, settings.repocache)
+            clients[key] = GithubClient(username, apikey, cache, settings.cachettl*60,
+                                        repos=repos)
+    return clients[key]
+
+def _get_cache(cls, filepath):
+    """Returns the shared instance of the cache class for the file path."""
+    from os import path
+    key = (cls.__name__, path.abspath(path.expanduser(filepath)))
+    if key not in caches:
+        caches[key] = cls(filepath)
+    return caches[key]
+
+class ResponseCache(object):
+    """Persistent cache of API responses keyed by URL. Each entry stores the
+    ETag and Last-Modified validators sent by the server, the time the
+    response was last validated and the decoded JSON body. The cache is shared
+    by the worker threads, so every access holds its lock.
+    """
+    def __init__(self, filepath=None):
+        """
+        :arg filepath: the path to the JSON file that the cache is serialized
+          to. If None, the cache only lives in memory.
+        """
+        from os import path
+        self.filepath = (path.abspath(path.expanduser(filepath))
+                         if filepath is not None else None)
+        """The full path to the JSON file with the cached responses."""
+        self.entries = {}
+        """Dictionary of URLs and their cached entries."""
+        self.dirty = False
+        """True when the entries changed since they were last saved to disk."""
+        self.lock = RLock()
+        """Serializes changes to the entries and their serialization to disk."""
+        self._load()
+
+    def _load(self):
+        """Loads the cached entries from disk. We don't use utility.get_json
+        here because the cached bodies should not be converted to datetimes.
+        """
+        import json
+        from os import path
+        if self.filepath is None or not path.isfile(self.filepath):
+            return
+        try:
+            with open(self.filepath) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            err("Unable to deserialize the response cache at {}".format(self.filepath))
+            self.entries = {}
+
+    def get(self, url):
+        """Returns the cached entry for the URL, or None."""
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url, etag, modified, data, next_url=None):
+        """Stores a validated response for the URL.
+
+        :arg etag: the value of the 'ETag' response header.
+        :arg modified: the value of the 'Last-Modified' response header.
+        :arg data: the decoded JSON body of the response.
+        :arg next_url: for paginated listings, the URL of the next page.
+        """
+        from time import time
+        with self.lock:
+            self.entries[url] = {"etag": etag, "modified": modified, "next": next_url,
+                                 "fetched": time(), "data": data}
+            self.dirty = True
+
+    def touch(self, url):
+        """Marks the cached entry for the URL as validated right now."""
+        from time import time
+        with self.lock:
+            self.entries[url]["fetched"] = time()
+            self.dirty = True
+
+    def save(self):
+        """Saves the cache to disk if anything changed. The file is replaced
+        atomically so that an interrupted save doesn't leave it truncated.
+        """
+        import json
+        from os import rename
+        with self.lock:
+            if self.filepath is None or not self.dirty:
+                return
+            temp = self.filepath + ".tmp"
+            with open(temp, 'w') as f:
+                json.dump(self.entries, f)
+            rename(temp, self.filepath)
+            self.dirty = False
+
+class RepoIndex(ResponseCache):
+    """Persistent index of lowered repository full names and the id, URLs and
+    clone URL that github resolved them to, so that the repo can be validated
+    by id without listing the owner's repositories.
+    """
+    def put(self, name, raw):
+        """Stores the resolved repository details for the name.
+
+        :arg name: the repository full name as configured in the repo XML.
+        :arg raw: the decoded JSON body of the github repository resource.
+        """
+        with self.lock:
+            self.entries[name.lower()] = {"id": raw["id"], "full_name": raw["full_name"],
+                                          "html_url": raw["html_url"],
+                                          "clone_url": raw["clone_url"]}
+            self.dirty = True
+
+    def get(self, name):
+        """Returns the resolved repository details for the name, or None."""
+        with self.lock:
+            return self.entries.get(name.lower())
+
+    def remove(self, name):
+        """Invalidates the entry for the name, e.g. after a rename."""
+        with self.lock:
+            if name.lower() in self.entries:
+                del self.entries[name.lower()]
+                self.dirty = True
+
+class GithubClient(object):
+    """Makes conditional GET requests to the github API for a single set of
+    credentials, re-using one HTTP session with keep-alive connections.
+    """
+    def __init__(self, username, apikey, cache=None, ttl=None,
+                 base_url="https://api.github.com", repos=None):
+        """
+        :arg username: the github user name to authenticate with.
+        :arg apikey: the API key (token) of the user.
+        :arg cache: the ResponseCache to validate requests against. If None,
+          an in-memory cache is used.
+        :arg repos: the RepoIndex of previously resolved repositories. If None,
+          an in-memory index is used.
+        :arg ttl: the number of seconds that cached metadata (repo and owner
+          details) is trusted without asking github again.
+        :arg base_url: the root URL of the github API.
+        """
+        import requests
+        self.username = username
+        """The github user name that authenticates the requests."""
+        self.apikey = apikey
+        """The API key of the github user."""
+        self.cache = cache if cache is not None else ResponseCache()
+        """The ResponseCache with the validators and bodies of previous responses."""
+        self.ttl = ttl
+        """Number of seconds that cached metadata is used without validation."""
+        self.repos = repos if repos is not None else RepoIndex()
+        """The RepoIndex of repository full names resolved previously."""
+        self.base_url = base_url.rstrip("/")
+        """The root URL of the github API."""
+        self.session = requests.Session()
+        """The requests.Session whose connection pool is shared by all requests."""
+        self.session.auth = (username, apikey)
+        self.session.headers.update({"Accept": "application/vnd.github.v3+json",
+                                     "User-Agent": "pyci"})
+        self._github = None
+        """Lazy initialization for the self.github property."""
+        self.ratelimit = {"remaining": None, "limit": None, "reset": None}
+        """The most recent rate limit status reported by github for these
+        credentials; 'reset' is the epoch time at which the limit resets.
+        """
+
+    @property
+    def github(self):
+        """Instance of github.Github for the same credentials; used to turn the
+        raw JSON responses into pygithub objects.
+        """
+        if self._github is None:
+            from github import Github
+            self._github = Github(self.username, self.apikey, base_url=self.base_url)
+        return self._github
+
+    @property
+    def rate_limiting(self):
+        """Returns a tuple of (remaining, limit) for the API requests of these
+        credentials, as reported by the headers of our last response. Both are
+        None until a response was seen; pygithub's own status isn't read because
+        it queries github for it when it has made no requests yet.
+        """
+        return (self.ratelimit["remaining"], self.ratelimit["limit"])
+
+    @property
+    def throttled(self):
+        """Returns True if the rate limit is exhausted and hasn't reset yet; before
+        any response was seen, the client isn't throttled.
+        """
+        from time import time
+        remaining, limit = self.rate_limiting
+        reset = self.ratelimit["reset"]
+        return remaining == 0 and reset is not None and reset > time()
+
+    def _track(self, headers):
+        """Updates the rate limit status from the response headers."""
+        if "X-RateLimit-Remaining" in headers:
+            self.ratelimit["remaining"] = int(headers["X-RateLimit-Remaining"])
+            self.ratelimit["limit"] = int(headers.get("X-RateLimit-Limit", 0))
+            self.ratelimit["reset"] = int(headers.get("X-RateLimit-Reset", 0))
+            if self.ratelimit["remaining"] == 0:
+                warn("Github rate limit exhausted for '{}'.".format(self.username))
+
+    def _url(self, path):
+        """Returns the absolute URL for the API path (or URL)."""
+        if path.startswith("http"):
+            return path
+        return self.base_url + path
+
+    def get(self, path, ttl=None):
+        """Returns the decoded JSON body of the resource at the API path. The
+        cached validators are sent along so that unchanged resources are served
+        from the cache.
+
+        :arg ttl: if the cached entry was validated less than this many seconds
+          ago, it is returned without making a request at all.
+        """
+        data, next_url = self._get_page(self._url(path), ttl)
+        return data
+
+    def get_list(self, path, ttl=None):
+        """Returns the concatenated items of a paginated API listing. Each page
+        is validated and cached separately.
+        """
+        result = []
+        url = self._url(path)
+        while url is not None:
+            data, url = self._get_page(url, ttl)
+            result.extend(data)
+        return result
+
+    def _get_page(self, url, ttl=None):
+        """Makes the conditional request for a single URL. Returns a tuple of the
+        decoded body and the URL of the next page (or None).
+        """
+        from time import time
+        #Other credentials may not be allowed to see the same resources, so the
+        #responses are cached separately for each user.
+        key = "{}@{}".format(self.username, url)
+        entry = self.cache.get(key)
+        if entry is not None and ttl is not None and time() - entry["fetched"] < ttl:
+            vms("Using cached response for {} (within TTL).".format(url), 3)
+            return (entry["data"], entry["next"])
+
+        headers = {}
+        if entry is not None:
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["modified"] is not None:
+                headers["If-Modified-Since"] = entry["modified"]
+
+        response = self.session.get(url, headers=headers)
+        self._track(response.headers)
+        if response.status_code == 304 and entry is not None:
+            vms("Cache hit (304) for {}.".format(url), 3)
+            if ttl is not None:
+                self.cache.touch(key)
+            return (entry["data"], entry["next"])
+
+        response.raise_for_status()
+        data = response.json()
+        next_url = response.links.get("next", {}).get("url")
+        self.cache.put(key, response.headers.get("ETag"),
+                       response.headers.get("Last-Modified"), data, next_url)
+        return (data, next_url)
+
+    def get_pulls(self, fullname):
+        """Returns a list of github.PullRequest.PullRequest instances for the
+        open pull requests of the repository with the specified full name.
+        """
+        from github.PullRequest import PullRequest
+        raw = self.get_list("/repos/{}/pulls?state=open&per_page=100".format(fullname))
+        self.cache.save()
+        return [self.github.create_from_raw_data(PullRequest, r) for r in raw]
+
+    def get_metadata(self, path):
+        """Returns the decoded JSON for a rarely-changing resource such as a repo
+        or its owner, honoring the configured TTL.
+        """
+        result = self.get(path, self.ttl)
+        self.cache.save()
+        return result
+
+    def get_repo(self, fullname):
+        """Returns the github.Repository.Repository with the specified full name
+        using a single (usually conditional) request. Raises a ValueError if the
+        repository doesn't exist or isn't accessible with these credentials.
+        """
+        from requests import HTTPError
+        from github.Repository import Repository
+        from pyci.msg import warn
+        raw = None
+        entry = self.repos.get(fullname)
+        if entry is not None:
+            #Validating by id means that a rename shows up as a different full
+            #name instead of a redirect.
+            try:
+                raw = self.get("/repositories/{}".format(entry["id"]))
+            except HTTPError:
+                vms("Cached repository '{}' is no longer accessible.".format(fullname), 2)
+            if raw is not None and raw["full_name"].lower() != fullname.lower():
+                warn("Repository '{}' was renamed to '{}'; please update its XML "
+                     "settings file.".format(fullname, raw["full_name"]))
+                raw = None
+            if raw is None:
+                self.repos.remove(fullname)
+
+        if raw is None:
+            try:
+                raw = self.get("/repos/{}".format(fullname))
+            except HTTPError:
+                self.repos.save()
+                raise ValueError("Repository '{}' doesn't exist or isn't accessible "
+                                 "to '{}'.".format(fullname, self.username))
+            self.repos.put(fullname, raw)
+
+        self.repos.save()
+        self.cache.save()
+        return self.github.create_from_raw_data(Repository, raw)
@@ -36,9 +36,38 @@ class RepositorySettings(object):
         be copied locally before updating them from the repo. These should be files
         and folders that probably never change (like the unit testing input/output).
         """        
+        self.prepare = []
+        """A list of shell commands (builds, dependency installs) that are run in a
+        staging directory after the static files are copied and before the tests.
+        """
+        self.cache = []
+        """A list of the folders (relative to the repo root) whose contents are
+        cached between pull requests, each a dictionary with the folder's 'path'
+        and the list of 'keys' files that determine its contents.
+        """
         self.wiki = {"user": None, "password": None, "basepage": None}
         """Settings for logging into and editing the base wiki page for the repo.
         """
+        self.staging = None
+        """The path to the staging directory that pull requests are checked out in."""
+        self.mirror = None
+        """The path to the local bare mirror of the repository that the staging
+        directories are checked out from as git worktrees.
+        """
+        self.ref = "head"
+        """The pull request ref to test: 'head' for the pull request's own commits,
+        'merge' for github's test merge of it into the base branch.
+        """
+        self.depth = None
+        """The number of commits of history to fetch into the mirror for each
+        branch and pull request. If None, the full history is fetched.
+        """
+        self.filter = None
+        """The partial clone filter of the mirror (e.g. 'blob:none'), or None."""
+        self.sparse = None
+        """A list of paths relative to the repo root that are checked out in the
+        staging directories. If None, the whole repo is checked out.
+        """
         
         self._repo = None
         """Lazy initialization for the self.repo property."""
@@ -46,6 +75,8 @@ class RepositorySettings(object):
         """Lazy initialization for the self.user property."""
         self._org = None
         """Lazy initialization for the self.org property."""
+        self._client = None
+        """Lazy initialization for the self.client property."""
 
         if self.filepath is not None:
             self._parse_xml()
@@ -58,8 +89,9 @@ class RepositorySettings(object):
         """Instance of the github.Organization.Organization specified as owning the
         repository being monitored.
         """
-        if self._org is None:
-            self._get_github()
+        if self._org is None and self.organization is not None:
+            self._org = self.client.github.get_organization(self.organization)
+            vms("Found github organization '{}'.".format(self._org.name), 2)
 
         return self._org
         
@@ -83,37 +115,32 @@ class RepositorySettings(object):
             
         return self._repo
 
+    @property
+    def client(self):
+        """Instance of pyci.client.GithubClient that makes conditional, cached
+        requests to the github API with this repo's credentials.
+        """
+        if self._client is None:
+            #All the repos that share the same credentials share a single client
+            #(and its connections and rate limit status) for the whole process.
+            from pyci.client import get_client
+            settings = self.server.settings if self.server is not None else GlobalSettings()
+            self._client = get_client(self.username, self.apikey, settings)
+        return self._client
+
     def _get_github(self):
         """Creates an instance of github.Github to interact with the repos via the 
         API interface in pygithub.
         """
-        from github import Github
         vms("Querying github with user '{}'.".format(self.username))
-        g = Github(self.username, self.apikey)
-        self._user = g.get_user()
+        self._user = self.client.github.get_user()
         if self._user is None:
             raise ValueError("Can't authenticate to github with '{}'.".format(self.username))
-        #The github user authenticating always has to be specified; however the user
-        #may not be able to see the repo, even if it has access to it. We may need
-        #to check the organization repos.
-        if self.organization is not None:
-            self._org = g.get_organization(self.organization)
-            vms("Found github organization '{}'.".format(self._org.name), 2)
-
-            #Next we need to find this repository in the lists available to both
-            #the user *and* the organization. If they specified an organization, then we
-            #should check that first/exclusively.
-            for repo in self._org.get_repos():
-                if repo.full_name.lower() == self.name.lower():
-                    self._repo = repo
-                    vms("Found organization repository '{}'.".format(self._repo.full_name), 2)
-                    break
-        else:
-            for repo in self._user.get_repos():
-                if repo.full_name.lower() == self.name.lower():
-                    self._repo = repo
-                    vms("Found user repository '{}'.".format(self._repo.full_name), 2)
-                    break        
+        #The repository is looked up directly by its full name (or by the id that
+        #the name resolved to previously) instead of searching through every repo
+        #that the user or organization owns.
+        self._repo = self.client.get_repo(self.name)
+        vms("Found repository '{}'.".format(self._repo.full_name), 2)
                 
     def _parse_repo(self, xml):
         """Parses a <repo> tag to update settings on this Repository instance.
@@ -125,6 +152,15 @@ class RepositorySettings(object):
         self.apikey = get_attrib(xml, "apikey", "repo")
         self.organization = get_attrib(xml, "organization")
         self.staging = get_attrib(xml, "staging", "repo")
+        self.mirror = get_attrib(xml, "mirror", default="{}.git".format(self.staging.rstrip("/")))
+        self.ref = get_attrib(xml, "ref", default="head")
+        if self.ref not in ["head", "merge"]:
+            raise ValueError("The 'ref' attribute of <cirepo> should be 'head' or 'merge'.")
+        self.depth = get_attrib(xml, "depth", cast=int)
+        self.filter = get_attrib(xml, "filter")
+        sparse = get_attrib(xml, "sparse")
+        if sparse is not None:
+            self.sparse = [p.strip() for p in sparse.split(",") if p.strip() != ""]
         
     def _parse_xml(self):
         """Extracts the XML settings into class instances that can operate on
@@ -154,6 +190,14 @@ class RepositorySettings(object):
                     self.testing = TestingSettings(child)
                 if child.tag == "static":
                     self.static = StaticSettings(child)
+                if child.tag == "prepare":
+                    self.prepare = [c.text for c in child if c.tag == "command"]
+                if child.tag == "cache":
+                    for folder in child:
+                        if folder.tag == "folder":
+                            keys = get_attrib(folder, "keys", "folder")
+                            self.cache.append({"path": get_attrib(folder, "path", "folder"),
+                                               "keys": [k.strip() for k in keys.split(",")]})
                 if child.tag == "wiki":
                     self.wiki["user"] = get_attrib(child, "user", "wiki")
                     self.wiki["password"] = get_attrib(child, "password", "wiki")
@@ -183,6 +227,24 @@ class CronSettings(object):
         """A list of events to notify the email addresses of during the
         automation. Possible values: ['start', 'error', 'success', 'timeout', 'failure'].
         """
+        self.keep = None
+        """The maximum number of closed pull requests to keep in the archive for
+        the repo. If None, all of them are kept.
+        """
+        self.maxage = None
+        """The maximum age (in days) of closed pull requests kept in the archive.
+        If None, they never expire.
+        """
+        self.concurrency = 1
+        """The maximum number of pull requests of the repo that are processed at
+        the same time. When larger than 1, each pull request is staged in its own
+        copy of the staging directory.
+        """
+        self.batch = 1
+        """The maximum number of pull requests of the repo that are merged and
+        tested together. When a batch fails, it is split in halves until the pull
+        requests that break the tests are found.
+        """
 
         if xml is not None:
             self._parse_xml(xml)
@@ -201,6 +263,10 @@ class CronSettings(object):
         self.frequency = get_attrib(xml, "frequency", default=5, cast=int)
         self.emails = split(",\s*", get_attrib(xml, "emails", default=""))
         self.notify = split(",\s*", get_attrib(xml, "notify", default=""))
+        self.keep = get_attrib(xml, "keep", cast=int)
+        self.maxage = get_attrib(xml, "maxage", cast=int)
+        self.concurrency = get_attrib(xml, "concurrency", default=1, cast=int)
+        self.batch = get_attrib(xml, "batch", default=1, cast=int)
             
 class StaticSettings(object):
     """Settings describing files *local* to the server that should be copied into
@@ -211,7 +277,9 @@ class StaticSettings(object):
     def __init__(self, xml=None):
         self.files = []
         """A list of locally available files to copy before syncing with the remote
-        pull request.
+        pull request. Each is a dictionary with the 'source' path, the 'target'
+        path relative to the repo and whether it is staged as a read-only hard link
+        to the shared copy in the asset store ('link').
         """
         self.folders = []
         """A list of locally available folders to copy before syncing with the remote
@@ -234,36 +302,88 @@ class StaticSettings(object):
         vms("Parsing <static> XML child tag.", 2)
         for child in xml:
             if "path" in child.attrib and "target" in child.attrib:
+                #Hard links are shared between the staging directories, so they are
+                #only used for files that the tests never write to.
+                link = get_attrib(child, "link", default="false").lower() == "true"
                 if child.tag == "file":
                     self.files.append({"source": child.attrib["path"],
-                                       "target": child.attrib["target"]})
+                                       "target": child.attrib["target"],
+                                       "link": link})
                 elif child.tag == "folder":
                     self.folders.append({"source": child.attrib["path"],
-                                         "target": child.attrib["target"]})
+                                         "target": child.attrib["target"],
+                                         "link": link})
 
-    def copy(self, repodir):
+    def copy(self, repodir, store=None):
         """Copies the static files and folders specified in these settings into the
         locally-cloned repository directory.
 
         :arg repodir: the full path to the directory with the locally-cloned version
           of the pull request being unit tested.
+        :arg store: the assets.AssetStore to materialize the files from. If None,
+          the files are copied when the target is missing or older.
         """
-        #Instead of using the built-in shell copy, we make shell calls to rsync.
-        #This allows us to copy only changes across between runs of pull-requests.
-        from os import system, path
+        from os import path
         vms("Running static file copy locally.", 2)
-        for file in self.files:
-            fullpath = path.expanduser(file["source"])
-            if path.isfile(fullpath):
-                vms("Running 'rsync' for {}.".format(fullpath), 3)
-                system("rsync -t -u {} {}".format(fullpath, get_repo_relpath(repodir, file["target"])))
-
-        for folder in self.folders:
-            fullpath = path.expanduser(folder["source"])
-            if path.isdir(fullpath):
-                vms("Running 'rsync' for {}.".format(fullpath), 3)
-                system("rsync -t -u -r {} {}".format(path.join(fullpath, ""),
-                                                     path.join(get_repo_relpath(repodir, folder["target"]), "")))
+        sources = [(f["source"], f["target"], f["link"]) for f in self.files if
+                   path.isfile(path.expanduser(f["source"]))]
+        sources.extend([(f["source"], f["target"], f["link"]) for f in self.folders if
+                        path.isdir(path.expanduser(f["source"]))])
+        for source, target, link in sources:
+            fullpath = path.expanduser(source)
+            vms("Copying static {}.".format(fullpath), 3)
+            if store is not None:
+                store.copy(fullpath, get_repo_relpath(repodir, target), link)
+            else:
+                _copy_newer(fullpath, get_repo_relpath(repodir, target))
+        if store is not None:
+            store.save()
+
+    def digest(self, store):
+        """Returns the hex SHA1 digest of the targets and contents of the static
+        files; it changes whenever a file that would be staged changes.
+
+        :arg store: the assets.AssetStore that fingerprints the files.
+        """
+        from hashlib import sha1
+        from os import path, walk
+        result = sha1()
+        for f in self.files + self.folders:
+            source = path.expanduser(f["source"])
+            if path.isfile(source):
+                pairs = [(source, f["target"])]
+            else:
+                pairs = []
+                for root, dirs, files in walk(source):
+                    dirs.sort()
+                    relpath = path.relpath(root, source)
+                    pairs.extend([(path.join(root, n), path.join(f["target"], relpath, n))
+                                  for n in sorted(files)])
+            for filepath, target in pairs:
+                result.update("{} {}\n".format(path.normpath(target), store.add(filepath)))
+        store.save()
+        return result.hexdigest()
+
+def _copy_newer(source, target):
+    """Copies the source file, or the files in the source folder, to the target
+    if they are missing or older there; the modification times are preserved.
+    """
+    from os import path, walk, makedirs
+    from shutil import copy2
+    if path.isfile(source):
+        pairs = [(source, target)]
+    else:
+        pairs = []
+        for root, dirs, files in walk(source):
+            relpath = path.relpath(root, source)
+            pairs.extend([(path.join(root, f), path.normpath(path.join(target, relpath, f)))
+                          for f in files])
+    for filepath, targetpath in pairs:
+        if (not path.isfile(targetpath) or
+            path.getmtime(targetpath) < path.getmtime(filepath)):
+            if not path.isdir(path.dirname(targetpath)):
+                makedirs(path.dirname(targetpath))
+            copy2(filepath, targetpath)
                     
 class TestingSettings(object):
     """Settings describing the series of unit tests to perform on the repository
@@ -275,11 +395,30 @@ class TestingSettings(object):
         """
         self.timeout = None
         """The maximum number of minutes that *all* tests are allowed to take to run.
-        If None, the allowed time is infinite.
+        If None, the allowed time is infinite. Individual commands can also have a
+        'timeout' attribute (in minutes) of their own.
         """
         self.tests = []
         """A list of the unit tests to run on the merged pull request repository.
         """
+        self.serial = False
+        """When true, the test commands of a pull request run one after another
+        instead of in parallel.
+        """
+        self.cache = False
+        """When true, the results of the commands are cached by the git tree they
+        ran on, the command text and the 'cacheenv' variables; commands with a
+        cached result aren't run again.
+        """
+        self.cacheenv = []
+        """A list of the names of the environment variables that the results of
+        the commands depend on, e.g. the compiler to use.
+        """
+        self.matrix = []
+        """A list of (name, values) tuples from the <variable> tags of the <matrix>
+        tag. Each command that uses @name is expanded into one test per combination
+        of the values of the variables it uses.
+        """
 
         if xml is not None:
             self._parse_xml(xml)
@@ -296,11 +435,123 @@ class TestingSettings(object):
         """
         vms("Parsing <testing> XML child tag.", 2)
         self.timeout = get_attrib(xml, "timeout", cast=int)
+        self.serial = get_attrib(xml, "serial", default="false").lower() == "true"
+        self.cache = get_attrib(xml, "cache", default="false").lower() == "true"
+        cacheenv = get_attrib(xml, "cacheenv", default="")
+        self.cacheenv = [v.strip() for v in cacheenv.split(",") if v.strip() != ""]
         for child in xml:
-            if child.tag == "command":
+            if child.tag == "matrix":
+                for variable in child:
+                    if variable.tag == "variable":
+                        values = get_attrib(variable, "values", default="")
+                        values = [v.strip() for v in values.split(",") if v.strip() != ""]
+                        name = get_attrib(variable, "name", "variable")
+                        #A variable without values would silently drop every
+                        #command that uses it.
+                        if len(values) == 0:
+                            raise ValueError("The matrix variable '{}' has no values.".format(name))
+                        self.matrix.append((name, values))
+            elif child.tag == "command":
+                #'weight' is accepted as a synonym for the number of slots.
+                weight = get_attrib(child, "weight", default=1, cast=int)
+                needs = get_attrib(child, "needs", default="")
+                paths = get_attrib(child, "paths", default="")
                 self.tests.append({"command": child.text, "end": None,
                                    "success": False, "code": None,
-                                   "start": None, "result": None})
+                                   "start": None, "result": None,
+                                   "timeout": get_attrib(child, "timeout", cast=int),
+                                   "slots": get_attrib(child, "slots", default=weight, cast=int),
+                                   "id": get_attrib(child, "id"),
+                                   "needs": [n.strip() for n in needs.split(",") if n.strip() != ""],
+                                   "paths": [p.strip() for p in paths.split(",") if p.strip() != ""],
+                                   "cell": None})
+        self._check_needs()
+        if len(self.matrix) > 0:
+            self._expand_matrix()
+
+    def _check_needs(self):
+        """Makes sure that the 'needs' of the test commands refer to the 'id' of
+        another command and that they don't depend on each other in a cycle.
+        """
+        ids = {}
+        for test in self.tests:
+            if test["id"] is not None:
+                if test["id"] in ids:
+                    raise ValueError("Duplicate test command id '{}'.".format(test["id"]))
+                ids[test["id"]] = test
+        for test in self.tests:
+            for need in test["needs"]:
+                if need not in ids:
+                    raise ValueError("Test command '{}' needs unknown id '{}'.".format(
+                        test["command"], need))
+
+        #Depth-first search; a command that is reached again while its own needs
+        #are still being visited closes a cycle.
+        state = {}
+        def visit(key, chain):
+            if state.get(key) == "done":
+                return
+            if state.get(key) == "visiting":
+                raise ValueError("Test commands depend on each other in a cycle: "
+                                 "{}.".format(" -> ".join(chain + [key])))
+            state[key] = "visiting"
+            for need in ids[key]["needs"]:
+                visit(need, chain + [key])
+            state[key] = "done"
+        for key in ids:
+            visit(key, [])
+
+    def _cells(self, text):
+        """Returns the list of matrix cells (lists of (name, value) tuples) that the
+        command text has to be run for; commands that don't use any of the matrix
+        variables have a single empty cell.
+        """
+        from itertools import product
+        #Longer names are looked for first so that @PY doesn't match @PYTHON.
+        found = set()
+        for name in sorted([n for n, v in self.matrix], key=len, reverse=True):
+            if "@{}".format(name) in text:
+                found.add(name)
+                text = text.replace("@{}".format(name), "")
+        used = [(n, v) for n, v in self.matrix if n in found]
+        names = [n for n, v in used]
+        return [list(zip(names, values)) for values in product(*[v for n, v in used])]
+
+    def _expand_matrix(self):
+        """Replaces each command that uses matrix variables by one test per cell.
+        The 'id' of an expanded test gets the cell appended, and its 'needs' are the
+        cells of the needed commands that agree with it on their shared variables.
+        """
+        from copy import deepcopy
+        order = sorted([n for n, v in self.matrix], key=len, reverse=True)
+        def cellid(ident, cell):
+            if ident is None or len(cell) == 0:
+                return ident
+            return "{}[{}]".format(ident, ", ".join("{}={}".format(*c) for c in cell))
+
+        cells = dict((t["id"], self._cells(t["command"])) for t in self.tests
+                     if t["id"] is not None)
+        expanded = []
+        for test in self.tests:
+            for cell in self._cells(test["command"]):
+                values = dict(cell)
+                etest = deepcopy(test)
+                for name in order:
+                    if name in values:
+                        etest["command"] = etest["command"].replace("@{}".format(name), values[name])
+                etest["id"] = cellid(test["id"], cell)
+                etest["cell"] = cell if len(cell) > 0 else None
+                etest["needs"] = [cellid(need, other) for need in test["needs"]
+                                  for other in cells[need]
+                                  if all(values.get(n, v) == v for n, v in other)]
+                expanded.append(etest)
+        self.tests = expanded
+
+    def format_cell(self, test):
+        """Returns the matrix values that the test command was expanded for."""
+        if test.get("cell") is None:
+            return ""
+        return ", ".join("{}={}".format(n, v) for n, v in test["cell"])
 
     def format_time(self, time, function, yes, no):
         """Formats the specified time using function. If time is not None,
@@ -311,6 +562,23 @@ class TestingSettings(object):
         else:
             return function(no)
                 
+    def format_code(self, test):
+        """Returns the exit code of the test command for display, 'Timeout' if it
+        was killed for running too long or 'Skipped' if a command it needs failed
+        or the pull request didn't change any of its 'paths'. Codes that came from
+        the result cache are marked as such.
+        """
+        if test.get("timedout"):
+            return "Timeout"
+        elif test.get("filtered"):
+            return "Skipped (paths)"
+        elif test.get("skipped"):
+            return "Skipped"
+        elif test.get("cached"):
+            return "{} (cached)".format(test["code"])
+        else:
+            return str(test["code"])
+
     def html(self, full=True):
         """Returns an HTML table of the test results."""
         import dominate
@@ -319,6 +587,8 @@ class TestingSettings(object):
         with result.add(tbody()):
             header = tr()
             header += th("Command")
+            if len(self.matrix) > 0:
+                header += th("Cell")
             if full:
                 header += th("Start")
                 header += th("End")
@@ -327,10 +597,12 @@ class TestingSettings(object):
             for test in self.tests:
                 l = tr()
                 l += td(test["command"])
+                if len(self.matrix) > 0:
+                    l += td(self.format_cell(test))
                 if full:
                     l += self.format_time(test["start"], td, "%m/%d/%Y %H:%M", "None")
                     l += self.format_time(test["end"], td, "%m/%d/%Y %H:%M", "None")
-                    l += td(str(test["code"]))
+                    l += td(self.format_code(test))
 
         sresult = str(result)
         vms("HTML test table generated: {}.".format(sresult), 3)
@@ -343,12 +615,14 @@ class TestingSettings(object):
         result = []
         for test in self.tests:
             result.append("Command: {}".format(test["command"]))
+            if test.get("cell") is not None:
+                result.append(" - Cell:  {}".format(self.format_cell(test)))
             if full:
                 result.append(" - Start: {}".format(
                     self.format_time(test["start"], str, "%m/%d/%Y %H:%M", "None")))
                 result.append(" - End:   {}".format(
                     self.format_time(test["end"], str, "%m/%d/%Y %H:%M", "None")))
-                result.append(" - Code:  {}\n".format(test["code"]))
+                result.append(" - Code:  {}\n".format(self.format_code(test)))
 
         sresult = '\n'.join(result)
         vms("Text test table generated: {}.".format(sresult), 3)        
@@ -360,12 +634,14 @@ class TestingSettings(object):
         result = []
         for test in self.tests:
             result.append("# {}".format(test["command"]))
+            if test.get("cell") is not None:
+                result.append("* Cell:   {}".format(self.format_cell(test)))
             if full:
                 result.append("* Start:  {}".format(
                     self.format_time(test["start"], str, "%m/%d/%Y %H:%M", "None")))
                 result.append("* End:    {}".format(
                     self.format_time(test["end"], str, "%m/%d/%Y %H:%M", "None")))
-                result.append("* Code:   {}".format(test["code"]))
+                result.append("* Code:   {}".format(self.format_code(test)))
                 result.append("* Stdout: [[File:{}]]\n".format(test["remote_file"]))
 
         sresult = '\n'.join(result)
@@ -434,7 +710,39 @@ class GlobalSettings(object):
             return serial.lower() == "true"
         else:
             return serial
+
+    @property
+    def slots(self):
+        """Returns the number of CPU/memory slots shared by the test commands of
+        all the pull requests being tested; each command holds its 'slots' while
+        it runs. Serial mode is the special case of a single slot.
+        """
+        from multiprocessing import cpu_count
+        if self.serial:
+            return 1
+        return max(1, int(self.property_get("SLOTS", cpu_count())))
         
+    @property
+    def maxjobs(self):
+        """Returns the maximum number of pull requests (across all repos) that
+        the CI server processes at the same time; defaults to the number of CPUs.
+        """
+        from multiprocessing import cpu_count
+        return int(self.property_get("MAXJOBS", cpu_count()))
+
+    @property
+    def output_limits(self):
+        """Returns a tuple of the number of bytes of each test command's output to
+        keep from the start and from the end (OUTPUTHEAD and OUTPUTTAIL, in KB)
+        and whether the output files are gzip-compressed (OUTPUTGZIP).
+        """
+        head = int(self.property_get("OUTPUTHEAD", 1024))*1024
+        tail = int(self.property_get("OUTPUTTAIL", 1024))*1024
+        compress = self.property_get("OUTPUTGZIP", False)
+        if isinstance(compress, str):
+            compress = compress.lower() == "true"
+        return (head, tail, compress)
+
     @property
     def datafile(self):
         """Returns the full path to the data file listing installed repos."""
@@ -444,7 +752,100 @@ class GlobalSettings(object):
     def archfile(self):
         """Returns the full path to the arch file listing installed repos."""
         return self.property_get("ARCHFILE")
+
+    @property
+    def pidfile(self):
+        """Returns the full path to the PID file that guards against multiple
+        instances of the CI server running in daemon mode.
+        """
+        return self.property_get("PIDFILE", "~/.ci.pid")
     
+    @property
+    def webhook(self):
+        """Returns the port to listen on for github webhook events, or None if
+        the webhook receiver is disabled.
+        """
+        port = self.property_get("WEBHOOK")
+        return int(port) if port is not None else None
+
+    @property
+    def webhook_secret(self):
+        """Returns the shared secret used to verify the github webhook payloads."""
+        return self.property_get("WEBHOOKSECRET")
+
+    @property
+    def webhook_insecure(self):
+        """Returns True if WEBHOOKINSECURE explicitly allows webhook payloads that
+        aren't signed because no WEBHOOKSECRET is configured.
+        """
+        return str(self.property_get("WEBHOOKINSECURE", "false")).lower() == "true"
+
+    @property
+    def pollfreq(self):
+        """Returns the minimum number of minutes between polls of a repo's open
+        pull requests while the webhook receiver is enabled.
+        """
+        return int(self.property_get("POLLFREQ", 60))
+
+    @property
+    def cachefile(self):
+        """Returns the full path to the file that caches github API responses."""
+        return self.property_get("CACHEFILE", "~/.ci.cache.json")
+
+    @property
+    def cachettl(self):
+        """Returns the number of minutes that cached github metadata (repo and
+        owner details) is used without asking github whether it changed.
+        """
+        return int(self.property_get("CACHETTL", 60))
+
+    @property
+    def repocache(self):
+        """Returns the full path to the file with the github repositories that
+        the installed repo names were resolved to.
+        """
+        return self.property_get("REPOCACHE", "~/.ci.repos.json")
+
+    @property
+    def assetdir(self):
+        """Returns the full path to the content-addressed store of static files
+        that are materialized in the staging directories.
+        """
+        return self.property_get("ASSETDIR", "~/.ci.assets")
+
+    @property
+    def artifactdir(self):
+        """Returns the full path to the cache of build products listed in the
+        repos' <cache> tags.
+        """
+        return self.property_get("ARTIFACTDIR", "~/.ci.artifacts")
+
+    @property
+    def artifactsize(self):
+        """Returns the disk budget (ARTIFACTSIZE in MB, 10 GB by default) of the
+        cache of build products in bytes.
+        """
+        return int(self.property_get("ARTIFACTSIZE", 10240))*1024*1024
+
+    @property
+    def resultdir(self):
+        """Returns the full path to the cache of test command results."""
+        return self.property_get("RESULTDIR", "~/.ci.results")
+
+    @property
+    def resultsize(self):
+        """Returns the disk budget (RESULTSIZE in MB, 1 GB by default) of the
+        cache of test command results in bytes.
+        """
+        return int(self.property_get("RESULTSIZE", 1024))*1024*1024
+
+    @property
+    def compactfreq(self):
+        """Returns the number of hours between automatic compactions of the
+        archive when the server runs as a daemon.
+        """
+        return int(self.property_get("COMPACTFREQ", 24))
+
     def property_get(self, key, default=None):
         if key in self._vardict:
             return self._vardict[key]
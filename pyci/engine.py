@@ -0,0 +1,323 @@
+"""Runs the unit test commands as direct child processes of the CI server. A
+single thread launches the commands with their working directory and
+environment set and multiplexes their output pipes with select(), so no extra
+python interpreter has to be forked for each command. Each command leads its
+own process group so that it can be cancelled together with everything it
+spawned. The output streams through an OutputStore that bounds how much of it
+is kept.
+"""
+from pyci.msg import vms
+
+_shim = "import os, sys; os.setsid(); os.execv(sys.argv[1], sys.argv[1:])"
+"""Python source that starts a new session and replaces itself with the shell
+when the 'setsid' program isn't available.
+"""
+
+def _session_args(command):
+    """Returns the argument list that runs the shell command as the leader of a
+    new session (and thus of a new process group). The session is started by an
+    exec'd wrapper rather than a preexec_fn, which isn't safe to use from a
+    process with several threads.
+    """
+    import sys
+    from distutils.spawn import find_executable
+    shell = ["/bin/bash", "-c", command]
+    setsid = find_executable("setsid")
+    if setsid is not None:
+        #The forked child isn't a process group leader, so setsid() succeeds
+        #in place and the command keeps the PID that Popen reports.
+        return [setsid] + shell
+    else:
+        return [sys.executable, "-c", _shim] + shell
+
+class OutputStore(object):
+    """Bounded store for the combined stdout/stderr of a command. The first
+    'head' bytes are streamed to disk as they arrive and the last 'tail' bytes
+    are kept in memory until the command exits; everything in between is only
+    counted. Disk usage per command is therefore at most head + tail bytes.
+    """
+    def __init__(self, filepath, head=None, tail=None, compress=False):
+        """
+        :arg filepath: the full path to the output file. When 'compress' is true,
+          '.gz' is appended to it.
+        :arg head: the number of bytes to keep from the start of the output. If
+          None, the output is not bounded at all.
+        :arg tail: the number of bytes to keep from the end of the output.
+        :arg compress: when true, the file is gzip-compressed on the fly.
+        """
+        from threading import Lock
+        from collections import deque
+        self.filepath = filepath + (".gz" if compress else "")
+        """The full path to the file with the retained output."""
+        self.head = head
+        """The number of bytes kept from the start of the output, or None."""
+        self.tail = tail or 0
+        """The number of bytes kept from the end of the output."""
+        self.compress = compress
+        """True if the output file is gzip-compressed."""
+        self.total = 0
+        """The total number of bytes that the command has written so far."""
+        self.window = max(self.tail, 65536)
+        """The number of bytes from the end of the output kept in memory so that
+        the live tail can be read while the command runs.
+        """
+        self._headsize = 0
+        self._headchunks = []
+        self._tailsize = 0
+        self._tailchunks = deque()
+        self._lock = Lock()
+        if compress:
+            import gzip
+            self._handle = gzip.open(self.filepath, 'wb')
+        else:
+            self._handle = open(self.filepath, 'wb')
+
+    @property
+    def omitted(self):
+        """Returns the number of bytes that were dropped from the middle."""
+        if self.head is None:
+            return 0
+        with self._lock:
+            return max(0, self.total - self._headsize - min(self.tail, self._tailsize))
+
+    def write(self, data):
+        """Adds a chunk of output from the command."""
+        with self._lock:
+            self.total += len(data)
+            if self.head is None:
+                self._handle.write(data)
+                self._keep(data)
+                return
+
+            if self._headsize < self.head:
+                part = data[:self.head - self._headsize]
+                self._handle.write(part)
+                self._headchunks.append(part)
+                self._headsize += len(part)
+                data = data[len(part):]
+            if len(data) > 0:
+                self._keep(data)
+
+    def _keep(self, data):
+        """Appends the data to the in-memory tail, dropping the oldest chunks
+        that aren't needed to hold the last 'window' bytes.
+        """
+        self._tailchunks.append(data)
+        self._tailsize += len(data)
+        while (len(self._tailchunks) > 1 and
+               self._tailsize - len(self._tailchunks[0]) >= self.window):
+            self._tailsize -= len(self._tailchunks.popleft())
+
+    def read_tail(self, size=4096):
+        """Returns the last 'size' bytes of output received so far. This can be
+        called from another thread while the command is still running. Once bytes
+        were dropped from the middle, only the in-memory tail is returned so that
+        the end of the head isn't joined to it as if it were contiguous.
+        """
+        with self._lock:
+            chunks = list(self._tailchunks)
+            if (self.head is not None and
+                self.total == self._headsize + self._tailsize):
+                #Nothing was dropped yet, so the head leads straight into the tail.
+                chunks = self._headchunks + chunks
+            result = []
+            count = 0
+            for chunk in reversed(chunks):
+                if count >= size:
+                    break
+                result.insert(0, chunk)
+                count += len(chunk)
+            return ''.join(result)[-size:] if size > 0 else ''
+
+    def close(self):
+        """Writes the retained tail (after a marker for the omitted bytes) and
+        closes the file.
+        """
+        with self._lock:
+            if self.head is not None:
+                tail = ''.join(self._tailchunks)
+                if len(tail) > self.tail:
+                    tail = tail[len(tail) - self.tail:]
+                omitted = self.total - self._headsize - len(tail)
+                if omitted > 0:
+                    self._handle.write("\n\n... [{} bytes omitted] ...\n\n".format(omitted))
+                self._handle.write(tail)
+            self._handle.close()
+
+class Command(object):
+    """A single shell command run by the Engine; holds its process, timing and
+    exit code.
+    """
+    def __init__(self, index, command, cwd, output, env=None, head=None, tail=None,
+                 compress=False):
+        """
+        :arg index: the index of the command in the repo's list of tests.
+        :arg command: the shell command to execute.
+        :arg cwd: the full path to the directory to run the command in.
+        :arg output: the full path to the file that the output is written to.
+        :arg env: a dictionary of environment variables for the command. If
+          None, the CI server's environment is inherited.
+        :arg head: the number of bytes of output to keep from the start; see
+          OutputStore. If None, all the output is kept.
+        :arg tail: the number of bytes of output to keep from the end.
+        :arg compress: when true, the output file is gzip-compressed.
+        """
+        self.index = index
+        """The index of the command in the repo's list of tests."""
+        self.command = command
+        """The shell command to execute."""
+        self.cwd = cwd
+        """The full path to the directory that the command runs in."""
+        self.output = output + (".gz" if compress else "")
+        """The full path to the file that the output of the command is written to;
+        '.gz' is appended when the output is compressed.
+        """
+        self._filepath = output
+        self.limits = (head, tail, compress)
+        """Tuple of the head and tail sizes and the compression flag for the
+        command's OutputStore.
+        """
+        self.store = None
+        """The OutputStore with the combined stdout and stderr of the command."""
+        self.env = env
+        """Dictionary of environment variables for the command, or None."""
+        self.process = None
+        """The subprocess.Popen instance once the command is launched."""
+        self.start = None
+        """The datetime at which the command was launched."""
+        self.end = None
+        """The datetime at which the command exited."""
+        self.code = None
+        """The exit code of the command; negative if it was killed by a signal."""
+        self.eof = False
+        """True once the command's output pipe has been closed."""
+
+    @property
+    def fd(self):
+        """Returns the file descriptor of the command's output pipe."""
+        return self.process.stdout.fileno()
+
+    @property
+    def bytes(self):
+        """Returns the total number of bytes the command has written so far."""
+        return self.store.total if self.store is not None else 0
+
+    def tail(self, size=4096):
+        """Returns the last 'size' bytes of the command's output; safe to call
+        from other threads while the command runs.
+        """
+        return self.store.read_tail(size) if self.store is not None else ''
+
+    def launch(self):
+        """Starts the command in a new process group with its stdout and stderr
+        piped back to the CI server.
+        """
+        from subprocess import Popen, PIPE, STDOUT
+        from os import devnull
+        from datetime import datetime
+        head, tail, compress = self.limits
+        self.store = OutputStore(self._filepath, head, tail, compress)
+        #The commands don't get the CI server's stdin; bash also sources ~/.bashrc
+        #for non-interactive shells whose stdin is a network socket.
+        with open(devnull) as stdin:
+            self.process = Popen(_session_args(self.command), cwd=self.cwd, env=self.env,
+                                 stdin=stdin, stdout=PIPE, stderr=STDOUT, close_fds=True)
+        self._await_session()
+        self.start = datetime.now()
+        vms("Launched test command #{} with PID {}.".format(self.index, self.process.pid), 2)
+
+    def _await_session(self, timeout=5.):
+        """Waits until the wrapper has made the command the leader of its own
+        process group so that kill() reaches everything that it spawns.
+        """
+        from os import getpgid
+        from time import time, sleep
+        deadline = time() + timeout
+        while time() < deadline and self.process.poll() is None:
+            try:
+                if getpgid(self.process.pid) == self.process.pid:
+                    break
+            except OSError:
+                break
+            sleep(0.001)
+
+    def read(self):
+        """Reads the output that is waiting on the pipe. Returns False once the
+        pipe has been closed by the command.
+        """
+        from os import read
+        data = read(self.fd, 65536)
+        if len(data) == 0:
+            self.eof = True
+            return False
+        self.store.write(data)
+        return True
+
+    def finish(self, code, timeout=1.):
+        """Collects the output that is still buffered in the pipe and records the
+        exit code of the command.
+
+        :arg timeout: the maximum number of seconds spent draining the pipe. A
+          process spawned by the command can keep writing to it after the
+          command exited; whatever it writes afterwards is discarded.
+        """
+        from select import select
+        from datetime import datetime
+        from time import time
+        self.end = datetime.now()
+        self.code = code
+        deadline = time() + timeout
+        while (not self.eof and time() < deadline and
+               len(select([self.fd], [], [], 0)[0]) > 0):
+            self.read()
+        self.process.stdout.close()
+        self.store.close()
+
+    def kill(self, signum=None):
+        """Sends the signal (SIGTERM by default) to the command's process group."""
+        from utility import kill_group
+        return kill_group(self.process.pid, signum)
+
+class Engine(object):
+    """Launches commands and waits on all of them from the calling thread."""
+    def __init__(self):
+        self.running = []
+        """The list of Command instances that have been launched but haven't
+        exited yet.
+        """
+
+    def launch(self, command):
+        """Launches the Command instance and starts tracking its output."""
+        command.launch()
+        self.running.append(command)
+
+    def poll(self, timeout):
+        """Copies the output of the running commands to their files for up to
+        'timeout' seconds. Returns the list of commands that exited.
+        """
+        from select import select, error
+        from time import sleep
+        from errno import EINTR
+        pipes = dict((c.fd, c) for c in self.running if not c.eof)
+        if len(pipes) > 0:
+            try:
+                ready = select(list(pipes), [], [], timeout)[0]
+            except error as e:
+                #A signal (e.g. SIGTERM to the daemon) interrupted the wait.
+                if e.args[0] != EINTR:
+                    raise
+                ready = []
+            for fd in ready:
+                pipes[fd].read()
+        elif timeout > 0:
+            #The remaining commands closed their output but haven't exited yet.
+            sleep(min(timeout, 0.1) if len(self.running) > 0 else timeout)
+
+        finished = []
+        for command in list(self.running):
+            code = command.process.poll()
+            if code is not None:
+                command.finish(code)
+                self.running.remove(command)
+                finished.append(command)
+        return finished
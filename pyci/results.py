@@ -0,0 +1,86 @@
+"""Cache of test command results for repos whose <testing> tag sets
+cache="true". A result is keyed by the git tree that the command ran on (plus
+the static files staged next to it), the expanded command text and the values
+of the environment variables the repo declares as relevant. A pull request
+that is reopened, rebased without changes or re-targeted gets the results of
+its unchanged commands from the cache instead of running them again.
+"""
+from artifacts import ArtifactCache
+from pyci.msg import vms
+
+class ResultCache(ArtifactCache):
+    """An ArtifactCache whose entries hold the output of a single test command;
+    the index also records the exit code and the number of bytes written.
+    """
+    def command_key(self, state, command, env):
+        """Returns the cache key for the result of a test command.
+
+        :arg state: a string identifying the contents of the staging directory,
+          usually the git tree SHA and the digest of the static files.
+        :arg command: the test command after all the variables were replaced.
+        :arg env: a dictionary of the relevant environment variables.
+        """
+        from hashlib import sha1
+        digest = sha1()
+        digest.update("{}\n{}\n".format(state, command))
+        for name in sorted(env):
+            digest.update("{}={}\n".format(name, env[name]))
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """Returns a copy of the index entry of the cached result, or None if the
+        command hasn't run on the same tree yet.
+        """
+        from time import time
+        with self.lock:
+            if key not in self.index:
+                return None
+            self.index[key]["used"] = time()
+            self._save()
+            return dict(self.index[key])
+
+    def copy_output(self, key, target):
+        """Copies the cached output of the command to the target path (without
+        extension); returns the full path to the copy, which ends in '.gz' if the
+        output was compressed.
+        """
+        from os import path
+        from shutil import copyfile
+        with self.lock:
+            entry = self.index[key]
+            source = path.join(self.entrypath(key), entry["filename"])
+            target = target + path.splitext(entry["filename"])[1]
+            copyfile(source, target)
+            return target
+
+    def record(self, key, code, output, nbytes, reponame=None, command=None):
+        """Saves the result of a command that ran to completion.
+
+        :arg code: the exit code of the command.
+        :arg output: the full path to the file with the command's output.
+        :arg nbytes: the total number of bytes that the command wrote.
+        """
+        from os import path, makedirs, rename
+        from shutil import copyfile, rmtree
+        from time import time
+        from tempfile import mkdtemp
+        with self.lock:
+            if key in self.index or not path.isfile(output):
+                return
+        vms("Caching the result of '{}' as {}.".format(command, key[0:7]), 2)
+        filename = "output" + (".gz" if output.endswith(".gz") else "")
+        temp = path.join(mkdtemp(dir=self.folder, suffix=".tmp"), "entry")
+        makedirs(temp)
+        copyfile(output, path.join(temp, filename))
+        with self.lock:
+            if key in self.index:
+                rmtree(path.dirname(temp))
+                return
+            rename(temp, self.entrypath(key))
+            rmtree(path.dirname(temp))
+            self.index[key] = {"size": path.getsize(path.join(self.entrypath(key), filename)),
+                               "used": time(), "repo": reponame, "path": None,
+                               "command": command, "code": code, "bytes": nbytes,
+                               "filename": filename}
+            self._evict()
+            self._save()
@@ -14,6 +14,10 @@ datapath = None
 """The full path to the data file to which 'db' is serialized."""
 args = None
 """The dictionary of arguments passed to the script."""
+stopping = False
+"""Set to True by the signal handlers when the daemon should shut down cleanly."""
+reloading = False
+"""Set to True by the SIGHUP handler when the daemon should re-read its settings."""
 
 def examples():
     """Prints examples of using the script to the console using colored output.
@@ -50,7 +54,19 @@ def examples():
                   "See also -uninstall.")),
                 (("Run the routines that check for new pull requests, run the unit tests, and post "
                   "the results to the media wiki."),
-                 "ci.py -cron", "")]
+                 "ci.py -cron", ""),
+                (("Run the CI server as a long-running daemon that keeps the repository settings "
+                  "in memory and checks each repository at its configured cron frequency."),
+                 "ci.py -daemon",
+                 ("Only a single daemon can run at a time; the 'PIDFILE' variable in 'global.xml' "
+                  "(default ~/.ci.pid) guards against duplicates. Send SIGTERM or SIGINT to stop "
+                  "it cleanly and SIGHUP to force a reload of the settings. While the daemon runs, "
+                  "-cron requests exit without doing anything.")),
+                (("Collapse the archive entries of closed pull requests into summaries, delete "
+                  "their staging directories and outputs and enforce the 'keep' and 'maxage' "
+                  "limits of each repo's <cron> tag."),
+                 "ci.py -compact",
+                 ("The daemon does this automatically every 'COMPACTFREQ' hours (24 by default)."))]
     required = ("REQUIRED:\n\t-'repo.xml' file for *each* repository that gets installed on the server.\n"
                 "\t-'global.xml' file with configuration settings for *all* repositories.\n"
                 "\t- git user and API key with push access for *each* repository installed.")
@@ -86,6 +102,12 @@ def _parser_options():
     parser.add_argument("-cron", action="store_true",
                         help=("Run the continuous integration routines for all the repos installed "
                               "in this script's database."))
+    parser.add_argument("-daemon", action="store_true",
+                        help=("Run the continuous integration routines in a long-running process "
+                              "that schedules each repo according to its cron frequency."))
+    parser.add_argument("-compact", action="store_true",
+                        help=("Collapse the archive entries of closed pull requests, delete their "
+                              "staging directories and enforce the archive retention limits."))
     parser.add_argument("-list", action="store_true",
                         help="List all the repositories in the CI server's database.")
     parser.add_argument("-install", nargs="+",
@@ -264,7 +286,7 @@ def _server_rollback():
     from os import path, remove
     archpath = path.abspath(path.expanduser(settings.archfile))
     if path.isfile(archpath) and not args["nolive"]:
-        vms("Removing archive JSON file at {}.".format(archpath))
+        vms("Removing archive file at {}.".format(archpath))
         remove(archpath)
     datapath = path.abspath(path.expanduser(settings.datafile))
     if path.isfile(datapath) and not args["nolive"]:
@@ -288,9 +310,12 @@ def _server_enable():
     if prev != db["enabled"]:
         _save_db()        
 
-def _find_next(server):
+def _find_next(server, exclude=None):
     """Finds the name of the next repository to run based on the *current*
     state of the database.
+
+    :arg exclude: a list of repo names that should not be returned because they
+      are already scheduled to run.
     """
     from datetime import datetime
     #Re-load the database in case we have multiple instances of the script
@@ -301,6 +326,9 @@ def _find_next(server):
     
     if "status" in db:
         for reponame, status in db["status"].items():
+            if exclude is not None and reponame in exclude:
+                visited.append(reponame)
+                continue
             vms("Checking cron status for {}: {}".format(reponame, status))
             start = None if "started" not in status else status["started"]
             end = None if "end" not in status else status["end"]
@@ -339,7 +367,8 @@ def _find_next(server):
 
 def _do_cron():
     """Handles the cron request to github to check for new pull requests. If
-    any are found, they are run *sequentially* until they are all completed.
+    any are found, the pull requests of all the due repos are processed by the
+    server's worker pool until they are all completed.
     """
     if not args["cron"]:
         return
@@ -364,35 +393,331 @@ def _do_cron():
     #We use the repo full names as keys in the db's status dictionary.
     from pyci.server import Server
     from datetime import datetime
-    attempted = []
+    if _daemon_pid() is not None:
+        vms("A CI server daemon is already processing the repositories. Exiting.")
+        return
+    
     server = Server(testmode=args["nolive"])
+    #All the repos that are due are processed together so that the server's
+    #worker pool can test their pull requests at the same time.
+    due = []
     nextrepo = _find_next(server)
-    dbs = db["status"]
-    
     while nextrepo is not None:
         vms("Working on '{}' in cron.".format(nextrepo))
-        if nextrepo in attempted:
-            #This makes sure we don't end up in an infinite loop.
-            vms("'{}' has already been handled! Exiting infinite loop.".format(nextrepo))
-            break
-        
+        dbs = db["status"]
         if nextrepo not in dbs:
             vms("Created blank status dictionary for '{}' in db.".format(nextrepo))
             dbs[nextrepo] = {"start": None, "end": None}
         dbs[nextrepo]["start"] = datetime.now()
+        #Save our intent to run these repo-checks before finding the next one;
+        #_find_next() re-loads the db from disk.
         _save_db()
+        due.append(nextrepo)
+        nextrepo = _find_next(server, due)
 
-        #Now that we have saved our intent to run these repo-checks, let's
-        #actually run them.
-        attempted.append(nextrepo)
-        server.runnable = [nextrepo]
-        if not args["nolive"]:
-            vms("Starting pull request processing for '{}'.".format(nextrepo))
-            server.process_pulls()
-    
-        dbs[nextrepo]["end"] = datetime.now()
-        _save_db()
-        nextrepo = _find_next(server)
+    if len(due) == 0:
+        return
+
+    server.runnable = due
+    if not args["nolive"]:
+        vms("Starting pull request processing for {}.".format(', '.join(due)))
+        server.process_pulls()
+        #The repos still count as running while their snapshots are refreshed, so
+        #the next cron call doesn't pick them up.
+        server.prewarm(due)
+
+    #_find_next() replaced the db when it re-loaded it from disk.
+    for reponame in due:
+        db["status"][reponame]["end"] = datetime.now()
+    _save_db()
+
+def _daemon_pid():
+    """Returns the process id of the running CI server daemon, or None if no
+    daemon is running. Stale PID files are ignored.
+    """
+    from os import path, kill
+    pidpath = path.abspath(path.expanduser(settings.pidfile))
+    if not path.isfile(pidpath):
+        return None
+
+    try:
+        with open(pidpath) as f:
+            pid = int(f.read().strip())
+        #Signal 0 does nothing to the process, but raises an OSError if it
+        #doesn't exist anymore.
+        kill(pid, 0)
+    except (IOError, ValueError, OSError):
+        return None
+    return pid
+
+def _acquire_pidfile():
+    """Creates the PID file for this daemon process. Returns False if another
+    daemon is already running.
+    """
+    import os
+    pidpath = os.path.abspath(os.path.expanduser(settings.pidfile))
+    pid = _daemon_pid()
+    if pid is not None:
+        err("A CI server daemon is already running with PID {}.".format(pid))
+        return False
+    if os.path.isfile(pidpath):
+        vms("Removing stale PID file at {}.".format(pidpath))
+        os.remove(pidpath)
+
+    #O_EXCL makes the creation atomic in case two daemons start at the same time.
+    try:
+        fd = os.open(pidpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except OSError:
+        err("Unable to create the PID file at {}.".format(pidpath))
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+def _release_pidfile():
+    """Removes the PID file if it belongs to this process."""
+    import os
+    pidpath = os.path.abspath(os.path.expanduser(settings.pidfile))
+    if _daemon_pid() == os.getpid():
+        os.remove(pidpath)
+
+def _handle_signal(signum, frame):
+    """Signal handler for the daemon; SIGHUP requests a reload of the settings,
+    all other signals request a clean shutdown after the current repo finishes.
+    """
+    import signal
+    global stopping, reloading
+    if signum == signal.SIGHUP:
+        reloading = True
+    else:
+        stopping = True
+
+def _next_due(server, now, minfreq=0, exclude=None):
+    """Returns a tuple of the name of the next repo whose cron frequency has
+    elapsed (or None) and the number of seconds until the next repo is due.
+
+    :arg minfreq: the minimum number of minutes between checks of a repo,
+      regardless of its configured cron frequency.
+    :arg exclude: a list of repo names that are already scheduled to run.
+    """
+    from pyci.config import CronSettings
+    dbs = db.setdefault("status", {})
+    wait = None
+    for reponame in server.repositories:
+        if exclude is not None and reponame in exclude:
+            continue
+        #The cron settings are keyed by the repo's full name as written in its XML
+        #file, while the repositories are keyed by the lowered name.
+        cron = server.cron.settings.get(server.repositories[reponame].name, CronSettings())
+        if reponame not in dbs or dbs[reponame]["end"] is None:
+            return (reponame, 0)
+
+        elapsed = (now - dbs[reponame]["end"]).total_seconds()
+        remaining = max(cron.frequency, minfreq)*60 - elapsed
+        if remaining <= 0:
+            return (reponame, 0)
+        if wait is None or remaining < wait:
+            wait = remaining
+
+    return (None, wait)
+
+def _idle(seconds, hooks=None):
+    """Waits for the specified number of seconds, returning early if a signal
+    stops the daemon or a webhook event queues a pull request.
+    """
+    from time import sleep, time
+    until = time() + seconds
+    while not stopping and time() < until:
+        if hooks is None:
+            sleep(until - time())
+        elif hooks.queue.wait(min(1, until - time())):
+            break
+
+def _prewarm(server, worker=None):
+    """Refreshes the warm snapshots of the repos in a background thread unless the
+    previous refresh is still running. Returns the thread doing the refresh.
+    """
+    from threading import Thread
+    if worker is not None and worker.is_alive():
+        return worker
+    worker = Thread(target=server.prewarm, name="pyci-prewarm")
+    worker.daemon = True
+    worker.start()
+    return worker
+
+def _stop_prewarm(server, worker, grace=10):
+    """Terminates the <prepare> commands of the snapshot refresh that is still
+    running and waits for the thread doing it, so that no children are left
+    behind when the daemon exits. Commands that ignore SIGTERM for 'grace'
+    seconds are killed.
+    """
+    from signal import SIGKILL
+    vms("Stopping the prewarming of the repo snapshots.")
+    server.stop()
+    worker.join(grace)
+    if worker.is_alive():
+        server.stop(SIGKILL)
+        worker.join(grace)
+
+def _start_webhook(server):
+    """Starts the webhook receiver in a background thread if a port is
+    configured in the global settings. Returns the WebhookServer or None.
+    """
+    if settings.webhook is None:
+        return None
+
+    from pyci.webhook import WebhookServer
+    if settings.webhook_secret is None:
+        if settings.webhook_insecure:
+            warn("No WEBHOOKSECRET configured; webhook payloads will not be verified.")
+        else:
+            warn("No WEBHOOKSECRET configured; all webhook payloads will be rejected. "
+                 "Set WEBHOOKINSECURE to 'true' to accept unsigned payloads.")
+    hooks = WebhookServer(server, ("", settings.webhook), settings.webhook_secret,
+                          settings.webhook_insecure)
+    hooks.start()
+    return hooks
+
+def _daemon_cycle(server, hooks, minfreq, maxsleep, warmer=None):
+    """Performs a single pass of the daemon's loop: reloads changed settings,
+    processes pull requests queued by webhooks or due by cron frequency and
+    otherwise idles. Returns the thread that refreshes the repo snapshots.
+    """
+    from datetime import datetime
+    global reloading
+    if reloading:
+        server._mtimes = None
+        reloading = False
+    server.reload()
+    #Another process may have enabled/disabled the server or updated the
+    #status of the repos; the db is small, so re-reading it is cheap.
+    _load_db()
+    enabled = "enabled" not in db or db["enabled"]
+    if hooks is not None and enabled:
+        queued = hooks.queue.drain()
+        if len(queued) > 0:
+            vms("Processing pull requests queued by webhooks: {}".format(queued))
+            server.runnable = None
+            if not args["nolive"]:
+                server.process_pulls(numbers=queued)
+            return warmer
+
+    compacted = db.get("compacted")
+    if (enabled and not args["nolive"] and
+        (compacted is None or
+         (datetime.now() - compacted).total_seconds() > settings.compactfreq*3600)):
+        vms("Compacted {} archive entries.".format(_compact(server)))
+
+    if not enabled:
+        nextrepo, wait = None, maxsleep
+    else:
+        nextrepo, wait = _next_due(server, datetime.now(), minfreq)
+
+    if nextrepo is None:
+        if enabled and not args["nolive"]:
+            warmer = _prewarm(server, warmer)
+        _idle(min(maxsleep, wait) if wait is not None else maxsleep, hooks)
+        return warmer
+
+    #Every repo that is due runs in the same pass so that the worker pool
+    #can process their pull requests at the same time.
+    due = []
+    now = datetime.now()
+    while nextrepo is not None:
+        due.append(nextrepo)
+        nextrepo, wait = _next_due(server, now, minfreq, due)
+
+    vms("Working on {} in daemon.".format(', '.join(due)))
+    dbs = db["status"]
+    for reponame in due:
+        if reponame not in dbs:
+            dbs[reponame] = {"start": None, "end": None}
+        dbs[reponame]["start"] = datetime.now()
+    _save_db()
+
+    server.runnable = due
+    if not args["nolive"]:
+        server.process_pulls()
+    for reponame in due:
+        dbs[reponame]["end"] = datetime.now()
+    _save_db()
+    return warmer
+
+def _daemon_loop(server, hooks, minfreq, maxsleep=60):
+    """Runs passes of the daemon's loop until a signal stops the daemon. Errors
+    in a pass (e.g. bad XML while a repo file is being edited or a github
+    outage) are reported and the pass is retried after 'maxsleep' seconds, so
+    that they don't take down the daemon and its webhook listener.
+
+    :arg maxsleep: even when nothing is due, we wake up at least this often (in
+      seconds) to check whether the settings files changed.
+    """
+    from traceback import format_exc
+    warmer = None
+    try:
+        while not stopping:
+            try:
+                warmer = _daemon_cycle(server, hooks, minfreq, maxsleep, warmer)
+            except Exception as e:
+                err("Daemon pass failed; retrying in {} seconds: {}".format(maxsleep, e))
+                vms(format_exc())
+                _idle(maxsleep, hooks)
+    finally:
+        if warmer is not None and warmer.is_alive():
+            _stop_prewarm(server, warmer)
+
+def _do_daemon():
+    """Runs the CI server as a single long-running process. The repo settings,
+    archive and wiki connection stay in memory between checks; configuration is
+    only re-read when the files change on disk.
+    """
+    if not args["daemon"]:
+        return
+
+    import signal
+    from os import getpid
+    from pyci.server import Server
+    if not _acquire_pidfile():
+        exit(1)
+    for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(signum, _handle_signal)
+
+    hooks = None
+    try:
+        server = Server(testmode=args["nolive"])
+        #When github pushes the pull request events to us, polling each repo's
+        #open pull requests becomes a low-frequency fallback.
+        hooks = _start_webhook(server)
+        minfreq = 0 if hooks is None else settings.pollfreq
+        okay("CI server daemon started with PID {}.".format(getpid()))
+        _daemon_loop(server, hooks, minfreq)
+    finally:
+        if hooks is not None:
+            hooks.shutdown()
+        _release_pidfile()
+    okay("CI server daemon stopped cleanly.")
+
+def _compact(server):
+    """Compacts the server's archive and records the time in the db."""
+    from datetime import datetime
+    count = server.compact()
+    db["compacted"] = datetime.now()
+    _save_db()
+    return count
+
+def _do_compact():
+    """Handles the request to compact the archive of processed pull requests.
+    """
+    if not args["compact"]:
+        return
+
+    from pyci.server import Server
+    server = Server(testmode=args["nolive"])
+    if args["nolive"]:
+        vms("Skipping archive compaction because 'nolive' enabled.")
+        return
+    count = _compact(server)
+    okay("Compacted or removed {} archive entries.".format(count))
 
 def _fmt_time(time):
     """Returns the formatted time if it is not None."""
@@ -465,9 +790,11 @@ def run():
     _server_enable()    
     _list_repos()
     _handle_install()
+    _do_compact()
     
     #This is the workhorse once a successful installation has happened.
     _do_cron()
+    _do_daemon()
         
 if __name__ == "__main__":
     run()
@@ -1,5 +1,5 @@
 from config import RepositorySettings, GlobalSettings
-from pyci.msg import warn, err
+from pyci.msg import warn, err, vms
 
 class Server(object):
     """Represents the continuous integration server for automatically unit testing
@@ -34,10 +34,27 @@ class Server(object):
         from previous runs of the CI server.
         """
         
+        self._store = None
+        """Lazy initialization for the self.store property."""
+        self._assets = None
+        """Lazy initialization for the self.assets property."""
+        self._artifacts = None
+        """Lazy initialization for the self.artifacts property."""
+        self._results = None
+        """Lazy initialization for the self.results property."""
+        from threading import RLock
+        self.lock = RLock()
+        """Serializes changes to the archive between the workers that process
+        pull requests at the same time.
+        """
         self.installed = self._get_installed()
         """A list of file paths to repo XML settings files for repos that need to
         be monitored.
         """
+        self.slots = SlotPool(self.settings.slots)
+        """The SlotPool shared by the test commands of all the pull requests that
+        are processed at the same time.
+        """
         self.cron = CronManager(self)
         """An instance of CronManager to handle the automation timing and events
         including the email notifications.
@@ -57,6 +74,77 @@ class Server(object):
         """A list of repository names that have been authorized to run by the
         calling script. If None, the constraint is not applied.
         """
+        self.mirrors = {}
+        """Dictionary of vcs.Mirror instances keyed by the full path to the
+        repo's bare mirror.
+        """
+        self.snapshots = {}
+        """Dictionary of the repos' warm Snapshot instances keyed by the full path
+        to their folders.
+        """
+        self.cycle = 0
+        """The number of the current processing cycle; the repo mirrors are only
+        fetched once per cycle.
+        """
+        self.active = {}
+        """Dictionary of (lowered repo name, pull request number as a string) keys
+        and the PullRequest instances that workers are processing right now.
+        """
+        self.preparing = []
+        """The list of engine.Command instances for the <prepare> commands that
+        are running right now.
+        """
+        self.stopping = False
+        """True once stop() was called; no more <prepare> commands are started."""
+        self._mtimes = self._config_mtimes()
+        """Dictionary of file paths and their modification times for the
+        configuration files that were read when the server was last (re)loaded.
+        """
+
+    @property
+    def store(self):
+        """Returns the archive store (JSON or SQLite, depending on the extension
+        of the archive file) for the current archive path.
+        """
+        if self._store is None or self._store.filepath != self.archpath:
+            from archive import get_store
+            self._store = get_store(self.archpath)
+        return self._store
+
+    @property
+    def assets(self):
+        """Returns the assets.AssetStore that the static files of the repos are
+        materialized from.
+        """
+        from assets import AssetStore
+        with self.lock:
+            if self._assets is None:
+                self._assets = AssetStore(self.settings.assetdir)
+            return self._assets
+
+    @property
+    def artifacts(self):
+        """Returns the artifacts.ArtifactCache with the cached build products of
+        the repos.
+        """
+        from artifacts import ArtifactCache
+        with self.lock:
+            if self._artifacts is None:
+                self._artifacts = ArtifactCache(self.settings.artifactdir,
+                                                self.settings.artifactsize)
+            return self._artifacts
+
+    @property
+    def results(self):
+        """Returns the results.ResultCache with the cached results of the test
+        commands of repos that enable it.
+        """
+        from results import ResultCache
+        with self.lock:
+            if self._results is None:
+                self._results = ResultCache(self.settings.resultdir,
+                                            self.settings.resultsize)
+            return self._results
 
     @property
     def dirname(self):
@@ -65,6 +153,47 @@ class Server(object):
         from os import path
         return path.abspath(path.dirname(__file__))
 
+    def _config_mtimes(self):
+        """Returns a dictionary of modification times for the global settings file,
+        the data file listing installed repos and each installed repo's XML file.
+        """
+        from os import path
+        files = [self.instpath] + list(self.installed)
+        if self.settings.implicit_XML is not None:
+            files.append(path.abspath(path.expanduser(self.settings.implicit_XML)))
+
+        result = {}
+        for filepath in files:
+            result[filepath] = path.getmtime(filepath) if path.isfile(filepath) else None
+        return result
+
+    def reload(self):
+        """Re-reads the global settings, the list of installed repositories and
+        their XML settings files if any of them changed on disk since they were
+        last read. Returns True if a reload was necessary.
+        """
+        mtimes = self._config_mtimes()
+        if mtimes == self._mtimes:
+            return False
+        #The data file also holds the script's database, which changes every time
+        #a repo is checked. Only reload if the list of installed repos changed.
+        changed = [f for f in mtimes if self._mtimes is None or mtimes[f] != self._mtimes.get(f)]
+        if changed == [self.instpath] and self._get_installed() == self.installed:
+            self._mtimes = mtimes
+            return False
+
+        vms("Configuration files changed on disk; reloading server settings.")
+        self.settings = GlobalSettings()
+        self.installed = self._get_installed()
+        self.slots.capacity = self.settings.slots
+        self.cron.settings = {}
+        self.repositories = self._get_repos()
+        #Repositories may have been (un)installed by another process; they save the
+        #archive before updating the list of installed repos.
+        self.archive = self._get_archive()
+        self._mtimes = self._config_mtimes()
+        return True
+
     def _get_fields(self, event, pull, message=None):
         """Constructs a dictionary of fields and replacement values based on the
         specified event and the status of the pull request.
@@ -80,91 +209,369 @@ class Server(object):
             
         return result
     
-    def process_pulls(self, testpulls=None, testarchive=None, expected=None):
+    def process_pulls(self, testpulls=None, testarchive=None, expected=None, numbers=None):
         """Runs self.find_pulls() *and* processes the pull requests unit tests,
-        status updates and wiki page creations.
+        status updates and wiki page creations. Up to the global MAXJOBS setting
+        pull requests are processed at the same time, but never more than the
+        'concurrency' cron setting of a repo for the same repo.
 
         :arg expected: for unit testing the output results that would be returned
           from running the tests in real time.
+        :arg numbers: a dictionary of lowered repo names and the list of pull request
+          numbers to process for each; see find_pulls().
         """
-        from datetime import datetime
-        pulls = self.find_pulls(None if testpulls is None else testpulls.values())
+        pulls = self.find_pulls(None if testpulls is None else testpulls.values(), numbers)
+        self.cycle += 1
+        queue = []
         for reponame in pulls:
-            for pull in pulls[reponame]:
+            queue.extend(self._batches(pulls[reponame]))
+        def process(pull):
+            if isinstance(pull, Batch):
+                pull.process()
+            else:
+                self._process_pull(pull, testarchive, expected)
+        self._schedule(queue, process)
+
+    def supersede(self, repokey, number, sha):
+        """Cancels the run of the pull request that is being processed if it tests
+        a different head commit than 'sha'. Returns True if a run was cancelled.
+
+        Only runs in this process can be cancelled, so stale runs are only stopped
+        when the daemon's webhook receiver gets a 'synchronize' event while the pull
+        request is tested. Polling (in the daemon or from cron) never overlaps with
+        a run; it just queues the new head to be tested after the stale run.
+        """
+        with self.lock:
+            pull = self.active.get((repokey, str(number)))
+            if pull is None or pull.sha is None or pull.sha == sha:
+                return False
+            warn("Cancelling the tests of pull request #{} at {}; it was updated to {}.".format(
+                number, pull.sha[0:7], sha[0:7]))
+            pull.cancel()
+            return True
+
+    def _batches(self, pulls):
+        """Returns the list of pull requests of a repo to schedule, with the ones
+        against the same base branch grouped into Batch instances if the repo's
+        'batch' cron setting is larger than 1.
+        """
+        if self.testmode or len(pulls) < 2:
+            return pulls
+        repo = pulls[0].repo
+        size = self.cron.settings[repo.name].batch if repo.name in self.cron.settings else 1
+        if size < 2:
+            return pulls
+
+        bases = {}
+        for pull in pulls:
+            bases.setdefault(pull.pull.base.ref, []).append(pull)
+        result = []
+        for base in sorted(bases):
+            for i in range(0, len(bases[base]), size):
+                group = bases[base][i:i+size]
+                result.append(Batch(self, repo, group) if len(group) > 1 else group[0])
+        return result
+
+    def mirror(self, repo):
+        """Returns the vcs.Mirror of the repository's bare mirror; the workers
+        processing pull requests of the same repo share it.
+
+        :arg repo: the RepositorySettings instance of the repo.
+        """
+        from os import path
+        from vcs import Mirror
+        folder = path.abspath(path.expanduser(repo.mirror))
+        with self.lock:
+            if folder not in self.mirrors:
+                self.mirrors[folder] = Mirror("{}.git".format(repo.repo.html_url), folder)
+            mirror = self.mirrors[folder]
+            #The options may have changed since the settings were reloaded.
+            mirror.depth, mirror.filter, mirror.sparse = repo.depth, repo.filter, repo.sparse
+            return mirror
+
+    def snapshot(self, repo):
+        """Returns the warm Snapshot of the repository's default branch."""
+        from os import path
+        folder = "{}_warm".format(path.abspath(path.expanduser(repo.staging)))
+        with self.lock:
+            if folder not in self.snapshots:
+                self.snapshots[folder] = Snapshot(self, repo, folder)
+            self.snapshots[folder].repo = repo
+            return self.snapshots[folder]
+
+    def prewarm(self, names=None):
+        """Brings the warm snapshots of the repos up to date with their default
+        branches so that new pull requests only have to check out their own
+        changes. Meant to run between processing cycles.
+
+        :arg names: a list of lowered repo names to prewarm; if None, all of them.
+        """
+        if self.testmode:
+            return
+        for lname, repo in self.repositories.items():
+            if self.stopping:
+                break
+            if names is not None and lname not in names:
+                continue
+            try:
+                self.snapshot(repo).refresh()
+            except:
+                import sys, traceback
+                e = sys.exc_info()
+                err("Unable to prewarm '{}':\n{}".format(
+                    repo.name, ''.join(traceback.format_exception(e[0], e[1], e[2]))))
+
+    def stop(self, signum=None):
+        """Stops the <prepare> commands that are running, e.g. in the prewarming
+        thread when the daemon shuts down, by signalling their process groups
+        (SIGTERM by default). No more of them are started afterwards.
+        """
+        with self.lock:
+            self.stopping = True
+            for command in list(self.preparing):
+                command.kill(signum)
+
+    def prepare(self, repo, folder):
+        """Runs the repo's <prepare> commands one after another in the folder;
+        each one holds a slot of the server's SlotPool while it runs. Raises a
+        ValueError if one of them fails or the server is stopping.
+        """
+        from os import path, environ
+        from engine import Engine, Command
+        from vcs import GitState
+        #The output goes into the worktree's git directory so that it doesn't show
+        #up as an untracked file.
+        state = GitState(folder)
+        logdir = state.gitdir if state.valid else folder
+        env = dict(environ)
+        env["PYCI_REPO"] = repo.name
+        env["PYCI_STAGE"] = folder
+        for i, command in enumerate(repo.prepare):
+            command = self.settings.var_replace(command)
+            vms("Running prepare command '{}' in {}.".format(command, folder), 2)
+            engine = Engine()
+            result = Command(0, command, folder, path.join(logdir, "prepare.{}.log".format(i)), env)
+            self.slots.acquire(1)
+            try:
+                #The command is registered while the lock is held so that stop()
+                #can't miss it.
+                with self.lock:
+                    if self.stopping:
+                        raise ValueError("The CI server is stopping; not running '{}'.".format(command))
+                    engine.launch(result)
+                    self.preparing.append(result)
                 try:
-                    archive = self.archive[pull.repokey]
-                    if pull.snumber in archive:
-                        #We pass the archive in so that an existing staging directory (if
-                        #different from the configured one) can be cleaned up if the previous
-                        #attempt failed and left the file system dirty.
-                        pull.init(archive[pull.snumber])
-                    else:
-                        pull.init({})
-                        
-                    if self.testmode and testarchive is not None:
-                        #Hard-coded start times so that the model output is reproducible
-                        if pull.number in testarchive[pull.repokey]:
-                            start = testarchive[pull.repokey][pull.number]["start"]
+                    while len(engine.running) > 0:
+                        engine.poll(1)
+                finally:
+                    with self.lock:
+                        self.preparing.remove(result)
+            finally:
+                self.slots.release(1)
+            if result.code != 0:
+                raise ValueError("The prepare command '{}' failed with code {} in {}:\n{}".format(
+                    command, result.code, folder, result.tail(2048)))
+
+    def cache_keys(self, repo, folder):
+        """Returns a list of tuples with the cache key, the relative path and the
+        full path of each of the repo's cached folders in the staging folder.
+        """
+        from utility import get_repo_relpath
+        return [(self.artifacts.key(repo.name, c["path"], c["keys"], folder),
+                 c["path"], get_repo_relpath(folder, c["path"]))
+                for c in repo.cache]
+
+    def restore_cache(self, repo, folder):
+        """Restores the repo's cached build products whose key files match into the
+        staging folder; folders that exist already are left alone.
+        """
+        for key, relpath, target in self.cache_keys(repo, folder):
+            self.artifacts.restore(key, target)
+
+    def _concurrency(self, pull):
+        """Returns the maximum number of pull requests of the pull request's repo
+        that may be processed at the same time.
+        """
+        if pull.repo.name in self.cron.settings:
+            return max(1, self.cron.settings[pull.repo.name].concurrency)
+        else:
+            return 1
+
+    def _schedule(self, pulls, target):
+        """Calls target(pull) for each of the pull requests using a bounded pool
+        of worker threads. The work itself happens in subprocesses, so threads
+        are enough to keep all the cores busy.
+
+        :arg pulls: a list of PullRequest instances in the order they should start.
+        :arg target: the function that processes a single pull request.
+        """
+        from threading import Thread, Condition
+        workers = min(self.settings.maxjobs, len(pulls))
+        if workers <= 1:
+            for pull in pulls:
+                target(pull)
+            return
+
+        pending = list(pulls)
+        running = {}
+        condition = Condition()
+        def worker():
+            while True:
+                with condition:
+                    pull = None
+                    while pull is None:
+                        if len(pending) == 0:
+                            return
+                        #Pick the first pull request whose repo is below its limit so
+                        #that a busy repo doesn't hold up the others.
+                        for candidate in pending:
+                            if running.get(candidate.repokey, 0) < self._concurrency(candidate):
+                                pull = candidate
+                                break
                         else:
-                            start = datetime(2015, 4, 23, 13, 8)
-                    else:
-                        start = datetime.now()
-                    archive[pull.snumber] = {"success": False, "start": start,
-                                             "number": pull.number, "stage": pull.repodir,
-                                             "completed": False, "finished": None}
-                    #Once a local staging directory has been initialized, we add the sha
-                    #signature of the pull request to our archive so we can track the rest
-                    #of the testing process. If it fails when trying to merge the head of
-                    #the pull request, the exception block should catch it and email the
-                    #owner of the repo.
-                    #We need to save the state of the archive now in case the testing causes
-                    #an unhandled exception.
-                    self._save_archive()
+                            condition.wait()
+                    pending.remove(pull)
+                    running[pull.repokey] = running.get(pull.repokey, 0) + 1
+                try:
+                    target(pull)
+                finally:
+                    with condition:
+                        running[pull.repokey] -= 1
+                        condition.notify_all()
 
-                    pull.begin()
-                    self.cron.email(pull.repo.name, "start", self._get_fields("start", pull), self.testmode)
-                    pull.test(expected[pull.number])
-                    pull.finalize()
-
-                    #Update the status of this pull request on the archive, save the archive
-                    #file in case the next pull request throws an unhandled exception.
-                    archive[pull.snumber]["completed"] = True
-                    archive[pull.snumber]["success"] = abs(pull.percent - 1) < 1e-12
-
-                    #This if block looks like a mess; it is necessary so that we can easily
-                    #unit test this processing code by passing in the model outputs etc. that should
-                    #have been returned from running live.
-                    if (self.testmode and testarchive is not None and
-                        pull.number in testarchive[pull.repokey] and
-                        testarchive[pull.repokey][pull.number]["finished"] is not None):
-                        archive[pull.snumber]["finished"] = testarchive[pull.repokey][pull.number]["finished"]
-                    elif self.testmode:
-                        archive[pull.snumber]["finished"] = datetime(2015, 4, 23, 13, 9)
-                    else:
-                        #This single line could replace the whole if block if we didn't have
-                        #unit tests integrated with the main code.
-                        archive[pull.snumber]["finished"] = datetime.now()
+        vms("Processing {} pull requests with {} workers.".format(len(pulls), workers))
+        threads = [Thread(target=worker, name="pyci-worker-{}".format(i)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _process_pull(self, pull, testarchive=None, expected=None, batch=None):
+        """Initializes, tests and reports the results of a single pull request.
+        Changes to the archive are made while holding self.lock so that workers
+        processing other pull requests see a consistent archive.
+
+        :arg batch: the PullRequest that ran the tests for a Batch that this pull
+          request was part of and that passed; its results are reported instead of
+          testing the pull request on its own.
+        """
+        from datetime import datetime
+        from copy import deepcopy
+        try:
+            with self.lock:
+                archive = self.archive[pull.repokey]
+                previous = dict(archive[pull.snumber]) if pull.snumber in archive else {}
+                self.active[(pull.repokey, pull.snumber)] = pull
+            if batch is None:
+                #We pass the archive in so that an existing staging directory (if
+                #different from the configured one) can be cleaned up if the previous
+                #attempt failed and left the file system dirty.
+                pull.init(previous)
+            else:
+                pull.repodir = batch.repodir
+                pull.testing = deepcopy(batch.testing)
+                pull.timedout = batch.timedout
+
+            if self.testmode and testarchive is not None:
+                #Hard-coded start times so that the model output is reproducible
+                if pull.number in testarchive[pull.repokey]:
+                    start = testarchive[pull.repokey][pull.number]["start"]
+                else:
+                    start = datetime(2015, 4, 23, 13, 8)
+            else:
+                start = datetime.now()
+            #Once a local staging directory has been initialized, we add the sha
+            #signature of the pull request to our archive so we can track the rest
+            #of the testing process. If it fails when trying to merge the head of
+            #the pull request, the exception block should catch it and email the
+            #owner of the repo.
+            #We need to save the state of the archive now in case the testing causes
+            #an unhandled exception.
+            with self.lock:
+                archive[pull.snumber] = {"success": False, "start": start,
+                                         "number": pull.number, "stage": pull.repodir,
+                                         "completed": False, "finished": None,
+                                         "sha": pull.sha}
+                self._save_archive()
+
+            self._begin(pull)
+            if batch is None:
+                pull.test(None if expected is None else expected[pull.number])
+            if pull.cancelled:
+                #A newer head commit will be tested instead; its run replaces this
+                #archive entry.
+                with self.lock:
+                    archive[pull.snumber].update({"cancelled": True, "finished": datetime.now()})
                     self._save_archive()
+                if not self.testmode:
+                    pull.commit.create_status("error", pull.url, "Superseded by newer commits.")
+                return
+            pull.finalize()
+            pull.save_cache()
 
-                    #We email after saving the archive in case the email server causes exceptions.
-                    if archive[pull.snumber]["success"]:
-                        key = "success"
-                    else:
-                        key = "failure"
-                    self.cron.email(pull.repo.name, key, self._get_fields(key, pull), self.testmode)
-                except:
-                    import sys, traceback
-                    e = sys.exc_info()
-                    errmsg = '\n'.join(traceback.format_exception(e[0], e[1], e[2]))
-                    err(errmsg)
-                    self.cron.email(pull.repo.name, "error", self._get_fields("error", pull, errmsg),
-                                    self.testmode)
+            #This if block looks like a mess; it is necessary so that we can easily
+            #unit test this processing code by passing in the model outputs etc. that should
+            #have been returned from running live.
+            if (self.testmode and testarchive is not None and
+                pull.number in testarchive[pull.repokey] and
+                testarchive[pull.repokey][pull.number]["finished"] is not None):
+                finished = testarchive[pull.repokey][pull.number]["finished"]
+            elif self.testmode:
+                finished = datetime(2015, 4, 23, 13, 9)
+            else:
+                #This single line could replace the whole if block if we didn't have
+                #unit tests integrated with the main code.
+                finished = datetime.now()
+
+            #Update the status of this pull request on the archive, save the archive
+            #file in case the next pull request throws an unhandled exception.
+            with self.lock:
+                entry = archive[pull.snumber]
+                entry["results"] = [t["result"] for t in pull.testing.tests]
+                entry["completed"] = True
+                entry["success"] = abs(pull.percent - 1) < 1e-12
+                entry["finished"] = finished
+                success = entry["success"]
+                self._save_archive()
+
+            #We email after saving the archive in case the email server causes exceptions.
+            if pull.timedout:
+                key = "timeout"
+            elif success:
+                key = "success"
+            else:
+                key = "failure"
+            self.cron.email(pull.repo.name, key, self._get_fields(key, pull), self.testmode)
+        except:
+            import sys, traceback
+            e = sys.exc_info()
+            errmsg = '\n'.join(traceback.format_exception(e[0], e[1], e[2]))
+            err(errmsg)
+            self.cron.email(pull.repo.name, "error", self._get_fields("error", pull, errmsg),
+                            self.testmode)
+        finally:
+            with self.lock:
+                if self.active.get((pull.repokey, pull.snumber)) is pull:
+                    del self.active[(pull.repokey, pull.snumber)]
                 
-    def find_pulls(self, testpulls=None):
+    def _begin(self, pull):
+        """Sets the pending status of the pull request and sends the 'start' email
+        unless that was done already, e.g. when a Batch started testing it.
+        """
+        if pull.begun:
+            return
+        pull.begin()
+        self.cron.email(pull.repo.name, "start", self._get_fields("start", pull), self.testmode)
+
+    def find_pulls(self, testpulls=None, numbers=None):
         """Finds a list of new pull requests that need to be processed.
 
         :arg testpulls: a list of tserver.FakePull instances so we can test the code
           functionality without making live requests to github.
+        :arg numbers: a dictionary of lowered repo names and the list of pull request
+          numbers to check for each (e.g. from webhook events). When specified, only
+          those repos and pull requests are queried on github instead of listing
+          every open pull request.
         """
         #We check all the repositories installed for new (open) pull requests.
         #If any exist, we check the pull request number against our archive to
@@ -179,15 +586,36 @@ class Server(object):
                 #performing a live check on github.
                 continue
             
-            pulls = testpulls if testpulls is not None else repo.repo.get_pulls("open")
+            if numbers is not None and lname not in numbers:
+                continue
+            
+            if testpulls is None and repo.client.throttled:
+                warn("Skipping '{}'; the github rate limit is exhausted.".format(lname))
+                continue
+            
+            if testpulls is not None:
+                pulls = testpulls
+            elif numbers is not None:
+                pulls = [repo.repo.get_pull(n) for n in numbers[lname]]
+                pulls = [p for p in pulls if p.state == "open"]
+            else:
+                #The listing is validated against the cached ETag, so an unchanged
+                #list of open pull requests doesn't count against the rate limit.
+                pulls = repo.client.get_pulls(repo.name)
             result[lname] = []
             for pull in pulls:
                 newpull = True
-                if pull.snumber in self.archive[lname]:
+                snumber = str(pull.number)
+                sha = None if testpulls is not None else pull.head.sha
+                if snumber in self.archive[lname]:
                     #Check the status of that pull request processing. If it was
                     #successful, we just ignore this open pull request; it is
-                    #obviously waiting to be merged in.
-                    if self.archive[lname][pull.snumber]["completed"] == True:
+                    #obviously waiting to be merged in. New commits have to be
+                    #tested again; entries from before the head SHA was archived
+                    #are taken to be current.
+                    entry = self.archive[lname][snumber]
+                    if (entry["completed"] == True and
+                        (sha is None or entry.get("sha") in [None, sha])):
                         newpull = False
 
                 if newpull:
@@ -198,20 +626,95 @@ class Server(object):
 
         return result
     
+    def compact(self, openpulls=None):
+        """Collapses the archive entries of closed or merged pull requests into
+        compact summaries, deletes their orphaned staging directories and test
+        outputs and enforces each repo's 'keep' and 'maxage' cron settings.
+        Returns the number of entries that were compacted or removed.
+
+        :arg openpulls: a dictionary of lowered repo names and the numbers of their
+          open pull requests so we can test without live requests to github.
+        """
+        from os import path, remove
+        from shutil import rmtree
+        from datetime import datetime, timedelta
+        from config import CronSettings
+        from vcs import Mirror
+        summary = ["number", "success", "completed", "start", "finished"]
+        count = 0
+        for lname, repo in self.repositories.items():
+            if lname not in self.archive:
+                continue
+            if openpulls is not None:
+                numbers = openpulls.get(lname, [])
+            else:
+                numbers = [p.number for p in repo.client.get_pulls(repo.name)]
+            opened = set(str(n) for n in numbers)
+            archive = self.archive[lname]
+            #Staging directories that are still needed by the open pull requests or
+            #are the repo's configured staging area must not be deleted.
+            staging = path.abspath(path.expanduser(repo.staging))
+            active = set([staging] + [path.abspath(archive[n]["stage"]) for n in opened
+                                      if n in archive and archive[n].get("stage") is not None])
+
+            closed = []
+            for snumber in list(archive):
+                if snumber in opened:
+                    continue
+                entry = archive[snumber]
+                closed.append((entry.get("finished") or entry.get("start"), snumber))
+                if entry.get("compact"):
+                    continue
+
+                #With a single worker, all pull requests share the same staging
+                #directory; outputs there may belong to an open pull request's run.
+                for result in entry.get("results") or []:
+                    if (result is not None and path.isfile(result) and
+                        path.dirname(path.abspath(result)) not in active):
+                        remove(result)
+                stage = entry.get("stage")
+                if (stage is not None and path.abspath(stage) not in active
+                    and path.isdir(stage)):
+                    vms("Removing orphaned staging directory {}.".format(stage), 2)
+                    rmtree(stage)
+
+                compacted = {k: entry.get(k) for k in summary}
+                compacted["compact"] = True
+                archive[snumber] = compacted
+                count += 1
+
+            #Forget the worktrees of the staging directories that were removed.
+            if repo.mirror is not None:
+                folder = path.abspath(path.expanduser(repo.mirror))
+                self.mirrors.get(folder, Mirror(None, folder)).prune()
+
+            #Now enforce the retention limits on the closed pull requests; the
+            #newest ones are kept.
+            #The cron settings are stored under the repo name in its original case.
+            cron = self.cron.settings.get(repo.name, CronSettings())
+            closed.sort(key=lambda c: (c[0] is not None, c[0]), reverse=True)
+            for i, (when, snumber) in enumerate(closed):
+                expired = (cron.maxage is not None and when is not None and
+                           datetime.now() - when > timedelta(days=cron.maxage))
+                if (cron.keep is not None and i >= cron.keep) or expired:
+                    del archive[snumber]
+                    count += 1
+
+        self._save_archive()
+        return count
+
     def _get_archive(self):
         """Loads the archive of previously processed pull requests for all repos
         being monitored by this server.
         """
-        from utility import get_json
-        return get_json(self.archpath, {})
+        return self.store.load()
 
     def _save_archive(self):
-        """Saves the JSON archive of processed pull requests.
+        """Saves the archive of processed pull requests. The SQLite store only
+        writes the entries that changed.
         """
-        import json
-        from utility import json_serial
-        with open(self.archpath, 'w') as f:
-            json.dump(self.archive, f, default=json_serial)
+        with self.lock:
+            self.store.save(self.archive)
     
     def _get_repos(self):
         """Gets a list of all the installed repositories in this server.
@@ -302,6 +805,20 @@ class PullRequest(object):
         self.pull = pull
         """github.PullRequest.PullRequest instance with information
         about the commits."""
+        self.sha = None if testmode else pull.head.sha
+        """The SHA of the pull request's head commit when it was found; runs for
+        an older head are cancelled when new commits are pushed.
+        """
+        self.cancelled = False
+        """True once the run was cancelled because the pull request has a newer
+        head commit.
+        """
+        self.begun = False
+        """True once the pending status was set by begin()."""
+        self.trial = None
+        """The PullRequest that runs the tests of the Batch this pull request is
+        merged into right now, if any; cancelling this one cancels the trial too.
+        """
         if testmode:
             self.commit = None
             """The last commit (by whatever ordering the API presents them in. Status
@@ -315,6 +832,23 @@ class PullRequest(object):
         """The URL to the wiki page with details about the unit tests."""
         self.repodir = None
         """The full path to the staging directory for the repo."""
+        from copy import deepcopy
+        self.testing = deepcopy(repo.testing)
+        """This pull request's copy of the repo's config.TestingSettings; the
+        results of its test commands are kept here so that pull requests of the
+        same repo can be tested at the same time.
+        """
+        self.timedout = False
+        """True if any of the test commands was killed for running too long."""
+        self.changed = None
+        """The list of paths changed by the pull request relative to its merge base
+        with the base branch, or None if they aren't known; commands with 'paths'
+        filters only run if one of these matches.
+        """
+        self.commands = []
+        """The list of engine.Command instances for the test commands that are
+        (or were last) running for this pull request.
+        """
         self.testmode = testmode
         """when true, this class is instantiated in test mode so that
         the live requests are skipped."""
@@ -344,89 +878,95 @@ class PullRequest(object):
         return self.pull.number
     
     def init(self, archive):
-        """Creates the repo folder locally, copies the static files and 
-        folders available locally, initalizes the repo with git so it
-        has the correct remote origin and is ready to sync.
+        """Checks the pull request out from the repo's bare mirror into its own
+        git worktree and copies the static files and folders available locally
+        into it. The mirror is only fetched once per processing cycle.
 
-        :arg staging: the full path to the directory to stage the unit tests in.
+        :arg archive: the archive entry of a previous attempt at this pull request.
         """
-        from os import makedirs, path, chdir, system, getcwd
-        self.repodir = path.abspath(path.expanduser(self.repo.staging))
+        from os import makedirs, path
+        staging = path.abspath(path.expanduser(self.repo.staging))
+        self.repodir = staging
+        if self.server._concurrency(self) > 1:
+            #Other pull requests of the same repo may be tested at the same time,
+            #so each one gets its own staging directory.
+            self.repodir = "{}_{}".format(self.repodir, self.number)
 
-        if ("stage" in archive and path.isdir(archive["stage"]) and
-            self.repodir != archive["stage"] and archive["stage"] is not None):
-            #We have a previous attempt in a different staging directory to clean.
-            from shutil import rmtree
-            rmtree(archive["stage"])
+        #A previous attempt in a different staging directory is only cleaned if
+        #that directory was this pull request's own; the shared staging area and
+        #the worktrees of batches may be in use by other pull requests.
+        stage = archive.get("stage")
+        if (stage is not None and stage != self.repodir and path.isdir(stage) and
+            stage == "{}_{}".format(staging, self.number)):
+            if self.testmode:
+                from shutil import rmtree
+                rmtree(stage)
+            else:
+                self.server.mirror(self.repo).remove(stage)
+
+        if not self.testmode:
+            #The worktree is checked out before the static files are copied because
+            #git only adds worktrees in empty directories. The static files are kept
+            #when an existing worktree is cleaned so they don't have to be copied
+            #again.
+            mirror = self.server.mirror(self.repo)
+            mirror.update(self.server.cycle)
+            ref = "refs/pull/{}/{}".format(self.number, self.repo.ref)
+            if self.repo.ref == "merge" and mirror.resolve(ref) is None:
+                warn("Pull request #{} has no merge ref; testing its head.".format(self.number))
+                ref = "refs/pull/{}/head".format(self.number)
+            if any(len(t.get("paths", [])) > 0 for t in self.testing.tests):
+                self.changed = self.list_changes(mirror)
+            keep = [f["target"] for f in self.repo.static.files + self.repo.static.folders]
+            #A warm snapshot of the default branch is taken over if it is up to
+            #date, so only the changes of the pull request have to be applied.
+            if self.server.snapshot(self.repo).take(self.repodir, ref, keep) is None:
+                mirror.checkout(self.repodir, ref, keep)
 
         if not path.isdir(self.repodir):
             makedirs(self.repodir)
             
-        #Copy across all the static files so that we don't have to download them
-        #again and chew up the bandwidth. We don't have to copy files that already
-        #exist in the local repo.
-        self.repo.static.copy(self.repodir)
-        cwd = getcwd()
-        chdir(self.repodir)
-        
-        if not self._is_gitted():
-            #Next we need to initialize the git repo, then add all the static files
-            #and folders to be tracked so that when we pull from origin master they
-            #can be merged into the repo without re-downloading them.
-            system("git init")
-            if not self.testmode:
-                system("git remote add origin {}.git".format(self.repo.repo.html_url))
-
-            for file in self.repo.static.files:
-                #Here the 2:: removes the ./ specifying the path relative to the git
-                #repository root. It is added by convention in the config files.
-                system("git add {}".format(file["target"][2::]))
-            for folder in self.repo.static.folders:
-                system("git add {}".format(file["target"][2::]))
-
-            #Now sync with the master branch so that we get everything else that isn't
-            #static. Also, fetch the changes from the pull request head so that we
-            #can merge them into a new branch for unit testing.
-            if not self.testmode:
-                system("git pull origin master")
-
-        #Even though we have initialized the repo before, we still need to fetch the
-        #pull request we are wanting to merge in.
+        #Link in all the static files so that we don't have to download them again
+        #and chew up the bandwidth. Files that are already linked are skipped.
+        self.repo.static.copy(self.repodir, self.server.assets)
+        self.restore_cache()
         if not self.testmode:
-            system("git fetch origin pull/{0}/head:testing_{0}".format(self.pull.number))
-            system("git checkout testing_{}".format(pull.number))
+            #In a warm snapshot the builds and installs are already done for the
+            #default branch, so they only have to catch up with the changes.
+            self.server.prepare(self.repo, self.repodir)
 
         #The local repo now has the pull request's proposed changes and is ready
         #to be unit tested.
-        chdir(cwd)
 
-    def _is_gitted(self):
-        """Returns true if the current repodir has been initialized in git *and*
-        had a remote origin added *and* has a 'testing' branch.
+    def list_changes(self, mirror):
+        """Returns the list of files that the pull request changed since it branched
+        off its base branch, or None if the mirror doesn't have the merge base.
         """
-        from os import waitpid
-        from subprocess import Popen, PIPE
-    
-        premote = Popen("cd {}; git remote -v".format(self.repodir),
-                        shell=True, executable="/bin/bash", stdout=PIPE, stderr=PIPE)
-        waitpid(premote.pid, 0)
-        remote = premote.stdout.readlines()
-        remerr = premote.stderr.readlines()
-
-        pbranch = Popen("cd {}; git branch".format(self.repodir),
-                        shell=True, executable="/bin/bash", stdout=PIPE, stderr=PIPE)
-        waitpid(pbranch.pid, 0)
-        branch = pbranch.stdout.readlines()
-        braerr = pbranch.stderr.readlines()
-
-        if len(remote) > 0 and len(remerr) > 0 and len(branch) > 0:
-            return ((".git" in remote[0] and "fatal" not in remerr[0])
-                    and any(["testing" in b for b in branch]))
-        elif self.testmode and len(remote) == 0 and len(branch) == 0 and len(remerr) == 0:
-            return True
-        else:
-            return False
-        
+        try:
+            return mirror.changed("refs/heads/{}".format(self.pull.base.ref),
+                                  "refs/pull/{}/head".format(self.number))
+        except ValueError as e:
+            #Shallow mirrors may not have the merge base; all commands run.
+            warn("Unable to list the files changed by pull request #{}: {}".format(
+                self.number, e))
+            return None
+
+    def restore_cache(self):
+        """Restores the cached build products whose key files match into the
+        staging directory; folders that exist already are left alone.
+        """
+        self.server.restore_cache(self.repo, self.repodir)
+
+    def save_cache(self):
+        """Saves the build products of the pull request to the artifact cache; we
+        only trust them if all the tests passed, so it has to be called after
+        finalize().
+        """
+        if abs(self.percent - 1) > 1e-12:
+            return
+        for key, relpath, source in self.server.cache_keys(self.repo, self.repodir):
+            self.server.artifacts.save(key, source, self.repo.name, relpath)
+
     def begin(self):
         """Sets the status message on the *last* commit for this pull request
         to be 'pending' with a details link to a newly created Wiki page with
@@ -436,52 +976,277 @@ class PullRequest(object):
         self.url = self.server.wiki.create(self)
         if not self.testmode:
             self.commit.create_status("pending", self.url, "Running unit tests...")
+        self.begun = True
 
     def test(self, testresults=None):
         """Runs the unit test commands specified in the repo settings in parallel,
-        keeping track of the results of each one.
+        keeping track of the results of each one. Each command waits until the
+        'slots' it needs are free in the server's SlotPool and until the commands it
+        'needs' have passed; it is skipped if one of them failed. Commands that run
+        longer than their own 'timeout' or the overall <testing> timeout are killed.
 
         :arg testresults: a dictionary (indexed by integer index of the test
           command) to use as the expected output of executing the commands in parallel.
         """
-        from multiprocessing import Process, Queue
-        from utility import run_exec
         from datetime import datetime
-
-        # Setup a list of processes that we want to run.
-        output = Queue()
-        processes = []
-        for i, test in enumerate(self.repo.testing.tests):
+        from os import path
+        for test in self.testing.tests:
             #Before the command is ready to run, we need to replace any custom variables.
             test["command"] = self.server.settings.var_replace(test["command"])
-            processes.append(Process(target=run_exec, args=(self.repodir, test["command"], output, i)))
             if self.testmode:
                 #We need to hardcode the date and time so that it always matches the model
                 #output we expect.
                 test["start"] = datetime(2015, 04, 23, 13, 04)
             else:
-                test["start"] = datetime.now()
-            if not self.testmode:
-                processes[-1].start()
+                #The start time is set when the command actually gets its slots.
+                test["start"] = None
             
-        #Wait for the unit tests to all finish. TODO: add a loop that waits for a few
-        #seconds before checking each of them in turn. Don't block until they are just
-        #finished. We need to cancel them all if the timeout value specified in the
-        #TODO: enforce the setting for serial="true".
-        #config file is reached.
         ordered = testresults
         if not self.testmode:
-            for p in processes:
-                p.join()
-            results = [output.get() for p in processes]
-            ordered = {o["index"]: o for o in results}
+            keys = self._result_keys() if self.testing.cache else {}
+            cached = {}
+            for i, key in keys.items():
+                entry = self.server.results.lookup(key)
+                if entry is not None:
+                    vms("Using the cached result of test command #{}.".format(i), 2)
+                    cached[i] = entry
+                    cached[i]["output"] = self.server.results.copy_output(
+                        key, path.join(self.repodir, "{}.cidat".format(i)))
+            ordered = self._run(cached=cached)
+            for i, key in keys.items():
+                result = ordered[i]
+                if (i not in cached and not result["timedout"] and not result["skipped"]
+                    and result["code"] is not None and result["code"] >= 0):
+                    self.server.results.record(key, result["code"], result["output"],
+                                               result["bytes"], self.repo.name,
+                                               self.testing.tests[i]["command"])
             
-        for i, test in enumerate(self.repo.testing.tests):
+        self.timedout = False
+        for i, test in enumerate(self.testing.tests):
             result = ordered[i]
             test["end"] = result["end"]
-            test["success"] = result["code"] == 0 or result["code"] == 1
+            #Commands that the pull request's changes can't affect count as passed.
+            test["success"] = (result["code"] == 0 or result["code"] == 1 or
+                               result.get("filtered", False))
             test["code"] = result["code"]
-            test["result"] = result["output"]      
+            test["result"] = result["output"]
+            test["timedout"] = result.get("timedout", False)
+            test["skipped"] = result.get("skipped", False)
+            test["cached"] = result.get("cached", False)
+            test["filtered"] = result.get("filtered", False)
+            test["bytes"] = result.get("bytes")
+            self.timedout = self.timedout or test["timedout"]
+
+    def cancel(self):
+        """Stops the tests of the pull request from another thread: commands that
+        haven't started are skipped and the process groups of the running ones are
+        terminated (and killed after the grace period) so their slots are freed.
+        """
+        self.cancelled = True
+        for command in list(self.commands):
+            if command.process is not None and command.code is None:
+                command.kill()
+        trial = self.trial
+        if trial is not None:
+            trial.cancel()
+
+    def tail(self, index, size=4096):
+        """Returns the last 'size' bytes of output of the test command with the
+        specified index. Safe to call from other threads while the tests run.
+        """
+        if index < len(self.commands):
+            return self.commands[index].tail(size)
+        return ''
+
+    def _environ(self):
+        """Returns the environment variables for the test commands; they describe
+        the pull request being tested in addition to the CI server's environment.
+        """
+        from os import environ
+        env = dict(environ)
+        env["PYCI_REPO"] = self.repo.name
+        env["PYCI_PULL"] = self.snumber
+        env["PYCI_STAGE"] = self.repodir
+        return env
+
+    def _result_keys(self):
+        """Returns a dictionary of test indices and the keys of their results in
+        the server's result cache. The keys depend on the git tree of the staging
+        directory, the static files, the command text and the 'cacheenv' variables.
+        """
+        from os import environ
+        from vcs import run_git
+        state = "{} {}".format(run_git(["rev-parse", "HEAD^{tree}"], cwd=self.repodir).strip(),
+                               self.repo.static.digest(self.server.assets))
+        env = dict((n, environ.get(n)) for n in self.testing.cacheenv)
+        return dict((i, self.server.results.command_key(state, t["command"], env))
+                    for i, t in enumerate(self.testing.tests))
+
+    def _filtered(self):
+        """Returns the set of indices of the test commands that don't have to run
+        because the pull request didn't change any of their 'paths'. Commands that
+        are needed by a command that runs are never filtered out.
+        """
+        from utility import match_paths
+        tests = self.testing.tests
+        if self.changed is None:
+            return set()
+        ids = dict((t["id"], i) for i, t in enumerate(tests) if t.get("id") is not None)
+        selected = [i for i, t in enumerate(tests) if len(t.get("paths", [])) == 0 or
+                    match_paths(self.changed, t["paths"])]
+        result = set(range(len(tests)))
+        while len(selected) > 0:
+            i = selected.pop()
+            if i in result:
+                result.remove(i)
+                selected.extend([ids[n] for n in tests[i].get("needs", [])])
+        return result
+
+    def _deadline(self, test, started, overall=None):
+        """Returns the epoch time by which the test command has to finish, or None
+        if neither it nor the <testing> tag have a timeout.
+
+        :arg started: the epoch time at which the command was started.
+        :arg overall: the epoch time by which *all* the commands have to finish.
+        """
+        deadlines = [d for d in [overall] if d is not None]
+        if test.get("timeout") is not None:
+            deadlines.append(started + test["timeout"]*60)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def _run(self, grace=5, cached=None):
+        """Launches the test commands as their slots become free and waits for them
+        to finish while enforcing their deadlines. The process group of a command
+        that runs too long is terminated; it is killed outright if it is still
+        running after the grace period (in seconds). Returns a dictionary of test
+        indices and their results.
+
+        :arg cached: a dictionary of test indices and the entries of the result
+          cache (with the path to their restored 'output') for the commands that
+          don't have to run again.
+        """
+        from datetime import datetime
+        from os import path
+        from time import time
+        from signal import SIGKILL
+        from engine import Engine, Command
+        tests = self.testing.tests
+        env = self._environ()
+        head, tail, compress = self.server.settings.output_limits
+        commands = [Command(i, t["command"], self.repodir,
+                            path.join(self.repodir, "{}.cidat".format(i)), env,
+                            head, tail, compress)
+                    for i, t in enumerate(tests)]
+        self.commands = commands
+        engine = Engine()
+        begun = time()
+        overall = None if self.testing.timeout is None else begun + self.testing.timeout*60
+        ids = dict((t["id"], i) for i, t in enumerate(tests) if t.get("id") is not None)
+        cached = cached if cached is not None else {}
+        for i, entry in cached.items():
+            tests[i]["start"] = commands[i].start = commands[i].end = datetime.now()
+            commands[i].code = entry["code"]
+            commands[i].output = entry["output"]
+        filtered = self._filtered()
+        for i in filtered:
+            vms("Skipping test command #{}; pull request #{} doesn't change its "
+                "paths.".format(i, self.number), 2)
+            tests[i]["start"] = commands[i].start = commands[i].end = datetime.now()
+        waiting = [i for i in range(len(commands)) if i not in cached and i not in filtered]
+        running = {}
+        deadlines = {}
+        killed = {}
+        timedout = set()
+        skipped = set()
+        
+        try:
+            while len(waiting) > 0 or len(running) > 0:
+                for command in engine.poll(0.5 if len(running) > 0 else 0):
+                    i = command.index
+                    self.server.slots.release(running.pop(i))
+                    if i in killed:
+                        #Whatever is left in the group ignored the request to terminate.
+                        command.kill(SIGKILL)
+                        del killed[i]
+                        
+                now = time()
+                if self.cancelled:
+                    #Nothing else starts; the running commands get the same grace
+                    #period as the ones that time out.
+                    for i in running:
+                        if i not in killed:
+                            commands[i].kill()
+                            killed[i] = now
+                    for i in waiting:
+                        tests[i]["start"] = commands[i].end = datetime.now()
+                        skipped.add(i)
+                    del waiting[:]
+
+                #Commands start in order so that a command needing many slots isn't
+                #starved by the smaller ones behind it; commands whose dependencies
+                #haven't finished yet are passed over until they have.
+                for i in list(waiting):
+                    needs = [ids[n] for n in tests[i].get("needs", [])]
+                    if overall is not None and now > overall:
+                        tests[i]["start"] = commands[i].end = datetime.now()
+                        timedout.add(i)
+                    elif any(n in skipped or not self._passed(commands[n], n in timedout)
+                             for n in needs if n not in waiting and n not in running):
+                        vms("Skipping test command #{} for pull request #{}; a command "
+                            "it needs failed.".format(i, self.number), 2)
+                        tests[i]["start"] = commands[i].end = datetime.now()
+                        skipped.add(i)
+                    elif any(n in waiting or n in running for n in needs):
+                        continue
+                    elif self.testing.serial and len(running) > 0:
+                        break
+                    else:
+                        taken = self.server.slots.acquire(tests[i].get("slots", 1), False, self)
+                        if not taken:
+                            break
+                        running[i] = taken
+                        engine.launch(commands[i])
+                        tests[i]["start"] = commands[i].start
+                        deadlines[i] = self._deadline(tests[i], now, overall)
+                    waiting.remove(i)
+
+                if len(running) == 0 and len(waiting) > 0:
+                    #Other pull requests hold all the slots.
+                    engine.poll(0.5)
+                    
+                for i in running:
+                    if i in killed:
+                        if now - killed[i] > grace:
+                            commands[i].kill(SIGKILL)
+                    elif deadlines[i] is not None and now > deadlines[i]:
+                        warn("Test command #{} for pull request #{} timed out.".format(i, self.number))
+                        commands[i].kill()
+                        killed[i] = now
+                        timedout.add(i)
+        finally:
+            for i in running:
+                #Only reached if the CI server itself fails; don't leave orphans.
+                commands[i].kill(SIGKILL)
+                self.server.slots.release(running[i])
+            #Commands that were skipped or cancelled while they waited for their
+            #slots shouldn't hold up the other pull requests.
+            self.server.slots.unreserve(self)
+
+        ordered = {}
+        for i, command in enumerate(commands):
+            ordered[i] = {"index": i, "end": command.end, "output": command.output,
+                          "code": None if i in timedout else command.code,
+                          "timedout": i in timedout,
+                          "skipped": i in skipped or i in filtered,
+                          "filtered": i in filtered, "cached": i in cached,
+                          "bytes": cached[i]["bytes"] if i in cached else command.bytes}
+        return ordered
+
+    def _passed(self, command, timedout=False):
+        """Returns True if the finished test command counts as a success; an exit
+        code of 1 reports a slowdown but still passes.
+        """
+        return not timedout and command.code in [0, 1]
 
     def finalize(self):
         """Finalizes the pull request processing by updating the wiki page with
@@ -491,16 +1256,18 @@ class PullRequest(object):
         #the unit tests.
         stotal = 0
         ttotal = 0
-        for test in self.repo.testing.tests:
+        for test in self.testing.tests:
             stotal += (1 if test["success"]==True else 0)
             ttotal += (test["end"] - test["start"]).seconds
 
-        self.percent = stotal/float(len(self.repo.testing.tests))
+        self.percent = stotal/float(len(self.testing.tests))
         self.message = "Results: {0:.2%} in {1:d}s.".format(self.percent, ttotal)
+        if self.timedout:
+            self.message += " Timed out."
         if not self.testmode:
-            if percent < 1:
+            if self.percent < 1:
                 self.commit.create_status("failure", self.url, self.message)
-            elif any([test["code"] == 1 for test in self.repo.testing.tests]):
+            elif any([test["code"] == 1 for test in self.testing.tests]):
                 self.commit.create_status("pending", self.url, self.message + " Slowdown reported.")
             else:
                 self.commit.create_status("success", self.url, self.message)
@@ -512,20 +1279,24 @@ class PullRequest(object):
         """
         result = {}
         if not self.testmode:
-            result["__reponame__"] = self.repo.repo.full_name
-            result["__repodesc__"] = self.repo.repo.description
-            result["__repourl__"] = self.repo.repo.html_url
+            #The repo and owner details rarely change; the client serves them from
+            #its cache until the configured TTL expires.
+            client = self.repo.client
+            repo = client.get_metadata("/repos/{}".format(self.repo.name))
+            result["__reponame__"] = repo["full_name"]
+            result["__repodesc__"] = repo["description"]
+            result["__repourl__"] = repo["html_url"]
             result["__repodir__"] = self.repodir
 
-            if self.organization is not None:
-                owner = self.repo.organization
+            if self.repo.organization is not None:
+                owner = client.get_metadata("/orgs/{}".format(self.repo.organization))
             else:
-                owner = self.repo.user
+                owner = client.get_metadata("/users/{}".format(self.repo.username))
                 
-            result["__username__"] = owner.name
-            result["__userurl__"] = owner.html_url
-            result["__useravatar__"] = owner.avatar_url
-            result["__useremail__"] = owner.email
+            result["__username__"] = owner["name"]
+            result["__userurl__"] = owner["html_url"]
+            result["__useravatar__"] = owner["avatar_url"]
+            result["__useremail__"] = owner["email"]
 
         return result
 
@@ -543,11 +1314,11 @@ class PullRequest(object):
         """
         result = self._fields_common()
         basic = {
-            "__test_html__": self.repo.testing.html(False),
-            "__test_text__": self.repo.testing.text(False)}
+            "__test_html__": self.testing.html(False),
+            "__test_text__": self.testing.text(False)}
         full = {
-            "__test_html__": self.repo.testing.html(),
-            "__test_text__": self.repo.testing.text()}
+            "__test_html__": self.testing.html(),
+            "__test_text__": self.testing.text()}
         
         if event in ["finish", "success"]:
             full["__percent__"] = "{0:.2%}".format(self.percent)
@@ -558,7 +1329,7 @@ class PullRequest(object):
             "error": basic,
             "finish": full,
             "success": full,
-            "timeout": basic
+            "timeout": full
         }
         if event in extra:
             result.update(extra[event])
@@ -602,6 +1373,11 @@ class Wiki(object):
         self.prefix = None
         """The text prefix used in front of the pages and links created for this request.
         """
+        from threading import RLock
+        self.lock = RLock()
+        """Serializes the page edits of pull requests processed at the same time;
+        the site connection and the page prefix are shared between them.
+        """
         self._get_site()
 
     def _get_site(self):
@@ -640,13 +1416,14 @@ class Wiki(object):
 
         :arg request: the PullRequest instance with testing information.
         """
-        self._site_login(request.repo)
-        self.prefix = "{}_Pull_Request_{}".format(request.repo.name, request.pull.number)
-        
-        #We add the link to the main repo page during this creation; we also create
-        #the full unit test report page here.
-        self._edit_main(request)
-        return self._create_new(request)
+        with self.lock:
+            self._site_login(request.repo)
+            self.prefix = "{}_Pull_Request_{}".format(request.repo.name, request.pull.number)
+
+            #We add the link to the main repo page during this creation; we also create
+            #the full unit test report page here.
+            self._edit_main(request)
+            return self._create_new(request)
 
     def update(self, request):
         """Updates the wiki page with the results of the unit tests run for the 
@@ -656,46 +1433,50 @@ class Wiki(object):
         :arg ttotal: the total time elapsed in running *all* the unit tests.
         """
         from os import path
-        self._site_login(request.repo)
-        self.prefix = "{}_Pull_Request_{}".format(request.repo.name, request.pull.number)
-                
-        #Before we can update the results from stdout, we first need to upload them to the
-        #server. The files can be quite big sometimes; if a file is larger than 1MB, we ...
-        for i, test in enumerate(request.repo.testing.tests):
-            test["remote_file"] = "{}_{}.txt".format(self.prefix, i)
-            if test["result"] is not None and path.isfile(test["result"]):
-                #Over here, we might consider doing something different if the wiki server
-                #is the same physical machine as the CI server; we needn't use the network
-                #protocols for the copy then. However, the machine knows already if an address
-                #it is accessing is its own; the copy, at worst, would be through the named
-                #pipes over TCP. It is wasteful compared to a HDD copy, but simplifies the
-                #uploading (which must also make an entry in the wiki database).
-                if not self.testmode:
-                    self.site.upload(open(test["result"]), test["remote_file"],
-                                     '`stdout` from `{}`'.format(test["command"]))
+        with self.lock:
+            self._site_login(request.repo)
+            self.prefix = "{}_Pull_Request_{}".format(request.repo.name, request.pull.number)
+            self.newpage = self.prefix
 
-        #Now we can just overwrite the page with the additional test results, including the
-        #links to the stdout files we uploaded.
-        head = list(self._newpage_head)
-        #Add a link to the details page that points back to the github pull request URL.
-        head.append("==Github Pull Request Info==\n")
-        head.append(request.wiki())
-        head.append("==Commands Run for Unit Testing==\n")
-        head.append(request.repo.testing.wiki())
-        if not self.testmode:
-            page = self.site.Pages[self.newpage]
-            result = page.save('\n'.join(head), summary='Edited by CI bot with uploaded unit test details.',
-                               minor=True, bot=True)
-            return result[u'result'] == u'Success'
-        else:
-            return '\n'.join(head)
+            #Before we can update the results from stdout, we first need to upload them to the
+            #server. The files can be quite big sometimes; if a file is larger than 1MB, we ...
+            for i, test in enumerate(request.testing.tests):
+                test["remote_file"] = "{}_{}.txt".format(self.prefix, i)
+                if test["result"] is not None and test["result"].endswith(".gz"):
+                    test["remote_file"] += ".gz"
+                if test["result"] is not None and path.isfile(test["result"]):
+                    #Over here, we might consider doing something different if the wiki server
+                    #is the same physical machine as the CI server; we needn't use the network
+                    #protocols for the copy then. However, the machine knows already if an address
+                    #it is accessing is its own; the copy, at worst, would be through the named
+                    #pipes over TCP. It is wasteful compared to a HDD copy, but simplifies the
+                    #uploading (which must also make an entry in the wiki database).
+                    if not self.testmode:
+                        self.site.upload(open(test["result"]), test["remote_file"],
+                                         '`stdout` from `{}`'.format(test["command"]))
+
+            #Now we can just overwrite the page with the additional test results, including the
+            #links to the stdout files we uploaded.
+            head = list(self._newpage_head)
+            #Add a link to the details page that points back to the github pull request URL.
+            head.append("==Github Pull Request Info==\n")
+            head.append(request.wiki())
+            head.append("==Commands Run for Unit Testing==\n")
+            head.append(request.testing.wiki())
+            if not self.testmode:
+                page = self.site.Pages[self.newpage]
+                result = page.save('\n'.join(head), summary='Edited by CI bot with uploaded unit test details.',
+                                   minor=True, bot=True)
+                return result[u'result'] == u'Success'
+            else:
+                return '\n'.join(head)
             
     def _create_new(self, request):
         """Creates the new wiki page that houses the details of the unit testing runs.
         """
         self.prefix = "{}_Pull_Request_{}".format(request.repo.name, request.pull.number)
         head = list(self._newpage_head)
-        head.append(request.repo.testing.wiki(False))
+        head.append(request.testing.wiki(False))
         if not self.testmode:
             page = self.site.Pages[self.newpage]
             result = page.save('\n'.join(head), summary='Created by CI bot for unit test details.', bot=True)
@@ -708,7 +1489,7 @@ class Wiki(object):
         """
         self.prefix = "{}_Pull_Request_{}".format(request.repo.name, request.pull.number)
         if not self.testmode:
-            page = site.pages[self.basepage]
+            page = self.site.Pages[self.basepage]
             text = page.text()
         else:
             text = "This is a fake wiki page.\n\n<!--@CI:Placeholder-->"
@@ -723,6 +1504,164 @@ class Wiki(object):
         else:
             return text
 
+class Snapshot(object):
+    """A worktree of a repo's default branch with the static files copied and
+    the <prepare> commands run. A new pull request takes the snapshot over as its
+    staging directory and only checks out its own changes on top; the worktree it
+    replaces is recycled as the next snapshot.
+    """
+    def __init__(self, server, repo, folder):
+        """
+        :arg folder: the full path to the snapshot's worktree.
+        """
+        from threading import RLock
+        self.server = server
+        """Server instance with the repo mirrors, asset store and settings."""
+        self.repo = repo
+        """The RepositorySettings of the repo whose default branch is kept warm."""
+        self.folder = folder
+        """The full path to the snapshot's worktree."""
+        self.lock = RLock()
+        """Held while the snapshot is refreshed or taken over."""
+
+    @property
+    def stamp(self):
+        """Returns the full path to the file with the SHA that the snapshot was
+        prepared for, or None if the snapshot doesn't exist.
+        """
+        from os import path
+        from vcs import GitState
+        state = GitState(self.folder)
+        return path.join(state.gitdir, "pyci-prepared") if state.valid else None
+
+    @property
+    def prepared(self):
+        """Returns the SHA of the commit that the snapshot is ready for, or None."""
+        from os import path
+        stamp = self.stamp
+        if stamp is None or not path.isfile(stamp):
+            return None
+        with open(stamp) as f:
+            return f.read().strip()
+
+    def _unstamp(self):
+        """Marks the snapshot as no longer prepared."""
+        from os import path, remove
+        if self.stamp is not None and path.isfile(self.stamp):
+            remove(self.stamp)
+
+    def refresh(self):
+        """Checks out the latest commit of the default branch, copies the static
+        files and runs the <prepare> commands if the snapshot isn't ready for it
+        yet. Files ignored by git, like build products, are kept between refreshes.
+        """
+        with self.lock:
+            mirror = self.server.mirror(self.repo)
+            #Refreshes happen between the processing cycles, so the fetch can't be
+            #skipped for the cycle; the snapshot would be stale once the next one
+            #fetches the default branch.
+            mirror.update()
+            sha = mirror.resolve("HEAD")
+            if sha is None or sha == self.prepared:
+                return
+
+            vms("Prewarming {} at {} in {}.".format(self.repo.name, sha[0:7], self.folder))
+            self._unstamp()
+            keep = [f["target"] for f in self.repo.static.files + self.repo.static.folders]
+            mirror.checkout(self.folder, "HEAD", keep, clean="untracked")
+            self.repo.static.copy(self.folder, self.server.assets)
+            self.server.restore_cache(self.repo, self.folder)
+            self.server.prepare(self.repo, self.folder)
+            with open(self.stamp, 'w') as f:
+                f.write(sha)
+
+    def take(self, target, ref, keep=None):
+        """Moves the snapshot to 'target' and checks out the ref on top of it if the
+        snapshot is ready for the latest commit of the default branch. Returns the
+        SHA that was checked out, or None if the snapshot can't be used (e.g. it is
+        being refreshed right now).
+        """
+        from os import path
+        if not self.lock.acquire(False):
+            return None
+        try:
+            mirror = self.server.mirror(self.repo)
+            if self.prepared is None or self.prepared != mirror.resolve("HEAD"):
+                return None
+            if path.exists(target) and not mirror.is_worktree(target):
+                return None
+
+            vms("Taking over the warm snapshot {} for {}.".format(self.folder, target), 2)
+            self._unstamp()
+            parked = None
+            if path.exists(target):
+                parked = "{}_old".format(self.folder)
+                mirror.move(target, parked)
+            mirror.move(self.folder, target)
+            if parked is not None:
+                mirror.move(parked, self.folder)
+            return mirror.checkout(target, ref, keep, clean=None)
+        finally:
+            self.lock.release()
+
+class SlotPool(object):
+    """Counts the CPU/memory slots held by the test commands that are running.
+    A single pool is shared by all the pull requests being tested at the same
+    time so that the box isn't oversubscribed.
+    """
+    def __init__(self, capacity):
+        """
+        :arg capacity: the total number of slots available.
+        """
+        from threading import Condition
+        self.capacity = capacity
+        """The total number of slots available to the test commands."""
+        self.used = 0
+        """The number of slots held by the commands that are running."""
+        self.reserved = None
+        """The owner that the free slots are kept for, or None."""
+        self._condition = Condition()
+
+    def acquire(self, slots, blocking=True, owner=None):
+        """Takes the specified number of slots, waiting for them to be released
+        if necessary. Returns the number of slots taken; commands that need more
+        than the capacity take all of them. Returns 0 if 'blocking' is False and
+        the slots are not free.
+
+        :arg owner: identifies the caller of a non-blocking request. The first
+          owner whose request fails reserves the pool: nobody else gets slots
+          until it has taken the ones it needs or called unreserve(). This way
+          a command that needs many slots isn't starved by a stream of commands
+          that need a single one.
+        """
+        slots = min(max(1, slots), self.capacity)
+        with self._condition:
+            while (self.used + slots > self.capacity or
+                   (self.reserved is not None and self.reserved is not owner)):
+                if not blocking:
+                    if self.reserved is None and owner is not None:
+                        self.reserved = owner
+                    return 0
+                self._condition.wait()
+            if owner is not None and self.reserved is owner:
+                self.reserved = None
+                self._condition.notify_all()
+            self.used += slots
+        return slots
+
+    def unreserve(self, owner):
+        """Gives up the reservation of the pool if 'owner' holds it."""
+        with self._condition:
+            if self.reserved is owner:
+                self.reserved = None
+                self._condition.notify_all()
+
+    def release(self, slots):
+        """Returns the slots taken by a previous call to acquire()."""
+        with self._condition:
+            self.used -= slots
+            self._condition.notify_all()
+
 class CronManager(object):
     """Object to manage a set of repositories whose pull requests need to be
     monitored via cron every few minutes.
@@ -844,3 +1783,141 @@ class Email(object):
             s.quit()
 
         self.sent = True
+
+class Batch(object):
+    """A group of pull requests of the same repo and base branch that are merged
+    into one candidate and tested together. If the candidate passes, every pull
+    request in it is reported as passed; otherwise the batch is split in halves
+    until the pull requests that break the tests are tested on their own.
+    """
+    def __init__(self, server, repo, pulls):
+        """
+        :arg pulls: the list of PullRequest instances to test together.
+        """
+        self.server = server
+        """Server instance with the repo mirrors, asset store and settings."""
+        self.repo = repo
+        """The RepositorySettings of the repo that the pull requests belong to."""
+        self.pulls = pulls
+        """The list of PullRequest instances in the batch."""
+        self.processed = []
+        """The list of pull request numbers that were processed (and reported)."""
+
+    @property
+    def repokey(self):
+        """Returns the lowered full-name of the repository."""
+        return self.repo.name.lower()
+
+    @property
+    def folder(self):
+        """Returns the full path to the worktree that the candidates are merged in;
+        batches of the same repo only share it if they can't run at the same time.
+        """
+        from os import path
+        folder = "{}_batch".format(path.abspath(path.expanduser(self.repo.staging)))
+        if self.server._concurrency(self.pulls[0]) > 1:
+            folder = "{}_{}".format(folder, self.pulls[0].number)
+        return folder
+
+    def process(self):
+        """Tests the batch and reports the results of each of its pull requests.
+        If the batch can't be staged, the remaining pull requests are processed on
+        their own.
+        """
+        try:
+            self._bisect(self.pulls)
+        except:
+            import sys, traceback
+            e = sys.exc_info()
+            err('\n'.join(traceback.format_exception(e[0], e[1], e[2])))
+            for pull in self.pulls:
+                if pull.number not in self.processed:
+                    self._report(pull)
+
+    def _report(self, pull, trial=None):
+        """Reports the pull request with the results of the passed trial run, or
+        processes it on its own if there is none.
+        """
+        self.server._process_pull(pull, batch=trial)
+        self.processed.append(pull.number)
+
+    def _bisect(self, pulls):
+        """Tests the pull requests together and reports them if they pass; if not,
+        each half is bisected in turn. Pull requests that were updated while they
+        were tested are reported as superseded and the others are tested again.
+        """
+        if len(pulls) == 1:
+            self._report(pulls[0])
+            return
+
+        merged, trial = self.test(pulls)
+        for pull in pulls:
+            if pull not in merged:
+                #It conflicts with the others, so it can only be tested on its own.
+                self._report(pull)
+        if len(merged) == 0:
+            return
+        superseded = [p for p in merged if p.cancelled]
+        if len(superseded) > 0:
+            for pull in superseded:
+                self._report(pull, trial)
+            remaining = [p for p in merged if not p.cancelled]
+            if len(remaining) > 0:
+                self._bisect(remaining)
+        elif all(t["success"] for t in trial.testing.tests):
+            vms("Pull requests {} passed as a batch.".format(
+                ", ".join("#{}".format(p.number) for p in merged)))
+            for pull in merged:
+                self._report(pull, trial)
+        elif len(merged) == 1:
+            #The others conflicted, so the trial tested this one on its own.
+            self._report(merged[0], trial)
+        else:
+            vms("Pull requests {} failed as a batch; bisecting.".format(
+                ", ".join("#{}".format(p.number) for p in merged)))
+            half = len(merged)//2
+            self._bisect(merged[0:half])
+            self._bisect(merged[half:])
+
+    def test(self, pulls):
+        """Merges the heads of the pull requests into their base branch in the
+        batch's worktree and runs the tests there. Returns the list of pull
+        requests that merged cleanly and the PullRequest (of the first of them)
+        that ran the tests, or None if none merged. While the trial runs, the
+        merged pull requests are registered as active so that pushing to one of
+        them cancels it; their pending status is set before the tests start.
+        """
+        mirror = self.server.mirror(self.repo)
+        mirror.update(self.server.cycle)
+        keep = [f["target"] for f in self.repo.static.files + self.repo.static.folders]
+        mirror.checkout(self.folder, "refs/heads/{}".format(pulls[0].pull.base.ref), keep)
+        merged = [p for p in pulls
+                  if mirror.merge(self.folder, "refs/pull/{}/head".format(p.number))]
+        if len(merged) == 0:
+            return merged, None
+
+        trial = PullRequest(self.server, self.repo, merged[0].pull)
+        trial.repodir = self.folder
+        with self.server.lock:
+            for pull in merged:
+                pull.trial = trial
+                self.server.active[(pull.repokey, pull.snumber)] = pull
+        try:
+            for pull in merged:
+                pull.repodir = self.folder
+                self.server._begin(pull)
+            self.repo.static.copy(self.folder, self.server.assets)
+            self.server.restore_cache(self.repo, self.folder)
+            self.server.prepare(self.repo, self.folder)
+            if any(len(t.get("paths", [])) > 0 for t in trial.testing.tests):
+                changes = [p.list_changes(mirror) for p in merged]
+                if all(c is not None for c in changes):
+                    trial.changed = sorted(set(sum(changes, [])))
+            trial.test()
+        finally:
+            with self.server.lock:
+                for pull in merged:
+                    pull.trial = None
+                    if self.server.active.get((pull.repokey, pull.snumber)) is pull:
+                        del self.server.active[(pull.repokey, pull.snumber)]
+        return merged, trial
@@ -20,28 +20,42 @@ def get_repo_relpath(repo, relpath):
     directory of the repository.
     """
     from os import path
-    if relpath[0:2] == "./":
-        return path.join(repo, relpath[2::])
+    #Joining the paths instead of changing into the repo directory keeps this
+    #safe to call from the worker threads, which share the working directory.
+    return path.abspath(path.join(path.expanduser(repo), relpath))
+
+datetime_keys = ["start", "end", "started", "finished", "compacted"]
+"""Keys whose string values in the data and archive files are datetimes that
+were serialized by json_serial() in ISO-8601 format.
+"""
+
+def parse_datetime(value):
+    """Parses an ISO-8601 string produced by datetime.isoformat(), i.e.
+    'YYYY-MM-DDTHH:MM:SS[.ffffff]'. Raises a ValueError for anything else.
+    """
+    from datetime import datetime
+    #Slicing the fixed-width fields is much faster than a generic parser.
+    if (len(value) in [19, 26] and value[4] == "-" and value[7] == "-" and
+        value[10] in "T " and value[13] == ":" and value[16] == ":"):
+        micro = int(value[20:26]) if len(value) == 26 and value[19] == "." else 0
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]), micro)
     else:
-        from os import chdir, getcwd
-        cd = getcwd()
-        chdir(path.expanduser(repo))
-        result = path.abspath(relpath)
-        chdir(cd)
-        return result
+        raise ValueError("'{}' is not an ISO-8601 datetime.".format(value))
 
-import dateutil.parser    
 def load_with_datetime(pairs):
-    """Deserialize JSON into python datetime objects."""
+    """Deserialize JSON into python datetime objects. Only the values of the
+    keys in datetime_keys are parsed; all other strings are left alone.
+    """
     d = {}
     for k, v in pairs:
-        if isinstance(v, basestring):
+        if k in datetime_keys and isinstance(v, basestring):
             try:
-                d[k] = dateutil.parser.parse(v)
+                d[k] = parse_datetime(v)
             except ValueError:
                 d[k] = v
         else:
-            d[k] = v             
+            d[k] = v
     return d
 
 def get_json(jsonpath, default):
@@ -69,22 +83,48 @@ def json_serial(obj):
         serial = obj.isoformat()
         return serial
 
-def run_exec(repodir, command, output, index):
-    """Runs the specified command in the repo directory.
+def kill_group(pid, signum=None):
+    """Sends the signal (SIGTERM by default) to every process in the process
+    group led by the specified process id. Returns False if the group no longer
+    exists.
+    """
+    from os import killpg
+    from signal import SIGTERM
+    try:
+        killpg(pid, SIGTERM if signum is None else signum)
+        return True
+    except OSError:
+        return False
 
-    :arg repodir: the absolute path of the repo directory to run 'command' in.
-    :arg command: what to run in the 'repodir'. Should be valid in the context
-      of the $PATH variable.
-    :arg output: the multiprocessing queue to push the results to.
-    :arg index: the index of this test in the master list.
+def glob_regex(pattern):
+    """Returns the compiled regular expression for a path pattern in which '*'
+    and '?' match within a single folder and '**' matches any number of them.
+    """
+    import re
+    result = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            result.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            result.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            result.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            result.append("[^/]")
+            i += 1
+        else:
+            result.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile("".join(result) + "$")
+
+def match_paths(paths, patterns):
+    """Returns True if any of the paths (relative to the repo root) matches one
+    of the patterns; see glob_regex().
     """
     from os import path
-    from subprocess import Popen, PIPE
-    from datetime import datetime
-    
-    child = Popen("cd {}; {} > {}.cidat".format(repodir, command, index),
-                  shell=True, executable="/bin/bash")
-    # Need to do this so that we are sure the process is done before moving on
-    child.wait()
-    output.put({"index": index, "end": datetime.now(), "code": child.returncode,
-                "output": path.join(repodir, "{}.cidat".format(index))})
+    regexes = [glob_regex(path.normpath(p).lstrip("/")) for p in patterns]
+    return any(r.match(p) for p in paths for r in regexes)
@@ -0,0 +1,400 @@
+"""Manages the local git copies of the monitored repositories. Each repo keeps a
+single bare mirror of its github repository that is fetched once per processing
+cycle; the pull requests are then checked out from it as git worktrees so that
+a new pull request only costs a checkout instead of a full clone. The state of
+the mirror and the worktrees (config, HEAD and refs) is read directly from the
+git directories; git itself is only run to change them.
+"""
+from pyci.msg import vms
+
+def run_git(args, cwd=None, gitdir=None):
+    """Runs the git command with the specified arguments and returns its stdout.
+    The output pipes are read with communicate() so that large outputs can't
+    deadlock the command.
+
+    :arg args: a list of arguments to pass to git.
+    :arg cwd: the full path to the directory to run git in.
+    :arg gitdir: the full path to the git directory to operate on; passed to git
+      with the --git-dir option.
+    """
+    from subprocess import Popen, PIPE
+    command = ["git"] + (["--git-dir={}".format(gitdir)] if gitdir is not None else []) + args
+    vms("Running '{}'.".format(' '.join(command)), 3)
+    process = Popen(command, cwd=cwd, stdout=PIPE, stderr=PIPE, close_fds=True)
+    output, error = process.communicate()
+    if process.returncode != 0:
+        raise ValueError("'{}' failed with code {}: {}".format(' '.join(command),
+                                                               process.returncode,
+                                                               error.strip()))
+    return output
+
+class GitState(object):
+    """Reads the config, HEAD and refs of a git repository or worktree directly
+    from the files in its git directory.
+    """
+    def __init__(self, folder):
+        """
+        :arg folder: the full path to the working directory of a repository or
+          worktree, or to a bare repository.
+        """
+        from os import path
+        self.folder = folder
+        """The full path to the working directory or bare repository."""
+        self.gitdir = None
+        """The full path to the git directory with the HEAD of the working
+        directory; None if the folder isn't a git repository.
+        """
+        self.commondir = None
+        """The full path to the git directory with the objects, refs and config
+        that are shared by all the worktrees of the repository.
+        """
+        self._config = None
+        """Lazy initialization for the self.config property."""
+
+        dotgit = path.join(folder, ".git")
+        if path.isfile(dotgit):
+            #Worktrees have a .git file that points to their own git directory.
+            contents = _read(dotgit)
+            if contents is not None and contents.startswith("gitdir:"):
+                self.gitdir = path.join(folder, contents[len("gitdir:"):].strip())
+        elif path.isdir(dotgit):
+            self.gitdir = dotgit
+        elif path.isdir(path.join(folder, "objects")):
+            self.gitdir = folder
+
+        if self.gitdir is not None:
+            if not path.isfile(path.join(self.gitdir, "HEAD")):
+                self.gitdir = None
+                return
+            common = _read(path.join(self.gitdir, "commondir"))
+            if common is not None:
+                self.commondir = path.normpath(path.join(self.gitdir, common))
+            else:
+                self.commondir = self.gitdir
+
+    @property
+    def valid(self):
+        """Returns True if the folder is a git repository or worktree."""
+        return self.gitdir is not None
+
+    @property
+    def config(self):
+        """Returns a dictionary of the repository's config values keyed by their
+        lowered 'section.subsection.key' names; the values in the worktree's own
+        config override the shared ones.
+        """
+        from os import path
+        if self._config is None:
+            self._config = {}
+            if self.valid:
+                _parse_config(path.join(self.commondir, "config"), self._config)
+                _parse_config(path.join(self.gitdir, "config.worktree"), self._config)
+        return self._config
+
+    @property
+    def head(self):
+        """Returns the SHA of the commit that is checked out, or None."""
+        return self.ref("HEAD")
+
+    @property
+    def branch(self):
+        """Returns the name of the branch that is checked out, or None if HEAD is
+        detached.
+        """
+        from os import path
+        if not self.valid:
+            return None
+        head = _read(path.join(self.gitdir, "HEAD"))
+        if head is not None and head.startswith("ref: refs/heads/"):
+            return head[len("ref: refs/heads/"):]
+
+    def remote(self, name="origin"):
+        """Returns the URL of the remote with the specified name, or None."""
+        return self.config.get("remote.{}.url".format(name))
+
+    def ref(self, name):
+        """Returns the SHA that the ref points to, following symbolic refs, or None
+        if the ref doesn't exist.
+
+        :arg name: the full name of the ref, e.g. 'HEAD' or 'refs/pull/1/head'.
+        """
+        from os import path
+        if not self.valid:
+            return None
+        for i in range(10):
+            #HEAD and the other pseudo-refs belong to the worktree; everything under
+            #refs/ is shared by all the worktrees.
+            folder = self.commondir if name.startswith("refs/") else self.gitdir
+            value = _read(path.join(folder, name))
+            if value is None:
+                return self._packed().get(name)
+            if value.startswith("ref: "):
+                name = value[len("ref: "):].strip()
+            else:
+                return value
+
+    def refs(self, prefix="refs/"):
+        """Returns a dictionary of the names of the refs that start with 'prefix'
+        and the SHAs they point to.
+        """
+        from os import path, walk
+        result = dict((k, v) for k, v in self._packed().items() if k.startswith(prefix))
+        if self.valid:
+            for root, dirs, files in walk(path.join(self.commondir, "refs")):
+                for filename in files:
+                    name = path.relpath(path.join(root, filename), self.commondir)
+                    if name.startswith(prefix):
+                        value = _read(path.join(root, filename))
+                        if value is not None and not value.startswith("ref: "):
+                            result[name] = value
+        return result
+
+    def worktrees(self):
+        """Returns a dictionary of the full paths to the worktrees registered in the
+        repository and whether they still exist on disk.
+        """
+        from os import path, listdir
+        result = {}
+        admin = path.join(self.commondir, "worktrees") if self.valid else None
+        if admin is None or not path.isdir(admin):
+            return result
+        for name in listdir(admin):
+            dotgit = _read(path.join(admin, name, "gitdir"))
+            if dotgit is not None:
+                result[path.dirname(dotgit)] = path.isfile(dotgit)
+        return result
+
+    def _packed(self):
+        """Returns a dictionary of the refs in the packed-refs file."""
+        from os import path
+        result = {}
+        if not self.valid or not path.isfile(path.join(self.commondir, "packed-refs")):
+            return result
+        with open(path.join(self.commondir, "packed-refs")) as f:
+            for line in f:
+                #Comments hold the capabilities of the file and '^' lines the
+                #peeled values of annotated tags.
+                if line[0] in "#^":
+                    continue
+                sha, sep, name = line.strip().partition(' ')
+                if sep != '':
+                    result[name] = sha
+        return result
+
+def _read(filepath):
+    """Returns the stripped contents of the file, or None if it doesn't exist."""
+    try:
+        with open(filepath) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def _parse_config(filepath, result):
+    """Adds the values in the git config file to the result dictionary, keyed by
+    their lowered 'section.subsection.key' names.
+    """
+    from os import path
+    if not path.isfile(filepath):
+        return
+    section = None
+    with open(filepath) as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line[0] in "#;":
+                continue
+            if line[0] == '[':
+                header = line[1:line.index(']')]
+                if '"' in header:
+                    name, subsection = header.split('"')[0:2]
+                    section = "{}.{}".format(name.strip().lower(), subsection)
+                else:
+                    section = header.strip().lower()
+                continue
+            key, sep, value = line.partition('=')
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            result["{}.{}".format(section, key.strip().lower())] = value if sep != '' else "true"
+
+class Mirror(object):
+    """A local bare mirror of a github repository and the worktrees that are
+    checked out from it.
+    """
+    def __init__(self, url, folder, depth=None, filter=None, sparse=None):
+        """
+        :arg url: the URL of the repository to mirror.
+        :arg folder: the full path to the bare mirror.
+        :arg depth: the number of commits of history to fetch for each ref; if
+          None, the full history is fetched.
+        :arg filter: the object filter for a partial clone (e.g. 'blob:none'), so
+          that file contents are only downloaded when they are checked out.
+        :arg sparse: a list of paths to check out in the worktrees; if None, the
+          whole tree is checked out.
+        """
+        from threading import RLock
+        self.url = url
+        """The URL of the repository that is mirrored."""
+        self.folder = folder
+        """The full path to the bare mirror."""
+        self.depth = depth
+        """The number of commits of history fetched for each ref, or None."""
+        self.filter = filter
+        """The object filter used when the mirror is cloned, or None."""
+        self.sparse = sparse
+        """The list of paths checked out in the worktrees, or None for all."""
+        self.cycle = None
+        """The processing cycle during which the mirror was last fetched."""
+        self.lock = RLock()
+        """Lock that serializes the git operations on the mirror between the
+        workers that process pull requests of the same repo.
+        """
+
+    def update(self, cycle=None):
+        """Clones the mirror if it doesn't exist yet, otherwise fetches the new
+        commits of all the branches and pull requests. The fetch is skipped if the
+        mirror was already updated during the same cycle.
+
+        :arg cycle: an identifier of the current processing cycle.
+        """
+        with self.lock:
+            if cycle is not None and cycle == self.cycle:
+                return
+            depth = ["--depth", str(self.depth)] if self.depth is not None else []
+            state = GitState(self.folder)
+            if not state.valid:
+                vms("Cloning mirror of {} into {}.".format(self.url, self.folder))
+                #The filter is remembered in the mirror's config; later fetches
+                #and the checkouts of the worktrees respect it automatically.
+                filter = ["--filter={}".format(self.filter)] if self.filter is not None else []
+                #A shallow clone would otherwise only fetch the default branch.
+                single = ["--no-single-branch"] if self.depth is not None else []
+                run_git(["clone", "--mirror"] + depth + single + filter + [self.url, self.folder])
+            else:
+                if self.url is not None and state.remote() != self.url:
+                    #The repository was renamed or moved since the mirror was cloned.
+                    run_git(["remote", "set-url", "origin", self.url], gitdir=self.folder)
+                vms("Fetching {} into the mirror at {}.".format(self.url, self.folder), 2)
+                run_git(["fetch", "--prune"] + depth + ["origin"], gitdir=self.folder)
+            self.cycle = cycle
+
+    def resolve(self, ref):
+        """Returns the SHA of the commit that the ref points to, or None if the
+        ref doesn't exist in the mirror.
+        """
+        return GitState(self.folder).ref(ref)
+
+    def changed(self, base, ref):
+        """Returns the list of paths (relative to the repo root) that changed on
+        the ref since it branched off the base, i.e. the merge-base diff.
+        """
+        output = run_git(["diff", "--name-only", "-z", "--no-renames",
+                          "{}...{}".format(base, ref)], gitdir=self.folder)
+        return [p for p in output.split("\0") if p != ""]
+
+    def is_worktree(self, target):
+        """Returns True if the directory is a worktree checked out from this mirror."""
+        from os import path
+        state = GitState(target)
+        return (state.valid and state.gitdir != state.commondir and
+                path.realpath(state.commondir) == path.realpath(self.folder))
+
+    def checkout(self, target, ref, keep=None, clean="all"):
+        """Checks out the commit that the ref points to in the worktree at 'target'.
+        An existing worktree is reused and cleaned of untracked files; otherwise a
+        new one is added.
+
+        :arg target: the full path to the worktree directory.
+        :arg ref: the name of the ref (e.g. 'refs/pull/1/head') to check out.
+        :arg keep: a list of paths relative to the worktree that shouldn't be
+          removed when the worktree is cleaned.
+        :arg clean: how an existing worktree is cleaned: 'all' removes every
+          untracked file, 'untracked' keeps the files that git ignores (such as
+          build products) and None keeps everything.
+        """
+        from os import path, listdir
+        sha = self.resolve(ref)
+        if sha is None:
+            raise ValueError("The ref '{}' doesn't exist in the mirror {}.".format(ref, self.folder))
+
+        with self.lock:
+            self.prune()
+            if self.is_worktree(target):
+                vms("Checking out {} in the worktree {}.".format(ref, target), 2)
+                self._sparse(target)
+                run_git(["checkout", "--detach", "--force", sha], cwd=target)
+                if clean is not None:
+                    excludes = []
+                    for relpath in keep or []:
+                        excludes.extend(["-e", "/{}".format(path.normpath(relpath))])
+                    flags = "-ffdx" if clean == "all" else "-ffd"
+                    run_git(["clean", flags] + excludes, cwd=target)
+                return sha
+
+            if path.isdir(target) and len(listdir(target)) > 0:
+                if not path.isdir(path.join(target, ".git")):
+                    raise ValueError("The staging directory {} isn't empty and isn't "
+                                     "a git checkout; remove it first.".format(target))
+                #This is a full clone from before the repo had a mirror.
+                from shutil import rmtree
+                vms("Replacing the clone at {} with a worktree.".format(target))
+                rmtree(target)
+
+            vms("Adding the worktree {} for {}.".format(target, ref), 2)
+            if self.sparse is None:
+                run_git(["worktree", "add", "--detach", "--force", target, sha],
+                        gitdir=self.folder)
+            else:
+                #The sparse paths have to be set before anything is checked out.
+                run_git(["worktree", "add", "--detach", "--force", "--no-checkout",
+                         target, sha], gitdir=self.folder)
+                self._sparse(target)
+                run_git(["checkout", "--detach", "--force", sha], cwd=target)
+            return sha
+
+    def merge(self, target, ref):
+        """Merges the commit that the ref points to into the commit checked out in
+        the worktree at 'target'. Returns False (leaving the worktree as it was) if
+        the ref is missing or the merge has conflicts.
+        """
+        sha = self.resolve(ref)
+        if sha is None:
+            return False
+        user = ["-c", "user.name=pyci", "-c", "user.email=pyci@localhost"]
+        try:
+            run_git(user + ["merge", "-q", "--no-edit", "--no-ff", sha], cwd=target)
+            return True
+        except ValueError:
+            vms("Unable to merge {} into the worktree {}.".format(ref, target), 2)
+            run_git(["merge", "--abort"], cwd=target)
+            return False
+
+    def move(self, source, target):
+        """Moves the worktree at 'source' to 'target', which must not exist."""
+        with self.lock:
+            run_git(["worktree", "move", source, target], gitdir=self.folder)
+
+    def remove(self, target):
+        """Removes the worktree at 'target' along with its administrative files in
+        the mirror. Directories that aren't worktrees of the mirror (such as full
+        clones from before the repo had one) are simply deleted.
+        """
+        with self.lock:
+            if self.is_worktree(target):
+                vms("Removing the worktree {}.".format(target), 2)
+                run_git(["worktree", "remove", "--force", target], gitdir=self.folder)
+            else:
+                from shutil import rmtree
+                rmtree(target)
+
+    def _sparse(self, target):
+        """Restricts the worktree to the sparse paths, if there are any."""
+        if self.sparse is not None:
+            run_git(["sparse-checkout", "set"] + self.sparse, cwd=target)
+
+    def prune(self):
+        """Removes the administrative files of worktrees whose directories were
+        deleted. Git is only run if there are any.
+        """
+        with self.lock:
+            if not all(GitState(self.folder).worktrees().values()):
+                run_git(["worktree", "prune"], gitdir=self.folder)
@@ -0,0 +1,181 @@
+"""Provides an optional HTTP endpoint that receives github 'pull_request'
+webhook events so that the CI server only queries the pull requests that
+actually changed instead of polling every installed repository.
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from pyci.msg import vms, warn
+
+actions = ["opened", "reopened", "synchronize"]
+"""The 'pull_request' event actions that require the pull request to be tested.
+"""
+
+def verify_signature(secret, body, header):
+    """Returns True if the signature header sent by github matches the HMAC
+    digest of the request body using the shared secret.
+
+    :arg secret: the shared secret configured for the webhook on github.
+    :arg body: the raw bytes of the request body.
+    :arg header: the value of the 'X-Hub-Signature-256' (or legacy
+      'X-Hub-Signature') header, e.g. 'sha256=abc...'.
+    """
+    import hmac
+    import hashlib
+    if header is None or "=" not in header:
+        return False
+
+    algorithm, signature = header.split("=", 1)
+    if algorithm not in ["sha1", "sha256"]:
+        return False
+    digest = hmac.new(secret, body, getattr(hashlib, algorithm)).hexdigest()
+    return hmac.compare_digest(digest, signature.strip())
+
+class PullQueue(object):
+    """Thread-safe collection of the pull requests that webhook events have
+    flagged for processing. Duplicate events for the same pull request are
+    collapsed into a single entry.
+    """
+    def __init__(self):
+        from threading import Lock, Event
+        self._lock = Lock()
+        self._event = Event()
+        """Set whenever the queue has pending pull requests."""
+        self.pending = {}
+        """Dictionary of lowered repo names and the set of pull request numbers
+        waiting to be processed for each one.
+        """
+
+    def put(self, repokey, number):
+        """Adds the specified pull request to the queue."""
+        with self._lock:
+            self.pending.setdefault(repokey, set()).add(number)
+            self._event.set()
+
+    def drain(self):
+        """Removes all the pending pull requests from the queue and returns them
+        as a dictionary of lowered repo names and sorted lists of numbers.
+        """
+        with self._lock:
+            result = {k: sorted(v) for k, v in self.pending.items()}
+            self.pending = {}
+            self._event.clear()
+        return result
+
+    def wait(self, timeout):
+        """Blocks until a pull request is queued or the timeout (in seconds)
+        elapses. Returns True if there are pending pull requests.
+        """
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Handles the POST requests sent by github for the configured webhook."""
+    def do_POST(self):
+        """Verifies and parses a webhook payload and queues the pull request."""
+        import json
+        length = int(self.headers.getheader("Content-Length", 0))
+        body = self.rfile.read(length)
+        secret = self.server.secret
+        signature = (self.headers.getheader("X-Hub-Signature-256") or
+                     self.headers.getheader("X-Hub-Signature"))
+        if secret is None:
+            if not self.server.insecure:
+                warn("Rejected webhook request; no secret is configured to verify it.")
+                self._respond(403, "Unsigned payloads are not accepted.")
+                return
+        elif not verify_signature(secret, body, signature):
+            warn("Rejected webhook request with an invalid signature.")
+            self._respond(403, "Invalid signature.")
+            return
+
+        event = self.headers.getheader("X-GitHub-Event")
+        if event == "ping":
+            self._respond(200, "pong")
+            return
+        if event != "pull_request":
+            self._respond(202, "Ignored '{}' event.".format(event))
+            return
+
+        try:
+            payload = json.loads(body)
+            action = payload["action"]
+            number = payload["pull_request"]["number"]
+            sha = payload["pull_request"].get("head", {}).get("sha")
+            fullname = payload["repository"]["full_name"]
+        except (ValueError, KeyError, TypeError):
+            self._respond(400, "Malformed pull_request payload.")
+            return
+
+        repokey = self.server.repokey(fullname)
+        if repokey is None:
+            self._respond(202, "Repository '{}' is not installed.".format(fullname))
+        elif action not in actions:
+            self._respond(202, "Ignored '{}' action.".format(action))
+        else:
+            if action == "synchronize" and sha is not None:
+                #The run for the previous head commit is stale; stop it now so its
+                #slots are free for the new commits.
+                self.server.ciserver.supersede(repokey, number, sha)
+            vms("Webhook queued pull request #{} for '{}'.".format(number, repokey))
+            self.server.queue.put(repokey, number)
+            self._respond(202, "Queued pull request #{}.".format(number))
+
+    def _respond(self, code, message):
+        """Sends a plain-text response with the specified HTTP status code."""
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def log_message(self, format, *args):
+        """Routes the request log through the verbose messaging."""
+        vms("Webhook: " + (format % args), 2)
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """HTTP server that listens for github webhook events and queues the pull
+    requests of installed repos for processing by the CI server.
+    """
+    daemon_threads = True
+
+    def __init__(self, server, address, secret=None, insecure=False):
+        """
+        :arg server: the pyci.server.Server instance whose repositories can
+          receive events.
+        :arg address: tuple of (host, port) to listen on. A port of 0 picks
+          a free port.
+        :arg secret: the shared webhook secret; when None, every payload is
+          rejected unless 'insecure' is true.
+        :arg insecure: when true and there is no secret, payloads are accepted
+          without checking their signature.
+        """
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.ciserver = server
+        """The Server instance whose repositories can receive events."""
+        self.secret = secret
+        """The shared secret used to verify the HMAC signature of payloads."""
+        self.insecure = insecure
+        """True if unsigned payloads are accepted when there is no secret."""
+        self.queue = PullQueue()
+        """The PullQueue with the pull requests waiting to be processed."""
+
+    def repokey(self, fullname):
+        """Returns the key of the installed repository matching the full name
+        from the payload, or None if it isn't installed on this server.
+        """
+        lname = fullname.lower()
+        if lname in self.ciserver.repositories:
+            return lname
+        #Repo XML files may specify just the short name of the repository.
+        short = lname.split("/")[-1]
+        if short in self.ciserver.repositories:
+            return short
+
+    def start(self):
+        """Serves requests in a background thread until shutdown() is called."""
+        from threading import Thread
+        thread = Thread(target=self.serve_forever, name="pyci-webhook")
+        thread.daemon = True
+        thread.start()
+        vms("Listening for github webhooks on port {}.".format(self.server_address[1]))
+        return thread
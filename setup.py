@@ -30,7 +30,8 @@ setup(name='pyci',
           "dominate",
           "mwclient",
           "python-crontab",
-          "pygithub"
+          "pygithub",
+          "requests"
       ],
       packages=['pyci'],
       scripts=['pyci/scripts/ci.py'],
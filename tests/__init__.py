@@ -3,11 +3,27 @@
 import tutility
 import tconfig
 import tserver
+import twebhook
+import tclient
+import tarchive
+import tengine
+import tvcs
+import tassets
+import tartifacts
+import tresults
+import tdaemon
 from unittest import TestSuite
 
 test_cases = (tutility.TestUtilities, tconfig.TestServerConfigRead, tconfig.TestCronSettings,
+              tconfig.TestTestingSettings,
               tconfig.TestRepoConfigRead, tserver.TestServerInit, tserver.TestServerProcess,
-              tserver.TestPullRequest, tserver.TestCronManager, tserver.TestWiki)
+              tserver.TestServerCompact, tserver.TestServerSchedule, tserver.TestSnapshot,
+              tserver.TestBatch, tserver.TestFindUpdated,
+              tserver.TestPullRequest, tserver.TestCronManager, tserver.TestWiki,
+              twebhook.TestWebhook, tclient.TestGithubClient,
+              tarchive.TestSqliteArchive, tengine.TestEngine, tvcs.TestMirror,
+              tassets.TestAssetStore, tartifacts.TestArtifactCache,
+              tresults.TestResultCache, tdaemon.TestDaemonLoop)
 
 def load_tests(loader, tests, pattern):
     suite = TestSuite()
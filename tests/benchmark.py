@@ -0,0 +1,123 @@
+#This script times the deserialization of large synthetic archives so that the
+#cost of loading the CI server's JSON files can be compared between decoders.
+import sys
+
+def examples():
+    """Prints examples of using the script to the console using colored output.
+    """
+    script = "Continuous Integration Archive Benchmark"
+    explain = ("The archive of processed pull requests grows without bound, and the "
+               "CI server deserializes it on every cron run. This script writes "
+               "synthetic archives with the specified number of pull requests and "
+               "times how long it takes to load them with the schema-aware decoder "
+               "in pyci.utility and with the legacy decoder that ran dateutil on "
+               "every string value.")
+    contents = [(("Time the loading of archives with 10k and 100k pull requests."),
+                 "benchmark.py 10000 100000",
+                 ("The legacy decoder requires the 'dateutil' package; if it isn't "
+                  "installed, only the current decoder is timed."))]
+    required = ("REQUIRED: a working installation of the code.")
+    output = ("RETURNS: prints the load times to stdout.")
+    details = ""
+    outputfmt = ""
+    from pyci.msg import example
+    example(script, explain, contents, required, output, outputfmt, details)
+
+def _parser_options():
+    """Parses the options and arguments from the command line."""
+    from os import getcwd
+    sys.path.insert(0, getcwd())
+
+    import argparse
+    bparser = argparse.ArgumentParser(add_help=False)
+    bparser.add_argument("-examples", action="store_true",
+                        help="See detailed help and examples for this script.")
+    args = vars(bparser.parse_known_args()[0])
+    if args["examples"]:
+        examples()
+        exit(0)
+
+    parser = argparse.ArgumentParser(parents=[bparser],
+                                     description="CI Server Archive Benchmark")
+    parser.add_argument("counts", nargs="+", type=int,
+                        help="Numbers of archived pull requests to benchmark.")
+    parser.add_argument("-repos", type=int, default=10,
+                        help="Number of repositories to spread the pull requests over.")
+    parser.add_argument("-repeat", type=int, default=3,
+                        help="Number of times to load each archive; the best time is kept.")
+    return vars(parser.parse_known_args()[0])
+
+def _legacy_hook(pairs):
+    """The object hook used before the decoder became schema-aware; it tries to
+    parse every string value as a date.
+    """
+    import dateutil.parser
+    d = {}
+    for k, v in pairs:
+        if isinstance(v, basestring):
+            try:
+                d[k] = dateutil.parser.parse(v)
+            except ValueError:
+                d[k] = v
+        else:
+            d[k] = v
+    return d
+
+def _write_archive(target, count, repos):
+    """Writes a synthetic archive with 'count' pull requests to the target file."""
+    import json
+    from datetime import datetime, timedelta
+    from pyci.utility import json_serial
+    now = datetime.now()
+    archive = {}
+    for i in range(count):
+        repokey = "owner/repo{}".format(i % repos)
+        start = now - timedelta(minutes=i)
+        archive.setdefault(repokey, {})[str(i)] = {
+            "success": i % 7 != 0, "completed": True, "start": start,
+            "finished": start + timedelta(seconds=90), "sha": "{:040x}".format(i),
+            "results": [0, 0, i % 7]}
+    with open(target, 'w') as f:
+        json.dump(archive, f, default=json_serial)
+
+def _time_load(target, hook, repeat):
+    """Returns the best time in seconds to deserialize the target file."""
+    import json
+    from time import time
+    best = None
+    for i in range(repeat):
+        start = time()
+        with open(target) as f:
+            json.load(f, object_pairs_hook=hook)
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _benchmark(args):
+    """Runs the benchmark for each of the requested archive sizes."""
+    from tempfile import mkstemp
+    from os import close, remove
+    from pyci.utility import load_with_datetime
+    from imp import find_module
+    try:
+        find_module("dateutil")
+        legacy = True
+    except ImportError:
+        legacy = False
+
+    for count in args["counts"]:
+        handle, target = mkstemp(suffix=".json")
+        close(handle)
+        try:
+            _write_archive(target, count, args["repos"])
+            current = _time_load(target, load_with_datetime, args["repeat"])
+            line = "{0: >8d} pulls: {1:.3f}s".format(count, current)
+            if legacy:
+                old = _time_load(target, _legacy_hook, args["repeat"])
+                line += " (legacy {0:.3f}s, {1:.1f}x faster)".format(old, old/current)
+            print(line)
+        finally:
+            remove(target)
+
+if __name__ == '__main__':
+    _benchmark(_parser_options())
@@ -0,0 +1,68 @@
+"""Unit tests for the archive storage backends in pyci."""
+import unittest as ut
+from pyci.archive import *
+
+class TestSqliteArchive(ut.TestCase):
+    """Tests the dictionary access pattern, transactional saves and the JSON
+    migration of the SQLite archive backend.
+    """
+    def setUp(self):
+        from os import path, remove
+        from datetime import datetime
+        self.dbpath = path.expanduser("~/codes/ci/tests/outputs/sqlite.db")
+        self.jsonpath = path.expanduser("~/codes/ci/tests/outputs/sqlite.json")
+        for filepath in [self.dbpath, self.jsonpath]:
+            if path.isfile(filepath):
+                remove(filepath)
+        self.model = {"arbitrary": {"1": {"success": True, "number": 1, "completed": True,
+                                          "start": datetime(2015, 4, 23, 13, 5),
+                                          "finished": datetime(2015, 4, 23, 13, 9),
+                                          "stage": "~/codes/ci/tests/repo"}}}
+
+    def tearDown(self):
+        from os import path, remove
+        for filepath in [self.dbpath, self.jsonpath]:
+            if path.isfile(filepath):
+                remove(filepath)
+
+    def test_get_store(self):
+        """Tests that the backend is selected by the file extension."""
+        self.assertIsInstance(get_store(self.jsonpath), JsonStore)
+        self.assertIsInstance(get_store(self.dbpath), SqliteStore)
+
+    def test_migrate(self):
+        """Tests the one-shot migration of an existing JSON archive."""
+        JsonStore(self.jsonpath).save(self.model)
+        archive = SqliteStore(self.dbpath).load()
+        self.assertEqual(archive, self.model)
+
+    def test_access(self):
+        """Tests that the nested dictionary access pattern used by the server
+        works and that only modified entries are written on save.
+        """
+        from datetime import datetime
+        store = SqliteStore(self.dbpath)
+        archive = store.load()
+        archive["arbitrary"] = {}
+        self.assertIn("arbitrary", archive)
+        self.assertNotIn("1", archive["arbitrary"])
+
+        archive["arbitrary"]["1"] = {"success": False, "number": 1, "completed": False,
+                                     "start": datetime(2015, 4, 23, 13, 5), "finished": None,
+                                     "stage": "~/codes/ci/tests/repo"}
+        store.save(archive)
+        self.assertEqual(store.dirty, {})
+        entry = archive["arbitrary"]["1"]
+        entry["completed"] = True
+        entry["success"] = True
+        entry["finished"] = datetime(2015, 4, 23, 13, 9)
+        self.assertEqual(list(store.dirty), [("arbitrary", "1")])
+        store.save(archive)
+
+        #A new store instance reads the values back from the database.
+        reloaded = SqliteStore(self.dbpath).load()
+        self.assertEqual(reloaded, self.model)
+        self.assertEqual(len(reloaded["arbitrary"]), 1)
+
+        del reloaded["arbitrary"]
+        self.assertEqual(len(SqliteStore(self.dbpath).load()), 0)
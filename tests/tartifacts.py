@@ -0,0 +1,69 @@
+"""Unit tests for the cache of build products."""
+import unittest as ut
+from pyci.artifacts import *
+
+class TestArtifactCache(ut.TestCase):
+    """Tests the keys, restoration and eviction of cached build folders."""
+    def setUp(self):
+        from tempfile import mkdtemp
+        from os import path, makedirs
+        self.folder = mkdtemp()
+        self.cache = ArtifactCache(path.join(self.folder, "cache"), 100)
+        self.stages = [path.join(self.folder, "stage_{}".format(i)) for i in range(3)]
+        for stage in self.stages:
+            makedirs(path.join(stage, "build"))
+            self._write(stage, "Makefile", "all:\n")
+            self._write(stage, "build/lib.so", "x"*40)
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def _write(self, stage, relpath, contents):
+        """Writes the contents to the file relative to the staging directory."""
+        from os import path
+        with open(path.join(stage, relpath), 'w') as f:
+            f.write(contents)
+
+    def _key(self, stage):
+        """Returns the cache key of the build folder in the staging directory."""
+        return self.cache.key("owner/repo", "./build", ["./Makefile", "./missing.txt"], stage)
+
+    def test_restore(self):
+        """Tests that a saved build folder is restored when the key files match."""
+        from os import path
+        from shutil import rmtree
+        key = self._key(self.stages[0])
+        self.assertEqual(key, self._key(self.stages[1]))
+        self.cache.save(key, path.join(self.stages[0], "build"), "owner/repo", "./build")
+        self.assertEqual(self.cache.size, 40)
+
+        #Existing folders are not replaced.
+        self.assertFalse(self.cache.restore(key, path.join(self.stages[1], "build")))
+        rmtree(path.join(self.stages[1], "build"))
+        self.assertTrue(self.cache.restore(key, path.join(self.stages[1], "build")))
+        with open(path.join(self.stages[1], "build", "lib.so")) as f:
+            self.assertEqual(f.read(), "x"*40)
+
+        self._write(self.stages[2], "Makefile", "all: lib.so\n")
+        self.assertNotEqual(key, self._key(self.stages[2]))
+        self.assertEqual(ArtifactCache(self.cache.folder, 100).index, self.cache.index)
+
+    def test_evict(self):
+        """Tests that the least recently used entries are evicted to stay within
+        the disk budget.
+        """
+        from os import path
+        from time import sleep
+        keys = []
+        for i, stage in enumerate(self.stages):
+            self._write(stage, "Makefile", "all: {}\n".format(i))
+            keys.append(self._key(stage))
+        self.cache.save(keys[0], path.join(self.stages[0], "build"))
+        self.cache.save(keys[1], path.join(self.stages[1], "build"))
+        sleep(0.01)
+        self.assertTrue(self.cache.restore(keys[0], path.join(self.folder, "restored")))
+        self.cache.save(keys[2], path.join(self.stages[2], "build"))
+        self.assertEqual(sorted(self.cache.index), sorted([keys[0], keys[2]]))
+        self.assertFalse(path.isdir(self.cache.entrypath(keys[1])))
+        self.assertLessEqual(self.cache.size, 100)
@@ -0,0 +1,107 @@
+"""Unit tests for the content-addressed store of static files."""
+import unittest as ut
+from pyci.assets import *
+
+class TestAssetStore(ut.TestCase):
+    """Tests the fingerprinting of static files and their materialization in
+    staging directories.
+    """
+    def setUp(self):
+        from tempfile import mkdtemp
+        from os import path, makedirs
+        self.folder = mkdtemp()
+        self.source = path.join(self.folder, "static")
+        makedirs(path.join(self.source, "inputs"))
+        for relpath, contents in [("inputs/a.dat", "1 2 3\n"), ("inputs/b.dat", "1 2 3\n"),
+                                  ("model.out", "result\n")]:
+            with open(path.join(self.source, relpath), 'w') as f:
+                f.write(contents)
+        self.store = AssetStore(path.join(self.folder, "assets"))
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def test_copy(self):
+        """Tests that linked files share a single object per content and that
+        unchanged sources aren't hashed again.
+        """
+        from os import path, stat
+        import pyci.assets as assets
+        staging = [path.join(self.folder, "staging_{}".format(i)) for i in range(2)]
+        for target in staging:
+            self.store.copy(self.source, target, link=True)
+        self.store.copy(path.join(self.source, "model.out"), path.join(staging[0], "model.txt"),
+                        link=True)
+
+        a, b = [path.join(staging[1], "inputs", f) for f in ["a.dat", "b.dat"]]
+        with open(b) as f:
+            self.assertEqual(f.read(), "1 2 3\n")
+        self.assertTrue(path.samefile(a, b))
+        self.assertTrue(path.samefile(a, path.join(staging[0], "inputs", "a.dat")))
+        self.assertTrue(path.samefile(path.join(staging[0], "model.txt"),
+                                      path.join(staging[1], "model.out")))
+        self.assertEqual(stat(a).st_nlink, 5)
+        self.assertEqual(len(self.store.manifest["objects"]), 2)
+
+        #The manifest is persisted and the sources are not read again.
+        self.store.save()
+        store = AssetStore(self.store.folder)
+        self.assertEqual(store.manifest, self.store.manifest)
+        hashed = []
+        original = assets.hash_file
+        assets.hash_file = lambda filepath: hashed.append(filepath) or original(filepath)
+        try:
+            store.copy(self.source, staging[0], link=True)
+            self.assertEqual(hashed, [])
+            with open(path.join(self.source, "model.out"), 'a') as f:
+                f.write("changed\n")
+            store.copy(self.source, staging[0], link=True)
+            self.assertEqual(hashed, [path.realpath(path.join(self.source, "model.out"))])
+        finally:
+            assets.hash_file = original
+        with open(path.join(staging[0], "model.out")) as f:
+            self.assertEqual(f.read(), "result\nchanged\n")
+
+    def test_modified(self):
+        """Tests that an object that was changed through one of its links is
+        replaced by the contents of the source again.
+        """
+        from os import path, chmod
+        target = path.join(self.folder, "staging")
+        self.store.copy(self.source, target, link=True)
+        staged = path.join(target, "model.out")
+        chmod(staged, 0644)
+        with open(staged, 'w') as f:
+            f.write("overwritten by a test\n")
+
+        self.store.copy(self.source, path.join(self.folder, "other"), link=True)
+        with open(path.join(self.folder, "other", "model.out")) as f:
+            self.assertEqual(f.read(), "result\n")
+
+    def test_writable(self):
+        """Tests that files get their own writable copy in each staging directory,
+        so that a write in one of them doesn't reach the others or the store.
+        """
+        from os import path, access, W_OK
+        staging = [path.join(self.folder, "staging_{}".format(i)) for i in range(2)]
+        for target in staging:
+            self.store.copy(self.source, target)
+        first, second = [path.join(s, "model.out") for s in staging]
+        self.assertFalse(path.samefile(first, second))
+        self.assertTrue(access(first, W_OK))
+        with open(first, 'a') as f:
+            f.write("written by a test\n")
+        with open(second) as f:
+            self.assertEqual(f.read(), "result\n")
+
+        #The changed copy is replaced when the directory is staged again; the
+        #untouched one is kept as it is.
+        before = path.getmtime(second)
+        for target in staging:
+            self.store.copy(self.source, target)
+        with open(first) as f:
+            self.assertEqual(f.read(), "result\n")
+        self.assertEqual(path.getmtime(second), before)
+        digest = self.store.add(path.join(self.source, "model.out"))
+        self.assertTrue(self.store._intact(digest, len("result\n")))
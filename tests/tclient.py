@@ -0,0 +1,166 @@
+"""Unit tests for the conditional-request github client in pyci."""
+import unittest as ut
+from pyci.client import *
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Serves a two-page listing of pull requests and a repo resource with
+    ETag validation, the way the github API does.
+    """
+    def do_GET(self):
+        import json
+        self.server.requests.append(self.path)
+        if self.path not in self.server.pages:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body, next_page = self.server.pages[self.path]
+        etag = '"{}"'.format(abs(hash(self.path)))
+        if self.headers.getheader("If-None-Match") == etag:
+            self.server.hits += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        text = json.dumps(body)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", str(self.server.remaining))
+        self.send_header("X-RateLimit-Reset", "9999999999")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(text)))
+        if next_page is not None:
+            port = self.server.server_address[1]
+            self.send_header("Link", '<http://127.0.0.1:{}/{}>; rel="next"'.format(port, next_page))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestGithubClient(ut.TestCase):
+    """Tests the ETag validation, pagination and TTL behavior of the client
+    against a local fake of the github API.
+    """
+    @classmethod
+    def setUpClass(self):
+        from threading import Thread
+        self.api = HTTPServer(("127.0.0.1", 0), FakeApiHandler)
+        self.api.requests = []
+        self.api.hits = 0
+        self.api.pages = {}
+        thread = Thread(target=self.api.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:{}".format(self.api.server_address[1])
+
+    @classmethod
+    def tearDownClass(self):
+        self.api.shutdown()
+        self.api.server_close()
+
+    def setUp(self):
+        self.api.requests = []
+        self.api.hits = 0
+        self.api.remaining = 4999
+        repo = {"id": 7, "full_name": "org/repo", "html_url": "https://github.com/org/repo",
+                "clone_url": "https://github.com/org/repo.git"}
+        self.api.pages = {"/repos/org/repo/pulls?state=open&per_page=100": ([{"number": 1}], "page2"),
+                          "/page2": ([{"number": 2}], None),
+                          "/repos/org/meta": ({"full_name": "org/meta"}, None),
+                          "/repos/org/repo": (repo, None),
+                          "/repositories/7": (repo, None)}
+
+    def test_conditional(self):
+        """Tests that the second listing of the paginated pulls is answered with
+        304s from the cache and that the cache survives a round trip to disk.
+        """
+        from os import path, remove
+        cachepath = path.expanduser("~/codes/ci/tests/cache.json")
+        if path.isfile(cachepath):
+            remove(cachepath)
+
+        client = GithubClient("user", "key", ResponseCache(cachepath), base_url=self.url)
+        path_ = "/repos/org/repo/pulls?state=open&per_page=100"
+        self.assertEqual(client.get_list(path_), [{"number": 1}, {"number": 2}])
+        self.assertEqual(self.api.hits, 0)
+        client.cache.save()
+
+        reloaded = GithubClient("user", "key", ResponseCache(cachepath), base_url=self.url)
+        self.assertEqual(reloaded.get_list(path_), [{"number": 1}, {"number": 2}])
+        self.assertEqual(self.api.hits, 2)
+        self.assertEqual(len(self.api.requests), 4)
+        self.assertFalse(path.isfile(cachepath + ".tmp"))
+
+        #Another user sharing the cache file must not be served these responses.
+        other = GithubClient("other", "key2", reloaded.cache, ttl=3600, base_url=self.url)
+        self.assertEqual(other.get_list(path_), [{"number": 1}, {"number": 2}])
+        self.assertEqual(self.api.hits, 2)
+        self.assertEqual(len(self.api.requests), 6)
+        remove(cachepath)
+
+    def test_ttl(self):
+        """Tests that metadata within the TTL is served without any request."""
+        client = GithubClient("user", "key", ttl=3600, base_url=self.url)
+        self.assertEqual(client.get_metadata("/repos/org/meta"), {"full_name": "org/meta"})
+        self.assertEqual(client.get_metadata("/repos/org/meta"), {"full_name": "org/meta"})
+        self.assertEqual(self.api.requests, ["/repos/org/meta"])
+
+        #With an expired TTL, the request is validated with the ETag instead.
+        client.ttl = 0
+        client.get_metadata("/repos/org/meta")
+        self.assertEqual(self.api.hits, 1)
+
+    def test_get_repo(self):
+        """Tests the direct repository lookup by name, its validation by id on
+        later lookups and the invalidation of the index after a rename.
+        """
+        repos = RepoIndex()
+        client = GithubClient("user", "key", base_url=self.url, repos=repos)
+        self.assertEqual(client.get_repo("org/repo").id, 7)
+        self.assertEqual(self.api.requests, ["/repos/org/repo"])
+        self.assertEqual(repos.get("Org/Repo")["clone_url"], "https://github.com/org/repo.git")
+
+        #A fresh client (e.g. a new process) validates the cached id instead.
+        self.api.requests = []
+        client = GithubClient("user", "key", base_url=self.url, repos=repos)
+        self.assertEqual(client.get_repo("org/repo").full_name, "org/repo")
+        self.assertEqual(self.api.requests, ["/repositories/7"])
+
+        #After a rename, the old name no longer resolves and the entry is dropped.
+        renamed = dict(self.api.pages["/repos/org/repo"][0], full_name="org/renamed")
+        self.api.pages["/repositories/7"] = (renamed, None)
+        del self.api.pages["/repos/org/repo"]
+        client = GithubClient("user", "key", base_url=self.url, repos=repos)
+        self.assertRaises(ValueError, client.get_repo, "org/repo")
+        self.assertIsNone(repos.get("org/repo"))
+
+    def test_registry(self):
+        """Tests that repos sharing credentials share a single client and that
+        the rate limit status is tracked on it.
+        """
+        import pyci.client
+        from pyci.config import GlobalSettings
+        settings = GlobalSettings(True)
+        settings._vardict["CACHEFILE"] = "~/codes/ci/tests/nocache.json"
+        settings._vardict["REPOCACHE"] = "~/codes/ci/tests/norepos.json"
+        a = get_client("user", "key", settings)
+        self.assertIs(a, get_client("user", "key", settings))
+        b = get_client("other", "key2", settings)
+        self.assertIsNot(a, b)
+        self.assertIs(a.cache, b.cache)
+        self.assertIs(a.repos, b.repos)
+        pyci.client.clients = {}
+        pyci.client.caches = {}
+
+        client = GithubClient("user", "key", base_url=self.url)
+        #Nothing is known about the rate limit before the first response.
+        self.assertEqual(client.rate_limiting, (None, None))
+        self.assertFalse(client.throttled)
+        client.get("/repos/org/meta")
+        self.assertEqual(client.rate_limiting, (4999, 5000))
+        self.assertFalse(client.throttled)
+        self.api.remaining = 0
+        client.get("/repos/org/repo")
+        self.assertTrue(client.throttled)
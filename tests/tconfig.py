@@ -17,6 +17,9 @@ class TestServerConfigRead(ut.TestCase):
         self.settings._vardict["DATAFILE"] = "~/codes/ci/tests/data.json"
         self.settings._vardict["ARCHFILE"] = "~/codes/ci/tests/archive.json"
         self.settings._vardict["VENV"] = "ci"
+        self.settings._vardict["ASSETDIR"] = "~/codes/ci/tests/outputs/assets"
+        self.settings._vardict["ARTIFACTDIR"] = "~/codes/ci/tests/outputs/artifacts"
+        self.settings._vardict["RESULTDIR"] = "~/codes/ci/tests/outputs/results"
         self.settings._initialized = True
 
     def _dict_compare(self, a, b):
@@ -61,6 +64,63 @@ class TestCronSettings(ut.TestCase):
         read = CronSettings(self.xml)
         self.assertEqual(read, self.model)
         
+class TestTestingSettings(ut.TestCase):
+    """Tests the dependencies between the <command> tags of the <testing> tag.
+    """
+    def _xml(self, commands, matrix=None):
+        import xml.etree.ElementTree as ET
+        xml = ET.Element("testing")
+        if matrix is not None:
+            child = ET.SubElement(xml, "matrix")
+            for name, values in matrix:
+                ET.SubElement(child, "variable", {"name": name, "values": values})
+        for text, attrib in commands:
+            child = ET.SubElement(xml, "command", attrib)
+            child.text = text
+        return xml
+
+    def test_needs(self):
+        """Tests the parsing of the 'id' and 'needs' attributes and the rejection
+        of unknown ids and cycles.
+        """
+        read = TestingSettings(self._xml([("make", {"id": "build"}),
+                                          ("make check", {"needs": "build"}),
+                                          ("make docs", {"id": "docs", "needs": " build, "})]))
+        self.assertEqual([t["id"] for t in read.tests], ["build", None, "docs"])
+        self.assertEqual([t["needs"] for t in read.tests], [[], ["build"], ["build"]])
+
+        self.assertRaises(ValueError, TestingSettings,
+                          self._xml([("make check", {"needs": "build"})]))
+        self.assertRaises(ValueError, TestingSettings,
+                          self._xml([("a", {"id": "a", "needs": "b"}),
+                                     ("b", {"id": "b", "needs": "a"})]))
+
+    def test_matrix(self):
+        """Tests the expansion of commands over the <matrix> variables and the
+        matching of the needs of the expanded cells.
+        """
+        xml = self._xml([("make FC=@FC", {"id": "build"}),
+                         ("@PYTHON test.py --fc=@FC", {"needs": "build"}),
+                         ("make docs", {"needs": "build"})],
+                        [("FC", "gfortran, ifort"), ("PY", "2"), ("PYTHON", "python2, python3")])
+        read = TestingSettings(xml)
+        self.assertEqual([t["command"] for t in read.tests],
+                         ["make FC=gfortran", "make FC=ifort",
+                          "python2 test.py --fc=gfortran", "python3 test.py --fc=gfortran",
+                          "python2 test.py --fc=ifort", "python3 test.py --fc=ifort",
+                          "make docs"])
+        self.assertEqual(read.tests[0]["id"], "build[FC=gfortran]")
+        self.assertEqual(read.tests[4]["needs"], ["build[FC=ifort]"])
+        self.assertEqual(read.tests[6]["needs"], ["build[FC=gfortran]", "build[FC=ifort]"])
+        self.assertEqual(read.format_cell(read.tests[3]), "FC=gfortran, PYTHON=python3")
+        self.assertIsNone(read.tests[6]["cell"])
+
+        self.assertIn("<th>Cell</th>", read.html(False))
+        self.assertIn(" - Cell:  FC=ifort", read.text(False))
+        self.assertNotIn("Cell", TestingSettings(self._xml([("make", {})])).html(False))
+        self.assertRaises(ValueError, TestingSettings,
+                          self._xml([("make FC=@FC", {})], [("FC", " , ")]))
+
 class TestRepoConfigRead(ut.TestCase):
     """Tests the importing of the repo settings XML file."""
     def setUp(self):
@@ -75,6 +135,7 @@ class TestRepoConfigRead(ut.TestCase):
         self.target.apikey = "[key]"
         self.target.organization = "custom-org"
         self.target.staging = "~/codes/ci/tests/repo"
+        self.target.mirror = "~/codes/ci/tests/repo.git"
 
         self.target.testing = TestingSettings()
         self.target.testing.timeout = 120
@@ -85,13 +146,17 @@ class TestRepoConfigRead(ut.TestCase):
             self.target.testing.tests.append(
                 {"command": c, "end": None,
                  "success": False, "code": None,
-                 "start": None, "result": None})
+                 "start": None, "result": None,
+                 "timeout": None, "slots": 1, "id": None, "needs": [],
+                 "paths": [], "cell": None})
 
         self.target.static = StaticSettings()
         self.target.static.files.append(
-            {"source": "~/codes/ci/tests/static/file.txt", "target": "./file.txt"})
+            {"source": "~/codes/ci/tests/static/file.txt", "target": "./file.txt",
+             "link": False})
         self.target.static.folders.append(
-            {"source": "~/codes/ci/tests/static/folder", "target": "./folder"})
+            {"source": "~/codes/ci/tests/static/folder", "target": "./folder",
+             "link": False})
 
         self.target.wiki["user"] = "wikibot"
         self.target.wiki["password"] = "botpassword"
@@ -0,0 +1,79 @@
+"""Unit tests for the long-running daemon loop of the ci.py script."""
+import unittest as ut
+
+def get_ci_script():
+    """Returns the ci.py script loaded as a module; it ships as a script
+    rather than as part of the pyci package.
+    """
+    from os import path
+    import imp
+    scriptpath = path.join(path.dirname(path.abspath(__file__)), "..", "pyci", "scripts", "ci.py")
+    return imp.load_source("pyci_ci_script", scriptpath)
+
+class FakeSettings(object):
+    """Subset of the properties of pyci.config.GlobalSettings that the daemon
+    loop uses.
+    """
+    def __init__(self, datafile):
+        self.datafile = datafile
+        self.compactfreq = 24
+
+class FakeCron(object):
+    """Cron manager without any per-repo settings, so every repo is due."""
+    def __init__(self):
+        self.settings = {}
+
+class FakeRepo(object):
+    """Repository settings with only the name that the cron lookup uses."""
+    def __init__(self, name):
+        self.name = name
+
+class FlakyServer(object):
+    """Server whose reload and process_pulls raise the first time they are
+    called, as they do for a repo file being edited or a github outage.
+    """
+    def __init__(self, ci):
+        self.ci = ci
+        self.repositories = {"arbitrary": FakeRepo("arbitrary")}
+        self.cron = FakeCron()
+        self.runnable = None
+        self.reloads = 0
+        self.processed = 0
+
+    def reload(self):
+        self.reloads += 1
+        if self.reloads == 1:
+            raise ValueError("Malformed XML in repo file.")
+        return False
+
+    def compact(self):
+        return 0
+
+    def process_pulls(self, numbers=None):
+        self.processed += 1
+        if self.processed == 1:
+            raise IOError("502 Bad Gateway")
+        #The second pass succeeded; stop the daemon as SIGTERM would.
+        self.ci.stopping = True
+
+class TestDaemonLoop(ut.TestCase):
+    """Tests that errors in a pass of the daemon's loop don't stop it."""
+    def setUp(self):
+        from tempfile import mkdtemp
+        from os import path
+        self.folder = mkdtemp()
+        self.ci = get_ci_script()
+        self.ci.settings = FakeSettings(path.join(self.folder, "data.json"))
+        self.ci.args = {"nolive": False}
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def test_errors(self):
+        """Tests that the loop keeps going after reload and process_pulls raise."""
+        server = FlakyServer(self.ci)
+        self.ci._daemon_loop(server, None, 0, maxsleep=0)
+        self.assertEqual(3, server.reloads)
+        self.assertEqual(2, server.processed)
+        self.assertIsNotNone(self.ci.db["status"]["arbitrary"]["end"])
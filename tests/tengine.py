@@ -0,0 +1,171 @@
+"""Unit tests for the subprocess engine that runs the test commands."""
+import unittest as ut
+from pyci.engine import *
+
+class TestEngine(ut.TestCase):
+    """Tests the launching of commands and the collection of their output."""
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def _run(self, commands, env=None):
+        """Runs the shell commands to completion; returns the Command instances."""
+        from os import path
+        engine = Engine()
+        result = [Command(i, c, self.folder, path.join(self.folder, "{}.cidat".format(i)), env)
+                  for i, c in enumerate(commands)]
+        for command in result:
+            engine.launch(command)
+        finished = []
+        while len(engine.running) > 0:
+            finished.extend(engine.poll(0.5))
+        self.assertEqual(sorted(c.index for c in finished), list(range(len(commands))))
+        return result
+
+    def test_output(self):
+        """Tests that the commands run in their folder and that their output and
+        exit codes are collected.
+        """
+        from os import path
+        commands = ["pwd", "seq 1 20000", "echo quiet >&2; exit 3"]
+        first, second, third = self._run(commands)
+        with open(first.output) as f:
+            self.assertEqual(path.realpath(f.read().strip()), path.realpath(self.folder))
+        with open(second.output) as f:
+            self.assertEqual(f.read().split(), [str(i) for i in range(1, 20001)])
+        self.assertEqual(first.code, 0)
+        self.assertEqual(third.code, 3)
+        self.assertIsNotNone(third.end)
+        self.assertGreaterEqual(third.end, third.start)
+
+    def test_env(self):
+        """Tests that the commands get the specified environment variables."""
+        command, = self._run(["echo $PYCI_PULL"], {"PYCI_PULL": "12", "PATH": "/bin:/usr/bin"})
+        with open(command.output) as f:
+            self.assertEqual(f.read().strip(), "12")
+
+    def test_kill(self):
+        """Tests that killing a command also kills the processes it spawned."""
+        from os import path
+        from time import time
+        engine = Engine()
+        command = Command(0, "sleep 30 & sleep 30", self.folder,
+                          path.join(self.folder, "0.cidat"))
+        engine.launch(command)
+        start = time()
+        command.kill()
+        while len(engine.running) > 0:
+            engine.poll(0.5)
+        self.assertLess(time() - start, 10)
+        self.assertLess(command.code, 0)
+        #The orphaned background sleep stays in the group until init reaps it.
+        until = time() + 10
+        while command.kill(0) and time() < until:
+            engine.poll(0.1)
+        self.assertFalse(command.kill())
+
+    def test_bounded(self):
+        """Tests that only the head and tail of a chatty command are kept, that
+        stderr is captured and that the output can be compressed.
+        """
+        import gzip
+        from os import path
+        engine = Engine()
+        command = Command(0, "seq 1 100000; echo failed >&2", self.folder,
+                          path.join(self.folder, "0.cidat"), head=100, tail=50, compress=True)
+        engine.launch(command)
+        while len(engine.running) > 0:
+            engine.poll(0.5)
+
+        self.assertTrue(command.output.endswith(".gz"))
+        with gzip.open(command.output) as f:
+            contents = f.read()
+        expected = ''.join("{}\n".format(i) for i in range(1, 100001)) + "failed\n"
+        self.assertEqual(command.bytes, len(expected))
+        self.assertTrue(contents.startswith(expected[:100]))
+        self.assertTrue(contents.endswith(expected[-50:]))
+        self.assertIn("[{} bytes omitted]".format(len(expected) - 150), contents)
+        self.assertEqual(command.tail(7), "failed\n")
+
+    def test_tail_gap(self):
+        """Tests that the live tail only reaches into the head while no bytes were
+        dropped between them.
+        """
+        from os import path
+        store = OutputStore(path.join(self.folder, "0.cidat"), head=4, tail=4)
+        store.write("abcd")
+        store.write("efgh")
+        self.assertEqual(store.read_tail(6), "cdefgh")
+        for i in range(70):
+            store.write("x"*1000)
+        store.write("done")
+        self.assertTrue(store.omitted > 0)
+        live = store.read_tail(10**6)
+        self.assertFalse(live.startswith("abcd"))
+        self.assertTrue(live.endswith("x"*10 + "done"))
+        store.close()
+
+    def test_live_tail(self):
+        """Tests that the tail of the output can be read while the command runs."""
+        from os import path
+        from time import time
+        engine = Engine()
+        command = Command(0, "echo started; sleep 30", self.folder,
+                          path.join(self.folder, "0.cidat"), head=10, tail=10)
+        engine.launch(command)
+        try:
+            until = time() + 10
+            while command.tail() == '' and time() < until:
+                engine.poll(0.1)
+            self.assertEqual(command.tail(), "started\n")
+            self.assertEqual(len(engine.running), 1)
+        finally:
+            command.kill()
+            while len(engine.running) > 0:
+                engine.poll(0.5)
+
+    def test_session(self):
+        """Tests that each command leads its own process group, whether or not
+        the 'setsid' program is available.
+        """
+        import distutils.spawn
+        first, = self._run(["echo $$ $(ps -o pgid= -p $$)"])
+        with open(first.output) as f:
+            pid, pgid = f.read().split()
+        self.assertEqual(int(pid), first.process.pid)
+        self.assertEqual(pgid, pid)
+
+        #Without the 'setsid' program, the python shim starts the session.
+        original = distutils.spawn.find_executable
+        distutils.spawn.find_executable = lambda name: None
+        try:
+            second, = self._run(["echo $$ $(ps -o pgid= -p $$)"])
+        finally:
+            distutils.spawn.find_executable = original
+        with open(second.output) as f:
+            pid, pgid = f.read().split()
+        self.assertEqual(int(pid), second.process.pid)
+        self.assertEqual(pgid, pid)
+
+    def test_drain(self):
+        """Tests that collecting the output of a command that exited doesn't
+        wait on a process it left behind that keeps writing to the pipe.
+        """
+        from os import path
+        from time import time
+        engine = Engine()
+        command = Command(0, "(while true; do echo more; done) & echo started", self.folder,
+                          path.join(self.folder, "0.cidat"))
+        engine.launch(command)
+        try:
+            start = time()
+            while len(engine.running) > 0:
+                engine.poll(0.1)
+            self.assertLess(time() - start, 10)
+            self.assertEqual(command.code, 0)
+        finally:
+            command.kill()
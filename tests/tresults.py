@@ -0,0 +1,36 @@
+"""Unit tests for the cache of test command results."""
+import unittest as ut
+from pyci.results import *
+
+class TestResultCache(ut.TestCase):
+    """Tests the keys, recording and lookup of cached test results."""
+    def setUp(self):
+        from tempfile import mkdtemp
+        from os import path
+        self.folder = mkdtemp()
+        self.cache = ResultCache(path.join(self.folder, "cache"), 1024)
+        self.output = path.join(self.folder, "0.cidat")
+        with open(self.output, 'w') as f:
+            f.write("3 passed\n")
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def test_record(self):
+        """Tests that a recorded result is found again under the same tree,
+        command and environment, and that its output is restored.
+        """
+        from os import path
+        key = self.cache.command_key("abc", "make check", {"FC": "gfortran"})
+        self.assertNotEqual(key, self.cache.command_key("abd", "make check", {"FC": "gfortran"}))
+        self.assertNotEqual(key, self.cache.command_key("abc", "make check", {"FC": "ifort"}))
+        self.assertIsNone(self.cache.lookup(key))
+
+        self.cache.record(key, 1, self.output, 9, "owner/repo", "make check")
+        entry = ResultCache(self.cache.folder, 1024).lookup(key)
+        self.assertEqual((entry["code"], entry["bytes"]), (1, 9))
+        target = self.cache.copy_output(key, path.join(self.folder, "5.cidat"))
+        self.assertEqual(target, path.join(self.folder, "5.cidat"))
+        with open(target) as f:
+            self.assertEqual(f.read(), "3 passed\n")
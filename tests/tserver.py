@@ -63,6 +63,24 @@ class TestServerInit(ut.TestCase):
             {"arbitrary": RepositorySettings(server, path.expanduser("~/codes/ci/tests/repo.xml"))},
             server.repositories)
 
+    def test_reload(self):
+        """Tests that the server only re-reads its settings when one of the
+        configuration files changes on disk.
+        """
+        from os import path, stat, utime
+        server = get_testing_server(archpath="~/codes/ci/tests/none.json")
+        self.assertFalse(server.reload())
+
+        xmlpath = path.expanduser("~/codes/ci/tests/repo.xml")
+        mtime = stat(xmlpath).st_mtime
+        utime(xmlpath, (mtime, mtime + 10))
+        try:
+            self.assertTrue(server.reload())
+            self.assertFalse(server.reload())
+            self.assertIn("arbitrary", server.repositories)
+        finally:
+            utime(xmlpath, (mtime, mtime))
+
     def test_bogus(self):
         """Tests whether the initialization fails when no valid data is given.
         """
@@ -193,6 +211,369 @@ class TestServerProcess(ut.TestCase):
             model = eval(f.read())
         self.assertEqual(self.server.archive, model)        
 
+class TestServerCompact(ut.TestCase):
+    """Tests the compaction of archive entries for closed pull requests."""
+    def setUp(self):
+        from os import path, makedirs
+        from datetime import datetime
+        self.server = get_testing_server(archpath="~/codes/ci/tests/outputs/compact.json")
+        self.stage = path.expanduser("~/codes/ci/tests/outputs/stage2")
+        if not path.isdir(self.stage):
+            makedirs(self.stage)
+        self.result = path.join(self.stage, "0.cidat")
+        with open(self.result, 'w') as f:
+            f.write("output")
+        #The staging directory of a closed pull request that no open one uses.
+        self.orphan = path.expanduser("~/codes/ci/tests/outputs/stage3")
+        if not path.isdir(self.orphan):
+            makedirs(self.orphan)
+        self.orphaned = path.join(self.orphan, "0.cidat")
+        with open(self.orphaned, 'w') as f:
+            f.write("output")
+
+        def entry(number, day, stage=None, results=None):
+            return {"success": True, "start": datetime(2015, 4, day, 13, 5),
+                    "number": number, "stage": stage, "completed": True,
+                    "finished": datetime(2015, 4, day, 13, 9), "results": results}
+        self.server.archive = {"arbitrary": {
+            "1": entry(1, 20, self.stage),
+            "2": entry(2, 21, self.stage, [self.result]),
+            "3": entry(3, 22, self.orphan, [self.orphaned]),
+            "4": entry(4, 1)}}
+
+    def tearDown(self):
+        from os import path, remove
+        from shutil import rmtree
+        for folder in [self.stage, self.orphan]:
+            if path.isdir(folder):
+                rmtree(folder)
+        if path.isfile(self.server.archpath):
+            remove(self.server.archpath)
+
+    def test_compact(self):
+        """Tests that closed pull requests are summarized, their outputs removed
+        and the retention limit enforced while open ones stay untouched.
+        """
+        from os import path
+        #The cron settings are keyed by the repo name in its original case.
+        self.server.repositories["arbitrary"].name = "Arbitrary"
+        cron = self.server.cron.settings.pop("arbitrary")
+        self.server.cron.settings["Arbitrary"] = cron
+        cron.keep = 2
+        count = self.server.compact({"arbitrary": [1]})
+        archive = self.server.archive["arbitrary"]
+        self.assertEqual(count, 4)
+        self.assertEqual(sorted(archive), ["1", "2", "3"])
+        self.assertNotIn("compact", archive["1"])
+        self.assertTrue(archive["2"]["compact"])
+        self.assertNotIn("stage", archive["2"])
+        #The staging directory and the outputs in it are still used by the open
+        #pull request; only those of the orphaned stage are removed.
+        self.assertTrue(path.isfile(self.result))
+        self.assertTrue(path.isdir(self.stage))
+        self.assertFalse(path.isfile(self.orphaned))
+        self.assertFalse(path.isdir(self.orphan))
+
+class TestServerSchedule(ut.TestCase):
+    """Tests the worker pool that processes pull requests at the same time."""
+    def test_schedule(self):
+        """Tests that the global and per-repo limits on the number of pull
+        requests processed at the same time are honored.
+        """
+        from time import sleep
+        from threading import Lock
+        server = get_testing_server(archpath="~/codes/ci/tests/none.json")
+        server.settings._vardict["MAXJOBS"] = "3"
+        repo = server.repositories["arbitrary"]
+        other = RepositorySettings(server, repo.filepath)
+        other.name = "other"
+        server.cron.settings["arbitrary"].concurrency = 2
+        pulls = ([PullRequest(server, repo, FakePull(i), True) for i in range(4)] +
+                 [PullRequest(server, other, FakePull(i), True) for i in range(4)])
+
+        lock = Lock()
+        running = {"arbitrary": 0, "other": 0}
+        peaks = {"arbitrary": 0, "other": 0, "total": 0}
+        done = []
+        def target(pull):
+            with lock:
+                running[pull.repokey] += 1
+                peaks[pull.repokey] = max(peaks[pull.repokey], running[pull.repokey])
+                peaks["total"] = max(peaks["total"], sum(running.values()))
+            sleep(0.05)
+            with lock:
+                running[pull.repokey] -= 1
+                done.append((pull.repokey, pull.number))
+
+        server._schedule(pulls, target)
+        self.assertEqual(len(done), 8)
+        self.assertEqual(peaks["arbitrary"], 2)
+        #Repos without cron settings process one pull request at a time.
+        self.assertEqual(peaks["other"], 1)
+        self.assertEqual(peaks["total"], 3)
+
+class TestFindUpdated(ut.TestCase):
+    """Tests that pull requests with new commits are tested again."""
+    def test_find_pulls(self):
+        """Tests that a completed pull request whose head moved on is queued
+        again. The pull requests are looked up by number because test pulls don't
+        have a head SHA.
+        """
+        class FakeHead(object):
+            def __init__(self, sha):
+                self.sha = sha
+        class FakeOpenPull(FakePull):
+            def __init__(self, number, sha):
+                super(FakeOpenPull, self).__init__(number)
+                self.state = "open"
+                self.head = FakeHead(sha)
+            def get_commits(self):
+                return [None]
+        class FakeGithubRepo(object):
+            def __init__(self, pulls):
+                self.pulls = pulls
+            def get_pull(self, number):
+                return self.pulls[number]
+
+        server = get_testing_server(archpath="~/codes/ci/tests/none.json")
+        repo = server.repositories["arbitrary"]
+        old, new = "a"*40, "b"*40
+        repo._repo = FakeGithubRepo({1: FakeOpenPull(1, old), 2: FakeOpenPull(2, new)})
+        server.archive["arbitrary"] = {
+            "1": {"completed": True, "success": True, "sha": old},
+            "2": {"completed": True, "success": True, "sha": old}}
+
+        result = server.find_pulls(numbers={"arbitrary": [1, 2]})
+        self.assertEqual([p.number for p in result["arbitrary"]], [2])
+        self.assertEqual(result["arbitrary"][0].sha, new)
+
+class TestSnapshot(ut.TestCase):
+    """Tests the warm snapshots of a repo's default branch that new pull
+    requests take over.
+    """
+    def setUp(self):
+        from tempfile import mkdtemp
+        from os import path
+        from pyci.vcs import run_git, Mirror
+        self.folder = mkdtemp()
+        origin = path.join(self.folder, "origin")
+        run_git(["init", "-q", origin])
+        run_git(["symbolic-ref", "HEAD", "refs/heads/master"], cwd=origin)
+        user = ["-c", "user.name=pyci", "-c", "user.email=pyci@localhost"]
+        for filename, contents, ref in [(".gitignore", "*.out\n", None),
+                                        ("feature.py", "print 1\n", "refs/pull/1/head")]:
+            with open(path.join(origin, filename), 'w') as f:
+                f.write(contents)
+            run_git(["add", filename], cwd=origin)
+            run_git(user + ["commit", "-q", "-m", filename], cwd=origin)
+            if ref is not None:
+                run_git(["update-ref", ref, "HEAD"], cwd=origin)
+                run_git(["reset", "-q", "--hard", "HEAD~1"], cwd=origin)
+
+        self.server = get_testing_server(archpath="~/codes/ci/tests/none.json")
+        self.repo = RepositorySettings(self.server, self.server.repositories["arbitrary"].filepath)
+        self.repo.staging = path.join(self.folder, "staging")
+        self.repo.mirror = path.join(self.folder, "mirror.git")
+        #Each preparation appends to the ignored build product.
+        self.repo.prepare = ["echo built >> build.out"]
+        self.server.mirrors[self.repo.mirror] = Mirror(origin, self.repo.mirror)
+        self.origin = origin
+        self.master = run_git(["rev-parse", "HEAD"], cwd=origin).strip()
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def test_take(self):
+        """Tests that a prepared snapshot is taken over with its build products
+        and that the replaced staging directory is recycled.
+        """
+        from os import path
+        snapshot = self.server.snapshot(self.repo)
+        self.assertIsNone(snapshot.take(self.repo.staging, "refs/pull/1/head"))
+        snapshot.refresh()
+        self.assertEqual(snapshot.prepared, self.master)
+        self.assertTrue(path.isfile(path.join(snapshot.folder, "file.txt")))
+
+        sha = snapshot.take(self.repo.staging, "refs/pull/1/head")
+        self.assertEqual(sha, self.server.mirrors[self.repo.mirror].resolve("refs/pull/1/head"))
+        with open(path.join(self.repo.staging, "build.out")) as f:
+            self.assertEqual(f.read(), "built\n")
+        self.assertTrue(path.isfile(path.join(self.repo.staging, "feature.py")))
+        self.assertFalse(path.isdir(snapshot.folder))
+        self.assertIsNone(snapshot.take(self.repo.staging, "refs/pull/1/head"))
+
+        #The second time, the previous staging directory becomes the new snapshot
+        #and its build products are prepared again incrementally.
+        snapshot.refresh()
+        snapshot.take(self.repo.staging, "refs/pull/1/head")
+        self.assertIsNone(snapshot.prepared)
+        snapshot.refresh()
+        self.assertFalse(path.isfile(path.join(snapshot.folder, "feature.py")))
+        with open(path.join(snapshot.folder, "build.out")) as f:
+            self.assertEqual(f.read(), "built\nbuilt\n")
+
+    def test_fetch(self):
+        """Tests that a refresh between the processing cycles fetches the latest
+        commit of the default branch.
+        """
+        from os import path
+        from pyci.vcs import run_git
+        snapshot = self.server.snapshot(self.repo)
+        snapshot.refresh()
+        with open(path.join(self.origin, "README"), 'w') as f:
+            f.write("second\n")
+        user = ["-c", "user.name=pyci", "-c", "user.email=pyci@localhost"]
+        run_git(["add", "README"], cwd=self.origin)
+        run_git(user + ["commit", "-q", "-m", "README"], cwd=self.origin)
+        master = run_git(["rev-parse", "HEAD"], cwd=self.origin).strip()
+
+        snapshot.refresh()
+        self.assertEqual(snapshot.prepared, master)
+        self.assertTrue(path.isfile(path.join(snapshot.folder, "README")))
+        self.assertEqual(snapshot.take(self.repo.staging, "refs/pull/1/head"),
+                         self.server.mirrors[self.repo.mirror].resolve("refs/pull/1/head"))
+
+    def test_failure(self):
+        """Tests that a snapshot whose prepare commands fail isn't used."""
+        self.repo.prepare = ["echo broken; exit 3"]
+        snapshot = self.server.snapshot(self.repo)
+        self.assertRaises(ValueError, snapshot.refresh)
+        self.assertIsNone(snapshot.prepared)
+        self.assertIsNone(snapshot.take(self.repo.staging, "refs/pull/1/head"))
+
+    def test_stop(self):
+        """Tests that stopping the server terminates the prepare commands of a
+        refresh that runs in another thread.
+        """
+        from threading import Thread
+        from time import time
+        self.repo.prepare = ["sleep 30 & sleep 30"]
+        snapshot = self.server.snapshot(self.repo)
+        errors = []
+        def target():
+            try:
+                snapshot.refresh()
+            except ValueError as e:
+                errors.append(e)
+        worker = Thread(target=target)
+        worker.start()
+        until = time() + 10
+        while len(self.server.preparing) == 0 and time() < until:
+            worker.join(0.05)
+        command = self.server.preparing[0]
+
+        self.server.stop()
+        worker.join(10)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertLess(command.code, 0)
+        self.assertIsNone(snapshot.prepared)
+        self.assertRaises(ValueError, self.server.prepare, self.repo, self.folder)
+
+class TestBatch(ut.TestCase):
+    """Tests the bisection of batches of pull requests that fail together."""
+    def setUp(self):
+        self.server = get_testing_server(archpath="~/codes/ci/tests/none.json")
+        self.repo = self.server.repositories["arbitrary"]
+        self.pulls = [PullRequest(self.server, self.repo, FakePull(n), True) for n in range(1, 9)]
+        self.reported = []
+        self.server._process_pull = lambda pull, batch=None: self.reported.append(
+            (pull.number, None if batch is None else batch.number))
+
+    def _batch(self, broken, conflicts=(), pulls=None, superseded=()):
+        """Returns a Batch of the pull requests whose trial runs fail whenever one
+        of the 'broken' pull requests is merged in; the 'conflicts' don't merge and
+        the 'superseded' ones get new commits during the first trial.
+        """
+        batch = Batch(self.server, self.repo, self.pulls if pulls is None else pulls)
+        tested = []
+        def test(pulls):
+            merged = [p for p in pulls if p.number not in conflicts]
+            tested.append([p.number for p in merged])
+            trial = PullRequest(self.server, self.repo, merged[0].pull, True)
+            if len(tested) == 1:
+                for pull in merged:
+                    if pull.number in superseded:
+                        pull.cancel()
+            passed = not any(p.number in broken for p in merged)
+            trial.testing.tests = [{"success": passed}]
+            return merged, trial
+        batch.test = test
+        return batch, tested
+
+    def test_bisect(self):
+        """Tests that only the pull requests that break the tests are tested on
+        their own and the others are reported with the batch's results.
+        """
+        batch, tested = self._batch([])
+        batch.process()
+        self.assertEqual(tested, [list(range(1, 9))])
+        self.assertEqual(self.reported, [(n, 1) for n in range(1, 9)])
+
+        self.reported = []
+        batch, tested = self._batch([6], [2])
+        batch.process()
+        self.assertEqual(tested, [[1, 3, 4, 5, 6, 7, 8], [1, 3, 4], [5, 6, 7, 8], [5, 6], [7, 8]])
+        self.assertEqual(sorted(self.reported),
+                         [(1, 1), (2, None), (3, 1), (4, 1), (5, None), (6, None),
+                          (7, 7), (8, 7)])
+        self.assertEqual(sorted(batch.processed), list(range(1, 9)))
+
+    def test_single(self):
+        """Tests that a failing trial of the only pull request that merged is
+        reported as its own result instead of being bisected.
+        """
+        batch, tested = self._batch([1], [2], self.pulls[0:2])
+        batch.process()
+        self.assertEqual(tested, [[1]])
+        self.assertEqual(sorted(self.reported), [(1, 1), (2, None)])
+
+    def test_timeout(self):
+        """Tests that the pull requests of a trial that timed out are reported as
+        timed out rather than failed.
+        """
+        from datetime import datetime
+        del self.server._process_pull
+        keys = []
+        self.server.cron.email = lambda repo, key, fields, testmode: keys.append(key)
+        trial = PullRequest(self.server, self.repo, FakePull(1), True)
+        trial.repodir = self.repo.staging
+        trial.testing.tests = [dict(test, success=False, code=None, timedout=True,
+                                    start=datetime(2015, 4, 23, 13, 5),
+                                    end=datetime(2015, 4, 23, 13, 9))
+                               for test in trial.testing.tests]
+        trial.timedout = True
+        self.server.archive["arbitrary"] = {}
+        try:
+            self.server._process_pull(self.pulls[0], batch=trial)
+        finally:
+            from os import path, remove
+            if path.isfile(self.server.archpath):
+                remove(self.server.archpath)
+        self.assertEqual(keys, ["start", "timeout"])
+        self.assertTrue(self.pulls[0].timedout)
+
+    def test_superseded(self):
+        """Tests that pull requests updated during a trial are reported with it
+        (as cancelled) and the others are tested again without them.
+        """
+        batch, tested = self._batch([], superseded=[3, 5])
+        batch.process()
+        self.assertEqual(tested, [list(range(1, 9)), [1, 2, 4, 6, 7, 8]])
+        self.assertEqual(sorted(self.reported), [(n, 1) for n in range(1, 9)])
+
+        #Cancelling a pull request also cancels the trial that it is merged into.
+        pull = PullRequest(self.server, self.repo, FakePull(9), True)
+        pull.sha = "a"*40
+        pull.trial = PullRequest(self.server, self.repo, FakePull(9), True)
+        self.server.active[(pull.repokey, pull.snumber)] = pull
+        try:
+            self.assertTrue(self.server.supersede(pull.repokey, 9, "b"*40))
+            self.assertTrue(pull.trial.cancelled)
+        finally:
+            del self.server.active[(pull.repokey, pull.snumber)]
+
 def get_expected_results(repodir, process=None):
     """Returns a dict of the test results expected from running the commands
     for the unit tests (i.e. the tests run by the server).
@@ -261,20 +642,22 @@ class TestPullRequest(ut.TestCase):
         self.assertEqual(self.pull.repodir, path.expanduser("~/codes/ci/tests/repo"))
         self.assertTrue(path.isdir(self.pull.repodir))
 
-    def test_is_gitted(self):
-        """Tests the function that determines if a repo has been initialized
-        by git for the pull request CI automation.
-        """
-        from os import path
-        self.pull.repodir = path.expanduser("~/codes/ci/tests/repo")
-        self.assertTrue(self.pull._is_gitted())
-        #Now make sure it returns false for a non-git repo.
-        self.pull.repodir = path.expanduser("~/codes")
-        self.assertFalse(self.pull._is_gitted())
-        #Finally, check that it works for a git repo that is not made by the
-        #CI server.
-        self.pull.repodir = path.expanduser("~/codes/ci")
-        self.assertFalse(self.pull._is_gitted())
+        #The stages of previous attempts are only removed if they were the pull
+        #request's own and not shared with a batch.
+        from os import makedirs
+        stages = ["{}_{}".format(self.pull.repodir, s) for s in ["11", "batch"]]
+        try:
+            for stage in stages:
+                if not path.isdir(stage):
+                    makedirs(stage)
+                self.pull.init({"stage": stage})
+            self.assertFalse(path.isdir(stages[0]))
+            self.assertTrue(path.isdir(stages[1]))
+        finally:
+            from shutil import rmtree
+            for stage in stages:
+                if path.isdir(stage):
+                    rmtree(stage)
 
     #def test_begin(self):
     #begin gets skipped because it only does two things: call the wiki create function
@@ -292,17 +675,209 @@ class TestPullRequest(ut.TestCase):
         self.pull.test(self.expected)
 
         #Running the tests updates the values of the dictionary entries for
-        #each test in the repository settings object. We test those values
-        #now to make sure that they match. Most of the values are copied
-        #verbatim from the expected dictionary above, so we just check the
+        #each test in the pull request's copy of the testing settings. We test
+        #those values now to make sure that they match. Most of the values are
+        #copied verbatim from the expected dictionary above, so we just check the
         #ones that ought to change.
         for i in range(3):
-            self.assertEqual(self.repo.testing.tests[i]["success"], i%3 < 2)
-        self.assertEqual(self.repo.testing.tests[1]["command"],
+            self.assertEqual(self.pull.testing.tests[i]["success"], i%3 < 2)
+            self.assertIsNone(self.repo.testing.tests[i]["code"])
+        self.assertEqual(self.pull.testing.tests[1]["command"],
                          "/usr/local/bin/mytester tests/scripts.py")
-        self.assertEqual(self.repo.testing.tests[2]["command"],
+        self.assertEqual(self.pull.testing.tests[2]["command"],
                          "cd /Users/dev/data/; path tests/builders.py")
 
+    def _run_commands(self, commands, timeouts=None, slots=None, needs=None, cached=None,
+                      paths=None, changed=None, cancel=None):
+        """Runs the shell commands for a new pull request in a temporary staging
+        directory with PullRequest._run(). Returns the pull request and results.
+
+        :arg timeouts: a list of per-command timeouts in minutes.
+        :arg slots: the capacity of the server's slot pool during the run.
+        :arg needs: a list of the indices of the commands that each one needs;
+          the commands get their index as 'id'.
+        :arg cached: a dictionary of command indices and their cached exit codes.
+        :arg paths: a list of the path filters of each command.
+        :arg changed: the list of files changed by the pull request.
+        :arg cancel: the number of seconds after which the run is cancelled.
+        """
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        pull = PullRequest(self.server, self.repo, FakePull(12), True)
+        pull.repodir = mkdtemp()
+        pull.testing.timeout = None
+        if timeouts is None:
+            timeouts = [None]*len(commands)
+        if needs is None:
+            needs = [[]]*len(commands)
+        if paths is None:
+            paths = [[]]*len(commands)
+        pull.testing.tests = [{"command": c, "timeout": t, "slots": 1, "id": str(i),
+                               "needs": [str(n) for n in needs[i]], "paths": paths[i]}
+                              for i, (c, t) in enumerate(zip(commands, timeouts))]
+        pull.changed = changed
+        capacity = self.server.slots.capacity
+        if slots is not None:
+            self.server.slots.capacity = slots
+        try:
+            if cached is not None:
+                cached = dict((i, {"code": c, "bytes": 0, "output": None})
+                              for i, c in cached.items())
+            if cancel is not None:
+                from threading import Timer
+                Timer(cancel, pull.cancel).start()
+            return pull, pull._run(grace=1, cached=cached)
+        finally:
+            self.server.slots.capacity = capacity
+            rmtree(pull.repodir)
+
+    def test_timeout(self):
+        """Tests that a command running past its deadline has its whole process
+        group killed while the other commands finish normally.
+        """
+        from time import time
+        start = time()
+        #The timeouts are in minutes; a second is enough to test with.
+        pull, ordered = self._run_commands(["echo done", "sleep 30 & sleep 30"],
+                                           [None, 1./60])
+        self.assertLess(time() - start, 10)
+        self.assertEqual(ordered[0]["code"], 0)
+        self.assertFalse(ordered[0].get("timedout", False))
+        self.assertTrue(ordered[1]["timedout"])
+        self.assertIsNone(ordered[1]["code"])
+        self.assertEqual(self.server.slots.used, 0)
+
+    def test_needs(self):
+        """Tests that commands wait for the commands they need and are skipped
+        when one of those fails.
+        """
+        pull, ordered = self._run_commands(["sleep 0.5; touch built", "test -f built",
+                                            "test -f built", "exit 3", "echo never"],
+                                           needs=[[], [0], [0], [], [1, 3]])
+        first, second, third, failed, last = pull.testing.tests
+        self.assertGreaterEqual(second["start"], ordered[0]["end"])
+        self.assertGreaterEqual(third["start"], ordered[0]["end"])
+        self.assertEqual([ordered[i]["code"] for i in range(4)], [0, 0, 0, 3])
+        self.assertTrue(ordered[4]["skipped"])
+        self.assertIsNone(ordered[4]["code"])
+        self.assertFalse(ordered[1]["skipped"])
+        self.assertEqual(pull.testing.format_code({"code": None, "skipped": True}), "Skipped")
+        self.assertEqual(self.server.slots.used, 0)
+
+    def test_cached(self):
+        """Tests that commands with a cached result aren't run and still decide
+        whether the commands that need them run.
+        """
+        pull, ordered = self._run_commands(["touch ran.0", "exit 4", "echo one", "echo two"],
+                                           needs=[[], [], [0], [1]], cached={0: 0, 1: 2})
+        self.assertEqual([ordered[i]["code"] for i in range(3)], [0, 2, 0])
+        self.assertEqual([ordered[i]["cached"] for i in range(3)], [True, True, False])
+        self.assertTrue(ordered[3]["skipped"])
+        self.assertEqual(pull.testing.format_code({"code": 2, "cached": True}), "2 (cached)")
+
+    def test_paths(self):
+        """Tests that commands whose paths the pull request didn't change are
+        skipped unless a command that runs needs them.
+        """
+        pull, ordered = self._run_commands(["echo build", "echo fortran", "echo docs",
+                                            "echo python"],
+                                           needs=[[], [0], [], [0]],
+                                           paths=[["src/**"], ["src/fortran/**"], ["docs/**"],
+                                                  ["src/python/**"]],
+                                           changed=["src/fortran/mod.f90", "README"])
+        self.assertEqual([ordered[i]["code"] for i in range(2)], [0, 0])
+        self.assertEqual([ordered[i]["filtered"] for i in range(4)], [False, False, True, True])
+        pull.test(ordered)
+        self.assertTrue(all(t["success"] for t in pull.testing.tests))
+        self.assertEqual(pull.testing.format_code(pull.testing.tests[2]), "Skipped (paths)")
+
+        pull, ordered = self._run_commands(["echo build", "echo docs"], paths=[[], ["docs/**"]])
+        self.assertFalse(ordered[1]["filtered"])
+
+    def test_cancel(self):
+        """Tests that a cancelled run kills the process groups of its running
+        commands, skips the others and frees its slots.
+        """
+        from time import time
+        start = time()
+        pull, ordered = self._run_commands(["sleep 30 & sleep 30", "sleep 30", "echo late"],
+                                           slots=2, cancel=0.5)
+        self.assertLess(time() - start, 10)
+        self.assertTrue(pull.cancelled)
+        self.assertEqual([ordered[i]["skipped"] for i in range(3)], [False, False, True])
+        self.assertLess(ordered[0]["code"], 0)
+        self.assertEqual(self.server.slots.used, 0)
+
+    def test_supersede(self):
+        """Tests that only a run for an outdated head commit is cancelled."""
+        pull = PullRequest(self.server, self.repo, FakePull(12), True)
+        pull.sha = "a"*40
+        self.server.active[(pull.repokey, pull.snumber)] = pull
+        try:
+            self.assertFalse(self.server.supersede(pull.repokey, 12, "a"*40))
+            self.assertFalse(self.server.supersede(pull.repokey, 13, "b"*40))
+            self.assertFalse(pull.cancelled)
+            self.assertTrue(self.server.supersede(pull.repokey, 12, "b"*40))
+            self.assertTrue(pull.cancelled)
+        finally:
+            del self.server.active[(pull.repokey, pull.snumber)]
+
+    def test_slots(self):
+        """Tests that commands wait for free slots in the server's pool."""
+        pull, ordered = self._run_commands(["sleep 0.5", "sleep 0.5"], slots=1)
+        first, second = pull.testing.tests
+        self.assertGreaterEqual(second["start"], ordered[0]["end"])
+        self.assertEqual(self.server.slots.used, 0)
+
+        slots = SlotPool(2)
+        self.assertEqual(slots.acquire(5), 2)
+        self.assertEqual(slots.acquire(1, False), 0)
+        slots.release(2)
+        self.assertEqual(slots.acquire(1, False), 1)
+
+    def test_reserve(self):
+        """Tests that a command needing many slots reserves the pool so that a
+        stream of single-slot commands can't starve it.
+        """
+        from threading import Thread, Timer
+        from time import sleep, time
+        slots = SlotPool(2)
+        self.assertEqual(slots.acquire(1, False, "light1"), 1)
+        self.assertEqual(slots.acquire(2, False, "heavy"), 0)
+        self.assertEqual(slots.acquire(1, False, "light2"), 0)
+        slots.release(1)
+        self.assertEqual(slots.acquire(2, False, "heavy"), 2)
+        self.assertIsNone(slots.reserved)
+        slots.release(2)
+        self.assertEqual(slots.acquire(1, False, "light1"), 1)
+        self.assertEqual(slots.acquire(2, False, "heavy"), 0)
+        slots.unreserve("heavy")
+        self.assertEqual(slots.acquire(1, False, "light2"), 1)
+        slots.release(2)
+
+        #Overlapping single-slot commands keep the pool busy all the time.
+        stopped = []
+        def stream():
+            count = 0
+            while len(stopped) == 0:
+                count += 1
+                if slots.acquire(1, False, "light{}".format(count)):
+                    Timer(0.05, slots.release, (1,)).start()
+                sleep(0.02)
+        worker = Thread(target=stream)
+        worker.start()
+        try:
+            until = time() + 5
+            taken = 0
+            while not taken and time() < until:
+                taken = slots.acquire(2, False, "heavy")
+                sleep(0.01)
+            self.assertEqual(taken, 2)
+            slots.release(2)
+        finally:
+            stopped.append(True)
+            worker.join()
+
     def test_finalize(self):
         """Tests the analysis of the testing results and the compilation of
         success percentages and total run times.
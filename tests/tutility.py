@@ -32,33 +32,32 @@ class TestUtilities(ut.TestCase):
         result = path.expanduser("~/codes/ci/pyci/config.py")
         self.assertEqual(result, get_repo_relpath(repodir, relpath))
 
+    def test_match_paths(self):
+        """Tests the matching of changed files against path patterns with '*'
+        and '**' wildcards.
+        """
+        patterns = ["src/fortran/**", "./docs/*.md"]
+        self.assertTrue(match_paths(["src/fortran/a/b.f90"], patterns))
+        self.assertTrue(match_paths(["README", "docs/index.md"], patterns))
+        self.assertFalse(match_paths(["docs/api/index.md", "src/python/a.py"], patterns))
+        self.assertTrue(match_paths(["tests/a/b/test.py"], ["**/test.py"]))
+        self.assertTrue(match_paths(["test.py"], ["**/test.py"]))
+        self.assertFalse(match_paths([], ["**"]))
+
     #def test_get_json(self): is simple enough; if the python library is unit
     #tested, we don't need to also test it.
 
-    def test_run_exec(self):
-        """Tests the running of a command in a subprocess, particularly within
-        the context of the multiprocessing module.
+    def test_load_with_datetime(self):
+        """Tests that only the values of the known datetime keys are decoded,
+        with and without microseconds.
         """
-        from multiprocessing import Process, Queue
-        output = Queue()
-        repodir = "~/codes/ci/tests/repo"
-        processes = []
-        for i in range(3):
-            processes.append(Process(target=run_exec, args=(repodir, "ls -la", output, i)))
-            processes[-1].start()
-            
-        #Wait for the unit tests to all finish.
-        for p in processes:
-            p.join()
-        results = [output.get() for p in processes]
-        ordered = {o["index"]: o for o in results}
-
-        #We consider the test successful if the output files were created and the end time
-        #is not None. That means that the process ran correctly and python didn't lose
-        #control of the subprocess.
-        from os import path
-        fullrepo = path.expanduser(repodir)
-        for i in range(3):
-            self.assertTrue(path.isfile(path.join(fullrepo, "{}.cidat".format(i))))
-            self.assertIsNotNone(ordered[i]["end"])
-            self.assertEqual(ordered[i]["code"], 0)
+        import json
+        from datetime import datetime
+        start = datetime(2016, 3, 4, 5, 6, 7, 89)
+        data = {"start": start, "end": datetime(2016, 3, 4, 5, 6, 7),
+                "sha": "2016-03-04T05:06:07", "finished": None, "started": "never"}
+        result = json.loads(json.dumps(data, default=json_serial),
+                            object_pairs_hook=load_with_datetime)
+        self.assertEqual(data, result)
+        self.assertEqual(start, parse_datetime(start.isoformat()))
+        self.assertRaises(ValueError, parse_datetime, "03/04/2016")
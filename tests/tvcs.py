@@ -0,0 +1,188 @@
+"""Unit tests for the local git mirrors and worktrees of the repos."""
+import unittest as ut
+from pyci.vcs import *
+
+class TestMirror(ut.TestCase):
+    """Tests the mirroring of a local repository with pull request refs and
+    the checkout of its pull requests as worktrees.
+    """
+    def setUp(self):
+        from tempfile import mkdtemp
+        from os import path
+        self.folder = mkdtemp()
+        self.origin = path.join(self.folder, "origin")
+        run_git(["init", "-q", self.origin])
+        run_git(["symbolic-ref", "HEAD", "refs/heads/master"], cwd=self.origin)
+        self._commit("README", "first\n")
+        self._commit("feature.py", "print 1\n", "refs/pull/1/head")
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def _commit(self, filename, contents, ref=None):
+        """Commits the file to the master branch of the origin repo, or to the
+        specified ref on top of master.
+        """
+        from os import path
+        user = ["-c", "user.name=pyci", "-c", "user.email=pyci@localhost"]
+        if ref is not None:
+            run_git(["checkout", "-q", "--detach", "master"], cwd=self.origin)
+        with open(path.join(self.origin, filename), 'w') as f:
+            f.write(contents)
+        run_git(["add", filename], cwd=self.origin)
+        run_git(user + ["commit", "-q", "-m", filename], cwd=self.origin)
+        if ref is not None:
+            run_git(["update-ref", ref, "HEAD"], cwd=self.origin)
+            run_git(["checkout", "-q", "master"], cwd=self.origin)
+
+    def test_checkout(self):
+        """Tests that the worktree of a pull request is reused for the next one,
+        keeping only the static files, and that the mirror is fetched once per
+        cycle.
+        """
+        from os import path
+        mirror = Mirror(self.origin, path.join(self.folder, "mirror.git"))
+        mirror.update(1)
+        target = path.join(self.folder, "staging")
+        sha = mirror.checkout(target, "refs/pull/1/head", ["./file.txt"])
+        self.assertEqual(sha, mirror.resolve("refs/pull/1/head"))
+        self.assertTrue(mirror.is_worktree(target))
+        self.assertTrue(path.isfile(path.join(target, "feature.py")))
+
+        for filename in ["file.txt", "0.cidat"]:
+            with open(path.join(target, filename), 'w') as f:
+                f.write("untracked\n")
+        self._commit("other.py", "print 2\n", "refs/pull/2/head")
+        mirror.update(1)
+        self.assertIsNone(mirror.resolve("refs/pull/2/head"))
+        mirror.update(2)
+        mirror.checkout(target, "refs/pull/2/head", ["./file.txt"])
+        self.assertTrue(path.isfile(path.join(target, "other.py")))
+        self.assertFalse(path.isfile(path.join(target, "feature.py")))
+        self.assertFalse(path.isfile(path.join(target, "0.cidat")))
+        self.assertTrue(path.isfile(path.join(target, "file.txt")))
+        self.assertRaises(ValueError, mirror.checkout, target, "refs/pull/3/head")
+
+    def test_changed(self):
+        """Tests the listing of the files that a pull request changed since it
+        branched off master, ignoring the later changes on master.
+        """
+        from os import path
+        self._commit("README", "second\n")
+        mirror = Mirror(self.origin, path.join(self.folder, "mirror.git"))
+        mirror.update()
+        self.assertEqual(mirror.changed("refs/heads/master", "refs/pull/1/head"), ["feature.py"])
+
+    def test_merge(self):
+        """Tests that pull requests are merged into a worktree of master unless
+        they conflict with the ones merged before them.
+        """
+        from os import path
+        self._commit("other.py", "print 2\n", "refs/pull/2/head")
+        self._commit("feature.py", "print 3\n", "refs/pull/3/head")
+        mirror = Mirror(self.origin, path.join(self.folder, "mirror.git"))
+        mirror.update()
+        target = path.join(self.folder, "batch")
+        mirror.checkout(target, "refs/heads/master")
+        self.assertEqual([mirror.merge(target, "refs/pull/{}/head".format(n)) for n in [1, 2, 3, 4]],
+                         [True, True, False, False])
+        with open(path.join(target, "feature.py")) as f:
+            self.assertEqual(f.read(), "print 1\n")
+        self.assertTrue(path.isfile(path.join(target, "other.py")))
+        self.assertEqual(run_git(["status", "--porcelain"], cwd=target), "")
+
+    def test_prune(self):
+        """Tests that the worktrees of deleted staging directories are pruned."""
+        from os import path
+        from shutil import rmtree
+        mirror = Mirror(self.origin, path.join(self.folder, "mirror.git"))
+        mirror.update()
+        targets = [path.join(self.folder, "staging_{}".format(i)) for i in range(2)]
+        for target in targets:
+            mirror.checkout(target, "refs/pull/1/head")
+        rmtree(targets[0])
+        mirror.prune()
+        worktrees = run_git(["worktree", "list", "--porcelain"], gitdir=mirror.folder)
+        self.assertNotIn(targets[0] + "\n", worktrees)
+        self.assertIn(targets[1] + "\n", worktrees)
+
+    def test_remove(self):
+        """Tests that removed worktrees are forgotten by the mirror right away."""
+        from os import path
+        mirror = Mirror(self.origin, path.join(self.folder, "mirror.git"))
+        mirror.update()
+        target = path.join(self.folder, "staging_1")
+        mirror.checkout(target, "refs/pull/1/head")
+        with open(path.join(target, "0.cidat"), 'w') as f:
+            f.write("untracked\n")
+        mirror.remove(target)
+        self.assertFalse(path.isdir(target))
+        self.assertEqual(list(GitState(mirror.folder).worktrees()), [])
+
+    def test_options(self):
+        """Tests that the shallow depth, partial clone filter and sparse paths
+        are respected by the mirror and its worktrees.
+        """
+        from os import path, makedirs
+        run_git(["config", "uploadpack.allowFilter", "true"], cwd=self.origin)
+        for folder in ["src", "docs"]:
+            makedirs(path.join(self.origin, folder))
+        self._commit("src/module.py", "print 3\n")
+        self._commit("docs/guide.txt", "docs\n", "refs/pull/4/head")
+
+        mirror = Mirror("file://{}".format(self.origin), path.join(self.folder, "mirror.git"),
+                        depth=1, filter="blob:none", sparse=["src"])
+        mirror.update()
+        self.assertEqual(run_git(["rev-parse", "--is-shallow-repository"],
+                                 gitdir=mirror.folder).strip(), "true")
+        self.assertEqual(run_git(["config", "remote.origin.partialclonefilter"],
+                                 gitdir=mirror.folder).strip(), "blob:none")
+
+        target = path.join(self.folder, "staging")
+        mirror.checkout(target, "refs/pull/4/head")
+        self.assertTrue(path.isfile(path.join(target, "src", "module.py")))
+        self.assertTrue(path.isfile(path.join(target, "README")))
+        self.assertFalse(path.isdir(path.join(target, "docs")))
+        mirror.update()
+        mirror.checkout(target, "refs/pull/1/head")
+        self.assertTrue(path.isfile(path.join(target, "feature.py")))
+        self.assertFalse(path.isdir(path.join(target, "src")))
+
+    def test_state(self):
+        """Tests the reading of the config, HEAD and refs of a repository, a bare
+        mirror and one of its worktrees without running git.
+        """
+        from os import path
+        state = GitState(self.origin)
+        self.assertTrue(state.valid)
+        self.assertEqual(state.branch, "master")
+        self.assertEqual(state.head, run_git(["rev-parse", "HEAD"], cwd=self.origin).strip())
+        pull = run_git(["rev-parse", "refs/pull/1/head"], cwd=self.origin).strip()
+        self.assertEqual(state.ref("refs/pull/1/head"), pull)
+        self.assertIsNone(state.remote())
+        run_git(["remote", "add", "origin", "git@github.com:owner/repo.git"], cwd=self.origin)
+        self.assertEqual(GitState(self.origin).remote(), "git@github.com:owner/repo.git")
+
+        #Packed refs are found once the loose ones are gone.
+        run_git(["pack-refs", "--all"], cwd=self.origin)
+        state = GitState(self.origin)
+        self.assertFalse(path.isfile(path.join(self.origin, ".git", "refs", "pull", "1", "head")))
+        self.assertEqual(state.ref("refs/pull/1/head"), pull)
+        self.assertEqual(state.refs("refs/pull/"), {"refs/pull/1/head": pull})
+        self.assertIsNone(state.ref("refs/pull/2/head"))
+
+        mirror = Mirror(self.origin, path.join(self.folder, "mirror.git"))
+        mirror.update()
+        self.assertEqual(GitState(mirror.folder).remote(), self.origin)
+        target = path.join(self.folder, "staging")
+        mirror.checkout(target, "refs/pull/1/head")
+        state = GitState(target)
+        self.assertTrue(mirror.is_worktree(target))
+        self.assertEqual(path.realpath(state.commondir), path.realpath(mirror.folder))
+        self.assertEqual(state.head, pull)
+        self.assertIsNone(state.branch)
+        self.assertEqual(GitState(mirror.folder).worktrees(), {target: True})
+
+        self.assertFalse(GitState(self.folder).valid)
+        self.assertFalse(mirror.is_worktree(self.origin))
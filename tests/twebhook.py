@@ -0,0 +1,95 @@
+"""Unit tests for the github webhook receiver in pyci."""
+import unittest as ut
+from pyci.webhook import *
+
+class TestWebhook(ut.TestCase):
+    """Tests the webhook listener by posting a recorded github payload to it.
+    """
+    @classmethod
+    def setUpClass(self):
+        from os import path
+        from tserver import get_testing_server
+        self.server = get_testing_server()
+        self.secret = "webhook-secret"
+        self.hooks = WebhookServer(self.server, ("127.0.0.1", 0), self.secret)
+        self.hooks.start()
+        with open(path.expanduser("~/codes/ci/tests/webhook/pull_request.json")) as f:
+            self.payload = f.read()
+
+    @classmethod
+    def tearDownClass(self):
+        self.hooks.shutdown()
+        self.hooks.server_close()
+
+    def _post(self, body, event="pull_request", signature=None, hooks=None):
+        """Posts the body to the listener (or the 'hooks' WebhookServer) and
+        returns the HTTP status code.
+        """
+        import urllib2
+        import hmac
+        import hashlib
+        if signature is None:
+            signature = "sha256=" + hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        hooks = self.hooks if hooks is None else hooks
+        url = "http://127.0.0.1:{}/".format(hooks.server_address[1])
+        request = urllib2.Request(url, body, {"X-GitHub-Event": event,
+                                              "X-Hub-Signature-256": signature,
+                                              "Content-Type": "application/json"})
+        try:
+            return urllib2.urlopen(request).getcode()
+        except urllib2.HTTPError as e:
+            return e.code
+
+    def test_verify_signature(self):
+        """Tests the HMAC verification of the payload signatures."""
+        import hmac
+        import hashlib
+        body = "payload"
+        sha1 = "sha1=" + hmac.new("key", body, hashlib.sha1).hexdigest()
+        self.assertTrue(verify_signature("key", body, sha1))
+        self.assertFalse(verify_signature("other", body, sha1))
+        self.assertFalse(verify_signature("key", body, None))
+        self.assertFalse(verify_signature("key", body, "md5=abc"))
+
+    def test_unsigned(self):
+        """Tests that payloads are rejected when no secret is configured unless
+        unsigned payloads are explicitly allowed.
+        """
+        for insecure, code in [(False, 403), (True, 202)]:
+            hooks = WebhookServer(self.server, ("127.0.0.1", 0), None, insecure)
+            hooks.start()
+            try:
+                self.assertEqual(self._post(self.payload, signature="", hooks=hooks), code)
+            finally:
+                hooks.shutdown()
+                hooks.server_close()
+            self.assertEqual(len(hooks.queue.drain()), 1 if insecure else 0)
+
+    def test_pull_request(self):
+        """Tests that a signed pull_request event queues the pull request for
+        the installed repository and that invalid requests are rejected.
+        """
+        self.hooks.queue.drain()
+        self.assertEqual(self._post(self.payload), 202)
+        self.assertEqual(self._post(self.payload), 202)
+        self.assertEqual(self.hooks.queue.drain(), {"arbitrary": [11]})
+
+        self.assertEqual(self._post(self.payload, signature="sha256=bogus"), 403)
+        self.assertEqual(self._post("{}", event="ping"), 200)
+        self.assertEqual(self._post("not json"), 400)
+        #New commits cancel the run for the previous head of the pull request.
+        from tserver import FakePull
+        from pyci.server import PullRequest
+        pull = PullRequest(self.server, self.server.repositories["arbitrary"], FakePull(11), True)
+        pull.sha = "0"*40
+        self.server.active[("arbitrary", "11")] = pull
+        try:
+            self.assertEqual(self._post(self.payload), 202)
+            self.assertTrue(pull.cancelled)
+        finally:
+            del self.server.active[("arbitrary", "11")]
+        self.hooks.queue.drain()
+
+        closed = self.payload.replace('"synchronize"', '"closed"')
+        self.assertEqual(self._post(closed), 202)
+        self.assertEqual(self.hooks.queue.drain(), {})